@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import heapq
+import itertools
+import math
+import time
+from starlette.responses import JSONResponse
+import config
+import client_tokens
+from key_pool import pool
+
+# 优先级，数值越小越先被放行
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+
+class AdmissionRejected(Exception):
+    """等待队列已满或等待超时"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.message = message
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """上游并发准入控制
+
+    并发数达到上限时请求进入有界等待队列，按 (优先级, 客户端虚拟时间, 到达顺序)
+    出队：同一优先级内各客户端轮流放行，单个客户端的突发不会饿死其他客户端。
+    """
+
+    def __init__(self):
+        self.active = 0
+        self.waiters = []
+        # 仍在等待的请求数；waiters 中还有超时或断开后留下的失效条目，数量为 dead
+        self.queued = 0
+        self.dead = 0
+        self.seq = itertools.count()
+        # 各客户端下一个请求的虚拟时间，以及全局已放行的虚拟时间
+        self.client_vtime = {}
+        self.vtime = 0
+        # 请求占用时长的滑动平均，用于估算 Retry-After
+        self.avg_hold = 1.0
+        self.admitted_total = 0
+        self.rejected_total = 0
+
+    def capacity(self) -> int:
+        if config.ADMISSION_MAX_CONCURRENCY > 0:
+            return config.ADMISSION_MAX_CONCURRENCY
+        return (len(pool.positive) + len(pool.zero)) * config.ADMISSION_PER_KEY_CONCURRENCY
+
+    def retry_after(self) -> int:
+        capacity = max(self.capacity(), 1)
+        return max(1, math.ceil(self.avg_hold * (self.queued + 1) / capacity))
+
+    async def acquire(self, client_id: str, priority: int):
+        capacity = self.capacity()
+        # 没有可用key时直接放行，由转发逻辑返回错误
+        if capacity <= 0 or (self.active < capacity and not self.queued):
+            self.active += 1
+            self.admitted_total += 1
+            return
+
+        if self.queued >= config.ADMISSION_QUEUE_SIZE:
+            self.rejected_total += 1
+            raise AdmissionRejected("请求过多，等待队列已满", self.retry_after())
+
+        start = max(self.client_vtime.get(client_id, 0), self.vtime)
+        self.client_vtime[client_id] = start + 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, start, next(self.seq), future))
+        self.queued += 1
+        try:
+            await asyncio.wait_for(future, timeout=config.ADMISSION_MAX_WAIT)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # 超时的同时已被放行，名额已经计入 active，需要归还
+                self.active -= 1
+                self._wake()
+            self.rejected_total += 1
+            raise AdmissionRejected("请求过多，排队等待超时", self.retry_after())
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # 已被放行但客户端已断开，归还名额
+                self.active -= 1
+                self._wake()
+            raise
+        finally:
+            # 超时或客户端断开时 future 被取消，条目留在堆中，出队或压缩时移除
+            if future.cancelled():
+                self.queued -= 1
+                self.dead += 1
+                if self.dead * 2 > len(self.waiters):
+                    self._compact()
+        self.admitted_total += 1
+
+    def _compact(self):
+        """持续过载时失效条目会不断累积，超过一半时重建堆"""
+        self.waiters = [entry for entry in self.waiters if not entry[3].done()]
+        heapq.heapify(self.waiters)
+        self.dead = 0
+
+    def release(self, hold_time: float):
+        self.avg_hold += 0.1 * (hold_time - self.avg_hold)
+        self.active -= 1
+        self._wake()
+
+    def _wake(self):
+        capacity = self.capacity()
+        while self.waiters and (self.active < capacity or capacity <= 0):
+            _, start, _, future = heapq.heappop(self.waiters)
+            if future.done():
+                self.dead -= 1
+                continue
+            self.queued -= 1
+            self.vtime = max(self.vtime, start)
+            self.active += 1
+            future.set_result(True)
+        if not self.waiters:
+            # 队列清空后重置虚拟时间，避免计数无限增长
+            self.client_vtime.clear()
+            self.vtime = 0
+
+    def snapshot(self):
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "queue_entries": len(self.waiters),
+            "capacity": self.capacity(),
+            "admitted_total": self.admitted_total,
+            "rejected_total": self.rejected_total,
+        }
+
+
+controller = AdmissionController()
+
+
+def classify(headers) -> tuple:
+    """根据请求头确定客户端标识与优先级"""
+    authorization = headers.get("authorization", "")
+    token = authorization[7:] if authorization.startswith("Bearer ") else authorization
+    client = client_tokens.lookup(authorization)
+    if client is not None:
+        priority_name = client.priority
+    else:
+        priority_name = config.ADMISSION_TOKEN_PRIORITIES.get(token)
+    if priority_name is None:
+        # 免费模型专用token的请求默认低优先级
+        if config.FREE_MODEL_API_KEY and token == config.FREE_MODEL_API_KEY:
+            priority_name = "low"
+        else:
+            priority_name = "normal"
+    client_id = hashlib.sha256(authorization.encode("utf-8")).hexdigest()[:16]
+    return client_id, PRIORITIES.get(priority_name, PRIORITIES["normal"])
+
+
+class AdmissionMiddleware:
+    """对 /v1 下的 POST 请求做准入控制，流式响应结束后才释放名额"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not scope["path"].startswith("/v1/")
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]}
+        client_id, priority = classify(headers)
+        try:
+            await controller.acquire(client_id, priority)
+        except AdmissionRejected as e:
+            response = JSONResponse(
+                {"detail": e.message},
+                status_code=429,
+                headers={"Retry-After": str(e.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+
+        start = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            controller.release(time.monotonic() - start)
@@ -0,0 +1,120 @@
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+
+STATIC_DIR = "static"
+MANIFEST_FILE = os.path.join(STATIC_DIR, "dist", "manifest.json")
+
+# 带内容哈希的资源内容不会变化，可以永久缓存
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# 原文件名 -> 带哈希的文件名，由 build_assets.py 生成
+_manifest = {}
+# HTML 文件名 -> (修改时间, ETag, 内容, gzip 压缩后的内容)
+_html_cache = {}
+
+
+def load_manifest():
+    """加载静态资源清单，未构建时直接使用原文件"""
+    global _manifest
+    try:
+        with open(MANIFEST_FILE, "r", encoding="utf-8") as f:
+            _manifest = json.load(f)
+    except FileNotFoundError:
+        _manifest = {}
+    except Exception as e:
+        logging.warning(f"读取静态资源清单失败: {str(e)}")
+        _manifest = {}
+    _html_cache.clear()
+
+
+def _render_html(path: str, mtime: float):
+    with open(path, "r", encoding="utf-8") as f:
+        html = f.read()
+    # 把资源地址替换为带哈希的版本
+    for name, hashed in _manifest.items():
+        html = html.replace(f'/static/{name}"', f'/static/{hashed}"')
+    body = html.encode("utf-8")
+    etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+    return mtime, etag, body, gzip.compress(body, compresslevel=6)
+
+
+def html_response(request_headers: Headers, path: str) -> Response:
+    """返回改写过资源地址的 HTML，内容不变时返回304"""
+    mtime = os.stat(path).st_mtime
+    entry = _html_cache.get(path)
+    if entry is None or entry[0] != mtime:
+        entry = _html_cache[path] = _render_html(path, mtime)
+    _, etag, body, compressed = entry
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if request_headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    if "gzip" in request_headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        body = compressed
+    return Response(body, media_type="text/html", headers=headers)
+
+
+class AssetFiles(StaticFiles):
+    """静态文件服务
+
+    - HTML 按清单改写资源地址，带 ETag，每次向服务端确认是否有更新
+    - dist/ 下带哈希的资源优先返回预压缩的 br/gzip 版本，并永久缓存
+    """
+
+    async def get_response(self, path: str, scope):
+        if scope["method"] not in ("GET", "HEAD"):
+            return await super().get_response(path, scope)
+        full_path, stat_result = self.lookup_path(path)
+        if stat_result is None or not os.path.isfile(full_path):
+            return await super().get_response(path, scope)
+
+        headers = Headers(scope=scope)
+        if full_path.endswith(".html"):
+            return html_response(headers, full_path)
+
+        if path.replace(os.sep, "/").startswith("dist/"):
+            accept = headers.get("accept-encoding", "")
+            for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+                if encoding in accept and os.path.isfile(full_path + suffix):
+                    response = self.file_response(
+                        full_path + suffix, os.stat(full_path + suffix), scope
+                    )
+                    # 按原文件类型返回，而不是 .gz/.br
+                    content_type = mimetypes.guess_type(full_path)[0] or "text/plain"
+                    response.headers["Content-Type"] = content_type
+                    response.headers["Content-Encoding"] = encoding
+                    break
+            else:
+                response = self.file_response(full_path, stat_result, scope)
+            response.headers["Cache-Control"] = IMMUTABLE
+            response.headers["Vary"] = "Accept-Encoding"
+            return response
+
+        return self.file_response(full_path, stat_result, scope)
+
+
+class CompressionMiddleware:
+    """只对指定路径前缀的响应做 gzip 压缩
+
+    用于体积较大的管理接口 JSON，避免压缩 /v1 的流式转发和 SSE 事件流。
+    """
+
+    def __init__(self, app, paths, minimum_size: int = 1024):
+        self.app = app
+        self.paths = tuple(paths)
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(self.paths):
+            await self.gzip(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
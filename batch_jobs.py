@@ -0,0 +1,339 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from fastapi import HTTPException
+import client_tokens
+import config
+import db
+
+logger = logging.getLogger(__name__)
+
+# 批量任务的请求文件和结果文件所在目录
+BATCH_DIR = "batches"
+# 批量任务支持的接口，与 routers.generate.BATCH_ENDPOINTS 一致
+BATCH_URLS = ("/v1/chat/completions", "/v1/completions", "/v1/embeddings")
+# 上游返回429/5xx或请求异常时的最大尝试次数
+MAX_ATTEMPTS = 3
+# 每完成多少个请求把进度写入一次数据库
+PROGRESS_EVERY = 20
+
+# 还没有结束的任务状态
+ACTIVE_STATUSES = ("queued", "in_progress", "cancelling")
+
+
+class BatchJob:
+    """一个批量任务，进度以结果文件为准，数据库中的计数定期更新"""
+
+    def __init__(self, row):
+        (
+            self.id,
+            self.status,
+            self.client_hash,
+            free_token,
+            self.total,
+            self.completed,
+            self.failed,
+            self.created_at,
+            self.started_at,
+            self.finished_at,
+            self.error,
+        ) = row
+        self.client_hash = self.client_hash or ""
+        self.free_token = bool(free_token)
+
+    @property
+    def input_file(self) -> str:
+        return os.path.join(BATCH_DIR, f"{self.id}_input.jsonl")
+
+    @property
+    def output_file(self) -> str:
+        return os.path.join(BATCH_DIR, f"{self.id}_output.jsonl")
+
+    def save(self):
+        db.update_batch_job(
+            self.id,
+            self.status,
+            self.completed,
+            self.failed,
+            self.started_at,
+            self.finished_at,
+            self.error,
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "object": "batch",
+            "status": self.status,
+            "created_at": self.created_at,
+            "in_progress_at": self.started_at,
+            "completed_at": self.finished_at,
+            "error": self.error,
+            "request_counts": {
+                "total": self.total,
+                "completed": self.completed,
+                "failed": self.failed,
+            },
+            "output_url": f"/v1/batches/{self.id}/output",
+        }
+
+
+# 任务ID -> BatchJob
+_jobs = {}
+# 有新任务时唤醒后台处理，在 run() 中创建
+_wakeup = None
+
+
+def load():
+    """从数据库加载批量任务，未结束的任务会在后台继续处理"""
+    _jobs.clear()
+    for row in db.get_batch_jobs():
+        job = BatchJob(row)
+        _jobs[job.id] = job
+
+
+def parse(raw: bytes) -> list:
+    """校验上传的 JSONL 文件，每行为 {"custom_id", "method", "url", "body"}
+
+    格式错误时抛出 HTTPException(400)
+    """
+    try:
+        text = raw.decode("utf-8")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="文件必须是 UTF-8 编码的 JSONL")
+    requests = []
+    seen = set()
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"第 {number} 行不是有效的 JSON")
+        if not isinstance(item, dict):
+            raise HTTPException(status_code=400, detail=f"第 {number} 行必须是 JSON 对象")
+        custom_id = item.get("custom_id")
+        if not isinstance(custom_id, str) or not custom_id:
+            raise HTTPException(status_code=400, detail=f"第 {number} 行缺少 custom_id")
+        if custom_id in seen:
+            raise HTTPException(status_code=400, detail=f"第 {number} 行的 custom_id 重复")
+        seen.add(custom_id)
+        if item.get("method", "POST").upper() != "POST":
+            raise HTTPException(status_code=400, detail=f"第 {number} 行的 method 必须是 POST")
+        if item.get("url") not in BATCH_URLS:
+            raise HTTPException(status_code=400, detail=f"第 {number} 行的 url 不支持，可用: {', '.join(BATCH_URLS)}")
+        body = item.get("body")
+        if not isinstance(body, dict) or not body.get("model"):
+            raise HTTPException(status_code=400, detail=f"第 {number} 行的 body 缺少 model")
+        requests.append({"custom_id": custom_id, "url": item["url"], "body": body})
+        if len(requests) > config.BATCH_MAX_REQUESTS:
+            raise HTTPException(status_code=400, detail=f"单个批量任务最多 {config.BATCH_MAX_REQUESTS} 个请求")
+    if not requests:
+        raise HTTPException(status_code=400, detail="文件中没有请求")
+    return requests
+
+
+def create(raw: bytes, client=None, free_token: bool = False) -> BatchJob:
+    """校验并保存请求文件，创建排队中的任务"""
+    requests = parse(raw)
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    job_id = f"batch_{uuid.uuid4().hex}"
+    client_hash = client.token_hash if client is not None else ""
+    job = BatchJob((job_id, "queued", client_hash, free_token, len(requests), 0, 0, time.time(), None, None, None))
+    with open(job.input_file, "w", encoding="utf-8") as f:
+        for request in requests:
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+    db.insert_batch_job(job_id, client_hash, free_token, len(requests))
+    _jobs[job_id] = job
+    if _wakeup is not None:
+        _wakeup.set()
+    return job
+
+
+def get(job_id: str, client=None):
+    """获取任务，只能看到同一个客户端token创建的任务"""
+    job = _jobs.get(job_id)
+    client_hash = client.token_hash if client is not None else ""
+    if job is None or job.client_hash != client_hash:
+        return None
+    return job
+
+
+def list_jobs(client=None) -> list:
+    client_hash = client.token_hash if client is not None else ""
+    jobs = [job for job in _jobs.values() if job.client_hash == client_hash]
+    return sorted(jobs, key=lambda job: job.created_at, reverse=True)
+
+
+def cancel(job: BatchJob):
+    """取消任务：排队中的立即取消，进行中的等已发出的请求完成后取消"""
+    if job.status == "queued":
+        job.status = "cancelled"
+        job.finished_at = time.time()
+        job.save()
+    elif job.status == "in_progress":
+        job.status = "cancelling"
+        job.save()
+
+
+def output_size(job: BatchJob) -> int:
+    try:
+        return os.path.getsize(job.output_file)
+    except OSError:
+        return 0
+
+
+def _read_done(job: BatchJob) -> set:
+    """从结果文件恢复已完成的请求及计数，用于重启后继续处理"""
+    done = set()
+    job.completed = job.failed = 0
+    if not os.path.exists(job.output_file):
+        return done
+    with open(job.output_file, "rb+") as f:
+        valid_size = 0
+        for line in f:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError
+                result = json.loads(line)
+            except ValueError:
+                # 进程退出时写了一半的行
+                break
+            valid_size += len(line)
+            done.add(result["custom_id"])
+            if result.get("error") is None and result["response"]["status_code"] == 200:
+                job.completed += 1
+            else:
+                job.failed += 1
+        f.truncate(valid_size)
+    return done
+
+
+async def _send(job: BatchJob, request: dict, client):
+    """发送一个请求，返回写入结果文件的记录"""
+    # 复用 routers.generate 的转发逻辑，按需导入，本模块不在导入时依赖 routers 包
+    from routers import generate
+
+    status = data = error = None
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            status, data = await generate.forward_offline(request["url"], request["body"], job.free_token, client)
+        except HTTPException as e:
+            if e.status_code == 429:
+                # 客户端token的配额用尽，等到窗口滚动后继续，不计入尝试次数
+                attempt -= 1
+                retry_after = (e.headers or {}).get("Retry-After")
+                await asyncio.sleep(float(retry_after) if retry_after else 1)
+                continue
+            if e.status_code >= 500 and attempt < MAX_ATTEMPTS:
+                await asyncio.sleep(attempt)
+                continue
+            status, data, error = None, None, {"code": e.status_code, "message": e.detail}
+        except Exception as e:
+            if attempt < MAX_ATTEMPTS:
+                await asyncio.sleep(attempt)
+                continue
+            error = {"code": "request_failed", "message": f"请求失败: {str(e)}"}
+        else:
+            if (status == 429 or status >= 500) and attempt < MAX_ATTEMPTS:
+                await asyncio.sleep(attempt)
+                continue
+        break
+    return {
+        "id": f"{job.id}_{request['custom_id']}",
+        "custom_id": request["custom_id"],
+        "response": {"status_code": status, "body": data} if error is None else None,
+        "error": error,
+    }
+
+
+async def _process(job: BatchJob, stop_event: asyncio.Event):
+    """用最多 batch_concurrency 个并发请求处理任务，结果逐行追加到结果文件"""
+    client = None
+    if job.client_hash:
+        client = client_tokens.get(job.client_hash)
+        if client is None:
+            job.status, job.error, job.finished_at = "failed", "创建任务的客户端token已被删除", time.time()
+            job.save()
+            return
+
+    with open(job.input_file, "r", encoding="utf-8") as f:
+        requests = [json.loads(line) for line in f if line.strip()]
+    done = _read_done(job)
+    remaining = iter([request for request in requests if request["custom_id"] not in done])
+    if job.status == "queued":
+        job.status = "in_progress"
+        job.started_at = time.time()
+    job.save()
+    logger.info(f"开始处理批量任务 {job.id}，共 {job.total} 个请求，已完成 {len(done)} 个")
+
+    with open(job.output_file, "a", encoding="utf-8") as out:
+
+        async def worker():
+            # 多个 worker 共用一个迭代器，每个 worker 同时只处理一个请求
+            for request in remaining:
+                if job.status == "cancelling":
+                    return
+                result = await _send(job, request, client)
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+                if result["error"] is None and result["response"]["status_code"] == 200:
+                    job.completed += 1
+                else:
+                    job.failed += 1
+                if (job.completed + job.failed) % PROGRESS_EVERY == 0:
+                    job.save()
+
+        workers = asyncio.gather(*(worker() for _ in range(max(1, config.BATCH_CONCURRENCY))))
+        stopper = asyncio.ensure_future(stop_event.wait())
+        await asyncio.wait({workers, stopper}, return_when=asyncio.FIRST_COMPLETED)
+        stopper.cancel()
+        if not workers.done():
+            # 服务停止：中止进行中的请求，重启后从结果文件继续
+            workers.cancel()
+            try:
+                await workers
+            except asyncio.CancelledError:
+                pass
+            job.save()
+            return
+        workers.result()
+
+    job.status = "cancelled" if job.status == "cancelling" else "completed"
+    job.finished_at = time.time()
+    job.save()
+    logger.info(f"批量任务 {job.id} 已结束: 成功 {job.completed} 个，失败 {job.failed} 个")
+
+
+def _next_job():
+    active = [job for job in _jobs.values() if job.status in ACTIVE_STATUSES]
+    # 重启前进行中的任务优先
+    active.sort(key=lambda job: (job.status == "queued", job.created_at))
+    return active[0] if active else None
+
+
+async def run(stop_event: asyncio.Event):
+    """后台按创建顺序依次处理批量任务"""
+    global _wakeup
+    _wakeup = asyncio.Event()
+    while not stop_event.is_set():
+        job = _next_job()
+        if job is None:
+            _wakeup.clear()
+            waiter = asyncio.ensure_future(_wakeup.wait())
+            stopper = asyncio.ensure_future(stop_event.wait())
+            await asyncio.wait({waiter, stopper}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            stopper.cancel()
+            continue
+        try:
+            await _process(job, stop_event)
+        except Exception as e:
+            logger.error(f"批量任务 {job.id} 处理失败: {str(e)}")
+            job.status, job.error, job.finished_at = "failed", str(e), time.time()
+            job.save()
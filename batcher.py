@@ -0,0 +1,168 @@
+import asyncio
+import json
+import time
+import config
+import metrics
+from utils import check_and_remove_key
+
+# embeddings 的微批处理：同一模型、同样参数、同一key子池的小请求在 embedding_batch_max_wait_ms 内
+# 合并成一次上游调用（最多 embedding_batch_max_size 条输入），再把结果按各请求拆分返回。
+
+# 正在收集的批次: 分组 -> _Batch
+_batches = {}
+# 正在发送的批次及其后台余额检查，保留引用避免任务被回收
+_sending = set()
+
+
+class _Stats:
+    __slots__ = ("batches", "requests", "inputs", "wait")
+
+    def __init__(self):
+        self.batches = 0
+        self.requests = 0
+        self.inputs = 0
+        self.wait = 0.0
+
+
+_stats = _Stats()
+
+
+class _Batch:
+    __slots__ = ("params", "key", "send", "items", "size", "timer")
+
+    def __init__(self, params: dict, key: str, send):
+        self.params = params
+        self.key = key
+        self.send = send
+        # [(输入列表, future, 加入时间), ...]
+        self.items = []
+        self.size = 0
+        self.timer = None
+
+
+def batchable(req_json: dict) -> bool:
+    """是否可以合并：开启了微批处理，input 为字符串或不超过批次上限的字符串列表"""
+    if not config.EMBEDDING_BATCHING:
+        return False
+    inputs = req_json.get("input")
+    if isinstance(inputs, str):
+        return True
+    return (
+        isinstance(inputs, list)
+        and 0 < len(inputs) < config.EMBEDDING_BATCH_MAX_SIZE
+        and all(isinstance(item, str) for item in inputs)
+    )
+
+
+async def submit(pool_key, req_json: dict, key: str, send):
+    """把请求加入批次，等待批次返回后得到该请求自己的结果
+
+    Args:
+        pool_key: key子池的标识，只有来自同一子池的请求才会合并
+        req_json: 客户端的请求
+        key: 为该请求选择的key，批次使用第一个请求的key
+        send: send(key, 请求体) 返回 (key, 状态码, 响应) 的协程函数
+
+    Returns:
+        (key, 状态码, 该请求的响应)
+    """
+    inputs = req_json["input"]
+    inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+    params = {k: v for k, v in req_json.items() if k != "input"}
+    group = (pool_key, json.dumps(params, sort_keys=True))
+
+    batch = _batches.get(group)
+    if batch is not None and batch.size + len(inputs) > config.EMBEDDING_BATCH_MAX_SIZE:
+        _flush(group, batch)
+        batch = None
+    loop = asyncio.get_running_loop()
+    if batch is None:
+        batch = _batches[group] = _Batch(params, key, send)
+        batch.timer = loop.call_later(config.EMBEDDING_BATCH_MAX_WAIT_MS / 1000, _flush, group, batch)
+    future = loop.create_future()
+    batch.items.append((inputs, future, time.monotonic()))
+    batch.size += len(inputs)
+    if batch.size >= config.EMBEDDING_BATCH_MAX_SIZE:
+        _flush(group, batch)
+    return await future
+
+
+def _spawn(coro):
+    task = asyncio.ensure_future(coro)
+    _sending.add(task)
+    task.add_done_callback(_sending.discard)
+
+
+def _flush(group, batch: _Batch):
+    if _batches.get(group) is not batch:
+        return
+    del _batches[group]
+    batch.timer.cancel()
+    _spawn(_send(batch))
+
+
+async def _send(batch: _Batch):
+    now = time.monotonic()
+    _stats.batches += 1
+    _stats.requests += len(batch.items)
+    _stats.inputs += batch.size
+    _stats.wait += sum(now - added for _, _, added in batch.items)
+    metrics.inc("embedding_batches")
+    metrics.inc("embedding_batched_requests", len(batch.items))
+
+    inputs = [text for item_inputs, _, _ in batch.items for text in item_inputs]
+    body = json.dumps({**batch.params, "input": inputs}).encode()
+    try:
+        key, status, data = await batch.send(batch.key, body)
+    except Exception as e:
+        for _, future, _ in batch.items:
+            if not future.done():
+                future.set_exception(e)
+        return
+    # 每次上游调用只检查一次实际使用的key的余额，而不是批次中每个请求各检查一次
+    _spawn(check_and_remove_key(key))
+
+    if status != 200 or not isinstance(data, dict):
+        for _, future, _ in batch.items:
+            if not future.done():
+                future.set_result((key, status, data))
+        return
+
+    # 上游只返回整个批次的用量，按各请求输入的字符数分摊，最后一个请求取余数使总数不变
+    usage = data.get("usage") or {}
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    total_chars = sum(len(text) for text in inputs) or 1
+    remaining = prompt_tokens
+    offset = 0
+    for i, (item_inputs, future, _) in enumerate(batch.items):
+        count = len(item_inputs)
+        if i == len(batch.items) - 1:
+            share = remaining
+        else:
+            share = round(prompt_tokens * sum(len(text) for text in item_inputs) / total_chars)
+            remaining -= share
+        part = {
+            **data,
+            "data": [
+                {**entry, "index": entry.get("index", 0) - offset}
+                for entry in data.get("data", [])
+                if offset <= entry.get("index", 0) < offset + count
+            ],
+            "usage": {"prompt_tokens": share, "total_tokens": share},
+        }
+        offset += count
+        if not future.done():
+            future.set_result((key, status, part))
+
+
+def snapshot() -> dict:
+    batches = _stats.batches
+    return {
+        "enabled": config.EMBEDDING_BATCHING,
+        "batches": batches,
+        "requests": _stats.requests,
+        "avg_batch_requests": round(_stats.requests / batches, 2) if batches else 0,
+        "avg_batch_inputs": round(_stats.inputs / batches, 2) if batches else 0,
+        "avg_wait_ms": round(_stats.wait * 1000 / _stats.requests, 2) if _stats.requests else 0,
+        "upstream_calls_saved": _stats.requests - batches,
+    }
@@ -12,6 +12,9 @@ if %ERRORLEVEL% neq 0 (
 :: Create build directory if it doesn't exist
 if not exist "build" mkdir build
 
+:: Vendor, fingerprint and precompress static assets
+uv run python build_assets.py
+
 :: Run Nuitka through UV to compile main.py
 uv run python -m nuitka ^
     --include-module=fastapi ^
@@ -20,6 +23,7 @@ uv run python -m nuitka ^
     --include-data-dir=.\static=static ^
     --output-dir=build ^
     --standalone ^
+    --python-flag=no_site ^
     --windows-icon-from-ico=./static/favicon.ico ^
     main.py
 
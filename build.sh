@@ -13,6 +13,9 @@ if [ ! -d "build" ]; then
     mkdir build
 fi
 
+# Vendor, fingerprint and precompress static assets
+uv run python build_assets.py
+
 # Run Nuitka through UV to compile main.py
 uv run python -m nuitka \
     --include-module=fastapi \
@@ -21,6 +24,7 @@ uv run python -m nuitka \
     --include-data-dir=./static=static \
     --output-dir=build \
     --standalone \
+    --python-flag=no_site \
     main.py
 
 echo "Build completed. Check the build directory for the output."
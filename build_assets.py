@@ -0,0 +1,101 @@
+"""构建静态资源
+
+1. 下载第三方库（Chart.js）到 static/vendor，离线环境也能显示图表
+2. 为 CSS/JS 生成带内容哈希的文件名，输出到 static/dist，可以永久缓存
+3. 预先生成 gzip（以及安装了 brotli 时的 br）压缩版本
+4. 写入 static/dist/manifest.json，服务端据此改写 HTML 中的资源地址
+
+用法: python build_assets.py [--offline]
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sys
+import urllib.request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = "static"
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+VENDOR_DIR = os.path.join(STATIC_DIR, "vendor")
+
+# 需要本地化的第三方库: 本地路径(相对 static) -> 下载地址
+VENDOR_ASSETS = {
+    "vendor/chart.umd.min.js": "https://cdn.jsdelivr.net/npm/chart.js@4.4.1/dist/chart.umd.min.js",
+}
+
+# 需要生成哈希文件名的资源（相对 static）
+ASSETS = ["style.css", "script.js", "navbar.js", *VENDOR_ASSETS]
+
+
+def vendor(offline: bool):
+    os.makedirs(VENDOR_DIR, exist_ok=True)
+    for name, url in VENDOR_ASSETS.items():
+        path = os.path.join(STATIC_DIR, name)
+        if os.path.exists(path):
+            continue
+        if offline:
+            print(f"跳过下载 {name}（离线模式），页面将回退到 CDN")
+            continue
+        print(f"下载 {url}")
+        try:
+            with urllib.request.urlopen(url, timeout=30) as resp:
+                data = resp.read()
+        except Exception as e:
+            print(f"下载 {name} 失败: {e}，页面将回退到 CDN")
+            continue
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+def fingerprint(name: str, data: bytes) -> str:
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    base, ext = os.path.splitext(name)
+    return f"dist/{base}.{digest}{ext}"
+
+
+def build(offline: bool = False):
+    vendor(offline)
+
+    # 清理旧的构建结果
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    os.makedirs(DIST_DIR)
+
+    manifest = {}
+    for name in ASSETS:
+        source = os.path.join(STATIC_DIR, name)
+        if not os.path.exists(source):
+            continue
+        with open(source, "rb") as f:
+            data = f.read()
+
+        hashed = fingerprint(name, data)
+        target = os.path.join(STATIC_DIR, hashed)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as f:
+            f.write(data)
+        # mtime 固定为 0，保证相同内容的构建结果完全一致
+        with open(target + ".gz", "wb") as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(target + ".br", "wb") as f:
+                f.write(brotli.compress(data, quality=11))
+
+        manifest[name] = hashed
+        print(f"{name} -> {hashed}")
+
+    with open(os.path.join(DIST_DIR, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    if brotli is None:
+        print("未安装 brotli，仅生成 gzip 压缩版本")
+
+
+if __name__ == "__main__":
+    build(offline="--offline" in sys.argv)
@@ -0,0 +1,233 @@
+import asyncio
+import hashlib
+import json
+import logging
+import secrets
+import time
+import db
+
+# 配额统计窗口(秒)
+WINDOW = 60
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class RateWindow:
+    """滑动窗口计数器：用当前和上一个固定窗口按时间加权近似，O(1) 内存"""
+
+    __slots__ = ("window_start", "current", "previous")
+
+    def __init__(self):
+        self.window_start = 0.0
+        self.current = 0
+        self.previous = 0
+
+    def _roll(self, now: float):
+        elapsed = now - self.window_start
+        if elapsed >= WINDOW:
+            self.previous = self.current if elapsed < 2 * WINDOW else 0
+            self.current = 0
+            self.window_start = now - (elapsed % WINDOW)
+
+    def value(self, now: float) -> float:
+        self._roll(now)
+        weight = 1 - (now - self.window_start) / WINDOW
+        return self.previous * weight + self.current
+
+    def add(self, amount: int, now: float):
+        self._roll(now)
+        self.current += amount
+
+    def retry_after(self, now: float) -> int:
+        return max(1, int(WINDOW - (now - self.window_start)) + 1)
+
+
+class ClientToken:
+    """客户端token在内存中的配置与用量"""
+
+    def __init__(self, row):
+        (
+            self.token_hash,
+            self.token_prefix,
+            self.name,
+            self.rpm,
+            self.tpm,
+            allowed_models,
+            self.key_tag,
+            self.priority,
+            enabled,
+            self.created_at,
+            self.last_used,
+            self.total_requests,
+            self.total_input_tokens,
+            self.total_output_tokens,
+        ) = row
+        self.allowed_models = set(json.loads(allowed_models or "[]"))
+        self.enabled = bool(enabled)
+        self.key_tag = self.key_tag or ""
+        self.requests = RateWindow()
+        self.tokens = RateWindow()
+        # 尚未写入数据库的用量
+        self.pending_requests = 0
+        self.pending_input = 0
+        self.pending_output = 0
+
+    def to_dict(self):
+        return {
+            "token_hash": self.token_hash,
+            "token_prefix": self.token_prefix,
+            "name": self.name,
+            "rpm": self.rpm,
+            "tpm": self.tpm,
+            "allowed_models": sorted(self.allowed_models),
+            "key_tag": self.key_tag,
+            "priority": self.priority,
+            "enabled": self.enabled,
+            "created_at": self.created_at,
+            "last_used": self.last_used,
+            "total_requests": self.total_requests + self.pending_requests,
+            "total_input_tokens": self.total_input_tokens + self.pending_input,
+            "total_output_tokens": self.total_output_tokens + self.pending_output,
+        }
+
+
+# token_hash -> ClientToken
+_tokens = {}
+
+
+def load():
+    """从数据库加载客户端token"""
+    pending = {h: t for h, t in _tokens.items()}
+    _tokens.clear()
+    for row in db.get_client_tokens():
+        token = ClientToken(row)
+        old = pending.get(token.token_hash)
+        if old is not None:
+            # 保留内存中的配额窗口和未写入的用量
+            token.requests, token.tokens = old.requests, old.tokens
+            token.pending_requests = old.pending_requests
+            token.pending_input = old.pending_input
+            token.pending_output = old.pending_output
+        _tokens[token.token_hash] = token
+
+
+def lookup(authorization: str):
+    """根据 Authorization 请求头查找客户端token，不存在时返回 None"""
+    if not authorization or not _tokens:
+        return None
+    token = authorization[7:] if authorization.startswith("Bearer ") else authorization
+    return _tokens.get(hash_token(token))
+
+
+def get(token_hash: str):
+    """根据哈希值查找客户端token，不存在时返回 None"""
+    return _tokens.get(token_hash)
+
+
+def check_quota(client: ClientToken, model: str):
+    """检查模型权限和 RPM/TPM 配额
+
+    Returns:
+        None 表示通过，否则返回 (状态码, 错误信息, Retry-After)
+    """
+    if not client.enabled:
+        return 403, "该 token 已被禁用", None
+    if client.allowed_models and model not in client.allowed_models:
+        return 403, f"该 token 无权调用模型 {model}", None
+    now = time.time()
+    if client.rpm and client.requests.value(now) + 1 > client.rpm:
+        return 429, "超出每分钟请求数限制", client.requests.retry_after(now)
+    if client.tpm and client.tokens.value(now) >= client.tpm:
+        return 429, "超出每分钟 token 数限制", client.tokens.retry_after(now)
+    client.requests.add(1, now)
+    return None
+
+
+def record_usage(client: ClientToken, input_tokens: int, output_tokens: int):
+    """记录一次调用的用量，先累加在内存中，由 flush 批量写入数据库"""
+    if client is None:
+        return
+    now = time.time()
+    client.tokens.add((input_tokens or 0) + (output_tokens or 0), now)
+    client.pending_requests += 1
+    client.pending_input += input_tokens or 0
+    client.pending_output += output_tokens or 0
+    client.last_used = now
+
+
+def flush():
+    """将内存中累加的用量批量写入数据库"""
+    rows = []
+    for client in _tokens.values():
+        if not client.pending_requests:
+            continue
+        rows.append(
+            (
+                client.pending_requests,
+                client.pending_input,
+                client.pending_output,
+                client.last_used,
+                client.token_hash,
+            )
+        )
+        client.total_requests += client.pending_requests
+        client.total_input_tokens += client.pending_input
+        client.total_output_tokens += client.pending_output
+        client.pending_requests = client.pending_input = client.pending_output = 0
+    if rows:
+        db.add_client_token_usage(rows)
+
+
+async def flush_loop(stop_event: asyncio.Event, interval: float = 5):
+    """后台定期写入用量，停止时再写入一次"""
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            flush()
+        except Exception as e:
+            logging.getLogger(__name__).error(f"写入客户端token用量失败: {str(e)}")
+
+
+def list_tokens():
+    return [client.to_dict() for client in _tokens.values()]
+
+
+def create_token(name, rpm=0, tpm=0, allowed_models=None, key_tag="", priority="normal"):
+    """创建客户端token，返回明文token（只在创建时返回一次）"""
+    token = "sp-" + secrets.token_urlsafe(32)
+    db.insert_client_token(
+        hash_token(token),
+        token[:10],
+        name,
+        rpm,
+        tpm,
+        json.dumps(allowed_models or []),
+        key_tag,
+        priority,
+    )
+    load()
+    return token
+
+
+def update_token(token_hash, name, rpm, tpm, allowed_models, key_tag, priority, enabled):
+    db.update_client_token(
+        token_hash,
+        name,
+        rpm,
+        tpm,
+        json.dumps(allowed_models or []),
+        key_tag,
+        priority,
+        enabled,
+    )
+    load()
+
+
+def delete_token(token_hash):
+    _tokens.pop(token_hash, None)
+    db.delete_client_token(token_hash)
@@ -3,41 +3,188 @@ import os
 
 
 CONFIG_FILE = "config.json"
+# API基础URL
+BASE_URL = "https://api.siliconflow.cn"
 DEFAULT_CONFIG = {
-    "call_strategy": "random",  # random, high, low, least_used, most_used, oldest, newest
+    "call_strategy": "random",  # random, high, low, least_used, most_used, oldest, newest, weighted, least_inflight, p2c, swrr
     "custom_api_key": "",  # 空字符串表示不使用自定义api_key
     "free_model_api_key": "",  # 空字符串表示不使用特殊token来调用免费模型的api_key
     "admin_username": "admin",  # 默认管理员用户名
     "admin_password": "admin",  # 默认管理员密码
+    "free_model_routing": True,  # 免费模型的请求自动使用余额为0的key
+    "free_models": [],  # 手动维护的免费模型列表，作为内置列表的补充
+    "free_models_refresh_interval": 60,  # 单位: 分钟，免费模型列表的后台刷新间隔
+    "circuit_failure_threshold": 3,  # 连续失败多少次后熔断隔离key
+    "circuit_cooldown": 30,  # 单位: 秒，首次熔断的隔离时长，连续熔断时翻倍
+    "circuit_max_cooldown": 600,  # 单位: 秒，隔离时长上限
+    "admission_max_concurrency": 0,  # 上游最大并发数，0表示按可用key数量自动计算
+    "admission_per_key_concurrency": 4,  # 自动计算并发上限时每个key允许的并发数
+    "admission_queue_size": 1000,  # 并发已满时最多排队的请求数
+    "admission_max_wait": 30,  # 单位: 秒，排队的最长等待时间，超时返回429
+    "admission_token_priorities": {},  # 客户端token -> 优先级(high/normal/low)
+    "stream_flush_policy": "immediate",  # 流式转发策略: immediate(逐事件发送) 或 coalesce(合并小事件)
+    "stream_buffer_events": 64,  # 每个流在上游与客户端之间最多缓冲的事件数
+    "stream_coalesce_bytes": 16384,  # coalesce 模式下单次合并发送的最大字节数
+    "stream_coalesce_ms": 20,  # 单位: 毫秒，coalesce 模式下等待合并的最长时间
+    "stream_include_usage": True,  # 流式请求自动加上 stream_options.include_usage，确保能统计用量
+    "usage_estimation": True,  # 上游没有返回 usage 时按生成的文本估算 token 数
+    "traffic_recording": False,  # 是否记录 /v1 请求用于回放压测
+    "traffic_record_bodies": "redacted",  # 请求体记录方式: none(不记录) / redacted(文本脱敏) / full(完整)
+    "traffic_record_file": "traffic.jsonl.gz",  # 流量记录文件
+    "upstreams": [],  # BASE_URL 以外的上游，如 [{"name": "intl", "base_url": "https://api.siliconflow.com", "models": []}]，models 为空表示按上游的模型列表
+    "upstream_probe_interval": 60,  # 单位: 秒，上游健康检查的间隔
+    "upstream_failure_threshold": 3,  # 健康检查连续失败多少次后不再向该上游路由请求
+    "hedging_enabled": False,  # embeddings/rerank 超过近期 p95 延迟未返回时，用另一个key再发一次，取先返回的结果
+    "hedging_max_ratio": 0.05,  # 对冲请求最多占这些请求的比例，限制额外的上游负载
+    "hedging_min_delay_ms": 50,  # 发出对冲请求前至少等待的时间
+    "fanout_embedding_chunk_size": 32,  # embeddings 的 input 超过该数量时拆分后并发发送到多个key，0 表示不拆分
+    "fanout_rerank_chunk_size": 100,  # rerank 的 documents 超过该数量时拆分后并发发送到多个key，0 表示不拆分
+    "fanout_concurrency": 8,  # 单个请求拆分后最多同时发送的分块数
+    "embedding_batching": False,  # 同一模型的小 embeddings 请求在短时间内合并成一次上游调用
+    "embedding_batch_max_size": 32,  # 一个批次最多合并的输入条数
+    "embedding_batch_max_wait_ms": 10,  # 第一个请求最多等待多久后发送批次
+    "batch_concurrency": 16,  # 批量任务同时转发的最大请求数
+    "batch_max_requests": 50000,  # 单个批量任务最多包含的请求数
+    "upstream_backend": "aiohttp",  # 上游连接实现: aiohttp (HTTP/1.1) / httpx_h2 (HTTP/2 多路复用，需安装 httpx[http2])
+    "upstream_h2_connections": 4,  # HTTP/2 模式下到每个上游地址的最大连接数，每个连接可承载多个并发请求
+    "runtime_profile": "default",  # 运行模式: default / compat / performance，见 runtime.py
+    "server_options": {},  # 覆盖运行模式中的 uvicorn 参数，如 {"backlog": 2048}
+    "loop_block_threshold_ms": 100,  # 事件循环被阻塞超过该时长时记录调用栈
+    "drain_timeout": 120,  # 单位: 秒，停止服务时等待进行中请求完成的最长时间
+    "pool_reconcile_interval": 300,  # 单位: 秒，用数据库校正内存密钥池汇总计数的间隔
+    "invalid_key_cache_ttl": 30,  # 单位: 天，已确认失效的key在该时间内再次导入时直接拒绝，0 表示不缓存
 }
 
+# 只读取配置文件，不存在时由 ensure_config_file 在启动时写入默认配置
 if os.path.exists(CONFIG_FILE):
     try:
         with open(CONFIG_FILE, "r", encoding="utf-8") as f:
             config = json.load(f)
     except Exception:
-        config = DEFAULT_CONFIG
-        with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-            json.dump(config, f, ensure_ascii=False, indent=2)
+        config = dict(DEFAULT_CONFIG)
 else:
-    config = DEFAULT_CONFIG
-    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-        json.dump(config, f, ensure_ascii=False, indent=2)
+    config = dict(DEFAULT_CONFIG)
 
 CALL_STRATEGY = config.get("call_strategy", DEFAULT_CONFIG["call_strategy"])
 CUSTOM_API_KEY = config.get("custom_api_key", DEFAULT_CONFIG["custom_api_key"])
 FREE_MODEL_API_KEY = config.get("free_model_api_key", DEFAULT_CONFIG["free_model_api_key"])
 ADMIN_USERNAME = config.get("admin_username", DEFAULT_CONFIG["admin_username"])
 ADMIN_PASSWORD = config.get("admin_password", DEFAULT_CONFIG["admin_password"])
+FREE_MODEL_ROUTING = config.get("free_model_routing", DEFAULT_CONFIG["free_model_routing"])
+FREE_MODELS = config.get("free_models", DEFAULT_CONFIG["free_models"])
+FREE_MODELS_REFRESH_INTERVAL = config.get(
+    "free_models_refresh_interval", DEFAULT_CONFIG["free_models_refresh_interval"]
+)
+CIRCUIT_FAILURE_THRESHOLD = config.get(
+    "circuit_failure_threshold", DEFAULT_CONFIG["circuit_failure_threshold"]
+)
+CIRCUIT_COOLDOWN = config.get("circuit_cooldown", DEFAULT_CONFIG["circuit_cooldown"])
+CIRCUIT_MAX_COOLDOWN = config.get(
+    "circuit_max_cooldown", DEFAULT_CONFIG["circuit_max_cooldown"]
+)
+ADMISSION_MAX_CONCURRENCY = config.get(
+    "admission_max_concurrency", DEFAULT_CONFIG["admission_max_concurrency"]
+)
+ADMISSION_PER_KEY_CONCURRENCY = config.get(
+    "admission_per_key_concurrency", DEFAULT_CONFIG["admission_per_key_concurrency"]
+)
+ADMISSION_QUEUE_SIZE = config.get(
+    "admission_queue_size", DEFAULT_CONFIG["admission_queue_size"]
+)
+ADMISSION_MAX_WAIT = config.get("admission_max_wait", DEFAULT_CONFIG["admission_max_wait"])
+ADMISSION_TOKEN_PRIORITIES = config.get(
+    "admission_token_priorities", DEFAULT_CONFIG["admission_token_priorities"]
+)
+STREAM_FLUSH_POLICY = config.get(
+    "stream_flush_policy", DEFAULT_CONFIG["stream_flush_policy"]
+)
+STREAM_BUFFER_EVENTS = config.get(
+    "stream_buffer_events", DEFAULT_CONFIG["stream_buffer_events"]
+)
+STREAM_COALESCE_BYTES = config.get(
+    "stream_coalesce_bytes", DEFAULT_CONFIG["stream_coalesce_bytes"]
+)
+STREAM_COALESCE_MS = config.get("stream_coalesce_ms", DEFAULT_CONFIG["stream_coalesce_ms"])
+STREAM_INCLUDE_USAGE = config.get(
+    "stream_include_usage", DEFAULT_CONFIG["stream_include_usage"]
+)
+USAGE_ESTIMATION = config.get("usage_estimation", DEFAULT_CONFIG["usage_estimation"])
+TRAFFIC_RECORDING = config.get("traffic_recording", DEFAULT_CONFIG["traffic_recording"])
+TRAFFIC_RECORD_BODIES = config.get(
+    "traffic_record_bodies", DEFAULT_CONFIG["traffic_record_bodies"]
+)
+TRAFFIC_RECORD_FILE = config.get(
+    "traffic_record_file", DEFAULT_CONFIG["traffic_record_file"]
+)
+UPSTREAMS = config.get("upstreams", DEFAULT_CONFIG["upstreams"])
+UPSTREAM_PROBE_INTERVAL = config.get(
+    "upstream_probe_interval", DEFAULT_CONFIG["upstream_probe_interval"]
+)
+UPSTREAM_FAILURE_THRESHOLD = config.get(
+    "upstream_failure_threshold", DEFAULT_CONFIG["upstream_failure_threshold"]
+)
+HEDGING_ENABLED = config.get("hedging_enabled", DEFAULT_CONFIG["hedging_enabled"])
+HEDGING_MAX_RATIO = config.get("hedging_max_ratio", DEFAULT_CONFIG["hedging_max_ratio"])
+HEDGING_MIN_DELAY_MS = config.get(
+    "hedging_min_delay_ms", DEFAULT_CONFIG["hedging_min_delay_ms"]
+)
+FANOUT_EMBEDDING_CHUNK_SIZE = config.get(
+    "fanout_embedding_chunk_size", DEFAULT_CONFIG["fanout_embedding_chunk_size"]
+)
+FANOUT_RERANK_CHUNK_SIZE = config.get(
+    "fanout_rerank_chunk_size", DEFAULT_CONFIG["fanout_rerank_chunk_size"]
+)
+FANOUT_CONCURRENCY = config.get("fanout_concurrency", DEFAULT_CONFIG["fanout_concurrency"])
+EMBEDDING_BATCHING = config.get("embedding_batching", DEFAULT_CONFIG["embedding_batching"])
+EMBEDDING_BATCH_MAX_SIZE = config.get(
+    "embedding_batch_max_size", DEFAULT_CONFIG["embedding_batch_max_size"]
+)
+EMBEDDING_BATCH_MAX_WAIT_MS = config.get(
+    "embedding_batch_max_wait_ms", DEFAULT_CONFIG["embedding_batch_max_wait_ms"]
+)
+BATCH_CONCURRENCY = config.get("batch_concurrency", DEFAULT_CONFIG["batch_concurrency"])
+BATCH_MAX_REQUESTS = config.get("batch_max_requests", DEFAULT_CONFIG["batch_max_requests"])
+UPSTREAM_BACKEND = config.get("upstream_backend", DEFAULT_CONFIG["upstream_backend"])
+UPSTREAM_H2_CONNECTIONS = config.get(
+    "upstream_h2_connections", DEFAULT_CONFIG["upstream_h2_connections"]
+)
+RUNTIME_PROFILE = config.get("runtime_profile", DEFAULT_CONFIG["runtime_profile"])
+SERVER_OPTIONS = config.get("server_options", DEFAULT_CONFIG["server_options"])
+LOOP_BLOCK_THRESHOLD_MS = config.get(
+    "loop_block_threshold_ms", DEFAULT_CONFIG["loop_block_threshold_ms"]
+)
+DRAIN_TIMEOUT = config.get("drain_timeout", DEFAULT_CONFIG["drain_timeout"])
+POOL_RECONCILE_INTERVAL = config.get(
+    "pool_reconcile_interval", DEFAULT_CONFIG["pool_reconcile_interval"]
+)
+INVALID_KEY_CACHE_TTL = config.get(
+    "invalid_key_cache_ttl", DEFAULT_CONFIG["invalid_key_cache_ttl"]
+)
+
+
+def ensure_config_file():
+    """配置文件不存在或无法解析时写入当前配置"""
+    try:
+        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+            json.load(f)
+        return
+    except Exception:
+        pass
+    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
 
 
 def save_config():
     global CALL_STRATEGY, CUSTOM_API_KEY, FREE_MODEL_API_KEY, ADMIN_USERNAME, ADMIN_PASSWORD
+    global FREE_MODEL_ROUTING, FREE_MODELS, FREE_MODELS_REFRESH_INTERVAL
     config["call_strategy"] = CALL_STRATEGY
     config["custom_api_key"] = CUSTOM_API_KEY
     config["free_model_api_key"] = FREE_MODEL_API_KEY
     config["admin_username"] = ADMIN_USERNAME
     config["admin_password"] = ADMIN_PASSWORD
+    config["free_model_routing"] = FREE_MODEL_ROUTING
+    config["free_models"] = FREE_MODELS
+    config["free_models_refresh_interval"] = FREE_MODELS_REFRESH_INTERVAL
     with open(CONFIG_FILE, "w", encoding="utf-8") as f:
         json.dump(config, f, ensure_ascii=False, indent=2)
 
@@ -1,9 +1,49 @@
 import sqlite3
 import time
+import events
+from key_pool import pool
+
+DB_FILE = "pool.db"
+
+
+class _Lazy:
+    """首次使用时才创建的对象代理，避免导入本模块时就打开数据库"""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+
+    def _get(self):
+        if self._target is None:
+            self._target = self._factory()
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    # 特殊方法不经过 __getattr__ 查找，需要显式转发（with conn:、for row in cursor: 等）
+    def __enter__(self):
+        return self._get().__enter__()
+
+    def __exit__(self, *exc_info):
+        return self._get().__exit__(*exc_info)
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __next__(self):
+        return next(self._get())
+
 
 # 全局数据库连接
-conn = sqlite3.connect("pool.db", check_same_thread=False)
-cursor = conn.cursor()
+conn = _Lazy(lambda: sqlite3.connect(DB_FILE, check_same_thread=False))
+cursor = _Lazy(lambda: conn.cursor())
+
+
+def publish_key(api_key: str):
+    """向管理页面推送单个key的最新状态"""
+    info = pool.key_info(api_key)
+    events.publish("key", info if info is not None else {"key": api_key, "removed": True})
 
 
 def init_db():
@@ -34,6 +74,18 @@ def init_db():
     """)
     conn.commit()
 
+    # 为旧版本数据库补充 status 列，记录调用结果（如客户端中途断开）
+    cursor.execute("PRAGMA table_info(logs)")
+    if "status" not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE logs ADD COLUMN status TEXT DEFAULT 'success'")
+        conn.commit()
+
+    # 补充 usage_estimated 列，标记上游没有返回 usage、由本地估算的token数
+    cursor.execute("PRAGMA table_info(logs)")
+    if "usage_estimated" not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE logs ADD COLUMN usage_estimated INTEGER DEFAULT 0")
+        conn.commit()
+
     # 创建会话表以存储用户会话
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS sessions (
@@ -44,14 +96,253 @@ def init_db():
     """)
     conn.commit()
 
+    # 为旧版本数据库补充 tag 列，用于划分客户端token专用的key子池
+    cursor.execute("PRAGMA table_info(api_keys)")
+    if "tag" not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE api_keys ADD COLUMN tag TEXT DEFAULT ''")
+        conn.commit()
+
+    # 补充 upstream 列，记录key所属的上游，空字符串表示默认上游
+    cursor.execute("PRAGMA table_info(api_keys)")
+    if "upstream" not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE api_keys ADD COLUMN upstream TEXT DEFAULT ''")
+        conn.commit()
+
+    # 为密钥列表的排序字段建立索引，key 作为相同值时的次序，以支持键集分页；
+    # 再按余额筛选条件各建一个部分索引，筛选后排序也能直接走索引
+    for column in ("add_time", "usage_count", "enabled"):
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_api_keys_{column} ON api_keys ({column}, key)"
+        )
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_api_keys_{column}_positive ON api_keys ({column}, key) WHERE balance > 0"
+        )
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_api_keys_{column}_zero ON api_keys ({column}, key) WHERE balance <= 0"
+        )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_api_keys_balance ON api_keys (balance, key)"
+    )
+    conn.commit()
+
+    # 将密钥加载到内存池
+    cursor.execute(
+        "SELECT key, add_time, balance, usage_count, enabled, tag, upstream FROM api_keys"
+    )
+    pool.load(cursor.fetchall())
+
+    # 创建客户端token表，token只保存哈希值
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS client_tokens (
+        token_hash TEXT PRIMARY KEY,
+        token_prefix TEXT,
+        name TEXT,
+        rpm INTEGER DEFAULT 0,
+        tpm INTEGER DEFAULT 0,
+        allowed_models TEXT DEFAULT '[]',
+        key_tag TEXT DEFAULT '',
+        priority TEXT DEFAULT 'normal',
+        enabled INTEGER DEFAULT 1,
+        created_at REAL,
+        last_used REAL,
+        total_requests INTEGER DEFAULT 0,
+        total_input_tokens INTEGER DEFAULT 0,
+        total_output_tokens INTEGER DEFAULT 0
+    )
+    """)
+    conn.commit()
+
+    # 创建批量任务表，请求与结果保存在 batches 目录下的 JSONL 文件中
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS batch_jobs (
+        id TEXT PRIMARY KEY,
+        status TEXT,
+        client_hash TEXT DEFAULT '',
+        free_token INTEGER DEFAULT 0,
+        total INTEGER DEFAULT 0,
+        completed INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        created_at REAL,
+        started_at REAL,
+        finished_at REAL,
+        error TEXT
+    )
+    """)
+    conn.commit()
 
-def insert_api_key(api_key: str, balance: float):
+    # 创建失效key缓存表，只保存key的哈希值，导入时据此跳过已确认失效的key；
+    # 同一个key在不同上游分别记录，空字符串表示默认上游
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS invalid_keys (
+        key_hash TEXT,
+        upstream TEXT DEFAULT '',
+        reason TEXT,
+        created_at REAL,
+        PRIMARY KEY (key_hash, upstream)
+    )
+    """)
+    conn.commit()
+
+    # 创建模型计费表，记录通过调用结果学习到的免费/收费模型
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS model_pricing (
+        model TEXT PRIMARY KEY,
+        is_free INTEGER,
+        source TEXT,
+        updated_at REAL
+    )
+    """)
+    conn.commit()
+
+
+def insert_api_key(api_key: str, balance: float, tag: str = "", upstream: str = ""):
     """向数据库中插入新的API密钥"""
+    add_time = time.time()
+    cursor.execute(
+        "INSERT OR IGNORE INTO api_keys (key, add_time, balance, usage_count, enabled, tag, upstream) VALUES (?, ?, ?, ?, 1, ?, ?)",
+        (api_key, add_time, balance, 0, tag, upstream),
+    )
+    conn.commit()
+    pool.add(api_key, add_time, balance, tag=tag, upstream=upstream)
+    publish_key(api_key)
+
+
+def set_key_tag(api_key: str, tag: str):
+    """设置API密钥所属的子池标签"""
+    cursor.execute("UPDATE api_keys SET tag = ? WHERE key = ?", (tag, api_key))
+    conn.commit()
+    pool.set_tag(api_key, tag)
+    publish_key(api_key)
+
+
+def update_key_balance(api_key: str, balance: float):
+    """更新API密钥余额"""
+    cursor.execute("UPDATE api_keys SET balance = ? WHERE key = ?", (balance, api_key))
+    conn.commit()
+    pool.set_balance(api_key, balance)
+    publish_key(api_key)
+
+
+def delete_api_key(api_key: str):
+    """从数据库中删除API密钥"""
+    cursor.execute("DELETE FROM api_keys WHERE key = ?", (api_key,))
+    conn.commit()
+    pool.remove(api_key)
+    publish_key(api_key)
+
+
+def set_key_enabled(api_key: str, enabled: bool):
+    """启用或禁用API密钥"""
+    cursor.execute(
+        "UPDATE api_keys SET enabled = ? WHERE key = ?", (1 if enabled else 0, api_key)
+    )
+    conn.commit()
+    pool.set_enabled(api_key, enabled)
+    publish_key(api_key)
+
+
+def set_keys_enabled(api_keys, enabled: bool):
+    """在一个事务中批量启用或禁用API密钥"""
+    value = 1 if enabled else 0
+    try:
+        cursor.executemany(
+            "UPDATE api_keys SET enabled = ? WHERE key = ?", ((value, k) for k in api_keys)
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    with pool.batch():
+        for api_key in api_keys:
+            pool.set_enabled(api_key, enabled)
+    events.publish("keys_changed", {"count": len(api_keys)})
+
+
+def set_keys_tag(api_keys, tag: str):
+    """在一个事务中批量设置API密钥的子池标签"""
+    try:
+        cursor.executemany(
+            "UPDATE api_keys SET tag = ? WHERE key = ?", ((tag, k) for k in api_keys)
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    with pool.batch():
+        for api_key in api_keys:
+            pool.set_tag(api_key, tag)
+    events.publish("keys_changed", {"count": len(api_keys)})
+
+
+def set_keys_upstream(api_keys, upstream: str):
+    """在一个事务中批量设置API密钥所属的上游"""
+    try:
+        cursor.executemany(
+            "UPDATE api_keys SET upstream = ? WHERE key = ?", ((upstream, k) for k in api_keys)
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    with pool.batch():
+        for api_key in api_keys:
+            pool.set_upstream(api_key, upstream)
+    events.publish("keys_changed", {"count": len(api_keys)})
+
+
+def apply_key_changes(balances=(), deleted=()):
+    """在一个事务中批量更新余额并删除密钥
+
+    Args:
+        balances: [(key, balance), ...]
+        deleted: [key, ...]
+    """
+    try:
+        cursor.executemany(
+            "UPDATE api_keys SET balance = ? WHERE key = ?",
+            ((balance, k) for k, balance in balances),
+        )
+        cursor.executemany("DELETE FROM api_keys WHERE key = ?", ((k,) for k in deleted))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    with pool.batch():
+        for api_key, balance in balances:
+            pool.set_balance(api_key, balance)
+        for api_key in deleted:
+            pool.remove(api_key)
+    events.publish("keys_changed", {"count": len(balances) + len(deleted)})
+
+
+def increment_key_usage(api_key: str):
+    """增加API密钥的使用计数"""
     cursor.execute(
-        "INSERT OR IGNORE INTO api_keys (key, add_time, balance, usage_count, enabled) VALUES (?, ?, ?, ?, 1)",
-        (api_key, time.time(), balance, 0),
+        "UPDATE api_keys SET usage_count = usage_count + 1 WHERE key = ?", (api_key,)
     )
     conn.commit()
+    pool.incr_usage(api_key)
+
+
+def reconcile_pool():
+    """用数据库校正内存密钥池及其汇总计数，返回被校正的key数量"""
+    local_cursor = conn.cursor()
+    try:
+        local_cursor.execute(
+            "SELECT key, add_time, balance, usage_count, enabled, tag, upstream FROM api_keys"
+        )
+        return pool.sync(local_cursor.fetchall())
+    finally:
+        local_cursor.close()
+
+
+def get_any_enabled_key(upstream: str = ""):
+    """获取指定上游（默认为 BASE_URL）任意一个已启用的API密钥，用于查询上游模型列表等辅助请求"""
+    cursor.execute(
+        "SELECT key FROM api_keys WHERE enabled = 1 AND upstream = ? LIMIT 1", (upstream,)
+    )
+    result = cursor.fetchone()
+    return result[0] if result else None
 
 
 def log_completion(
@@ -62,10 +353,12 @@ def log_completion(
     output_tokens: int,
     total_tokens: int,
     endpoint: str,
+    status: str = "success",
+    usage_estimated: bool = False,
 ):
     """记录API调用日志"""
     cursor.execute(
-        "INSERT INTO logs (used_key, model, call_time, input_tokens, output_tokens, total_tokens, endpoint) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        "INSERT INTO logs (used_key, model, call_time, input_tokens, output_tokens, total_tokens, endpoint, status, usage_estimated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
         (
             used_key,
             model,
@@ -74,9 +367,25 @@ def log_completion(
             output_tokens,
             total_tokens,
             endpoint,
+            status,
+            1 if usage_estimated else 0,
         ),
     )
     conn.commit()
+    events.publish(
+        "log",
+        {
+            "used_key": used_key,
+            "model": model,
+            "call_time": call_time,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": total_tokens,
+            "endpoint": endpoint,
+            "status": status,
+            "usage_estimated": usage_estimated,
+        },
+    )
 
 
 def create_session(token: str, expiry_time: float):
@@ -114,3 +423,174 @@ def cleanup_expired_sessions():
     current_time = time.time()
     cursor.execute("DELETE FROM sessions WHERE expiry_time < ?", (current_time,))
     conn.commit()
+
+
+def get_model_pricing():
+    """获取所有已学习到的模型计费信息"""
+    cursor.execute("SELECT model, is_free, source, updated_at FROM model_pricing")
+    return cursor.fetchall()
+
+
+def save_model_pricing(model: str, is_free: bool, source: str):
+    """保存模型是否免费"""
+    cursor.execute(
+        "INSERT OR REPLACE INTO model_pricing (model, is_free, source, updated_at) VALUES (?, ?, ?, ?)",
+        (model, 1 if is_free else 0, source, time.time()),
+    )
+    conn.commit()
+
+
+def delete_model_pricing_before(timestamp: float):
+    """删除过期的模型计费记录"""
+    cursor.execute("DELETE FROM model_pricing WHERE updated_at < ?", (timestamp,))
+    conn.commit()
+
+
+def get_client_tokens():
+    """获取所有客户端token"""
+    cursor.execute(
+        "SELECT token_hash, token_prefix, name, rpm, tpm, allowed_models, key_tag, priority, enabled, created_at, last_used, total_requests, total_input_tokens, total_output_tokens FROM client_tokens ORDER BY created_at"
+    )
+    return cursor.fetchall()
+
+
+def insert_client_token(
+    token_hash: str,
+    token_prefix: str,
+    name: str,
+    rpm: int,
+    tpm: int,
+    allowed_models: str,
+    key_tag: str,
+    priority: str,
+):
+    """新增客户端token"""
+    cursor.execute(
+        "INSERT INTO client_tokens (token_hash, token_prefix, name, rpm, tpm, allowed_models, key_tag, priority, enabled, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?)",
+        (token_hash, token_prefix, name, rpm, tpm, allowed_models, key_tag, priority, time.time()),
+    )
+    conn.commit()
+
+
+def update_client_token(
+    token_hash: str,
+    name: str,
+    rpm: int,
+    tpm: int,
+    allowed_models: str,
+    key_tag: str,
+    priority: str,
+    enabled: bool,
+):
+    """更新客户端token的配额与限制"""
+    cursor.execute(
+        "UPDATE client_tokens SET name = ?, rpm = ?, tpm = ?, allowed_models = ?, key_tag = ?, priority = ?, enabled = ? WHERE token_hash = ?",
+        (name, rpm, tpm, allowed_models, key_tag, priority, 1 if enabled else 0, token_hash),
+    )
+    conn.commit()
+
+
+def delete_client_token(token_hash: str):
+    """删除客户端token"""
+    cursor.execute("DELETE FROM client_tokens WHERE token_hash = ?", (token_hash,))
+    conn.commit()
+
+
+def add_client_token_usage(rows):
+    """批量累加客户端token的用量
+
+    Args:
+        rows: (请求数, 输入token, 输出token, 最后使用时间, token_hash) 的列表
+    """
+    cursor.executemany(
+        "UPDATE client_tokens SET total_requests = total_requests + ?, total_input_tokens = total_input_tokens + ?, total_output_tokens = total_output_tokens + ?, last_used = ? WHERE token_hash = ?",
+        rows,
+    )
+    conn.commit()
+
+
+BATCH_JOB_COLUMNS = "id, status, client_hash, free_token, total, completed, failed, created_at, started_at, finished_at, error"
+
+
+def insert_batch_job(job_id: str, client_hash: str, free_token: bool, total: int):
+    """创建批量任务"""
+    cursor.execute(
+        "INSERT INTO batch_jobs (id, status, client_hash, free_token, total, created_at) VALUES (?, 'queued', ?, ?, ?, ?)",
+        (job_id, client_hash, 1 if free_token else 0, total, time.time()),
+    )
+    conn.commit()
+
+
+def update_batch_job(job_id: str, status: str, completed: int, failed: int, started_at=None, finished_at=None, error=None):
+    """更新批量任务的状态和进度"""
+    cursor.execute(
+        "UPDATE batch_jobs SET status = ?, completed = ?, failed = ?, started_at = COALESCE(?, started_at), finished_at = ?, error = ? WHERE id = ?",
+        (status, completed, failed, started_at, finished_at, error, job_id),
+    )
+    conn.commit()
+
+
+def get_batch_jobs(statuses=None):
+    """按创建时间获取批量任务，可按状态筛选"""
+    if statuses:
+        placeholders = ", ".join("?" for _ in statuses)
+        cursor.execute(
+            f"SELECT {BATCH_JOB_COLUMNS} FROM batch_jobs WHERE status IN ({placeholders}) ORDER BY created_at",
+            tuple(statuses),
+        )
+    else:
+        cursor.execute(f"SELECT {BATCH_JOB_COLUMNS} FROM batch_jobs ORDER BY created_at")
+    return cursor.fetchall()
+
+
+def add_invalid_keys(rows):
+    """记录已确认失效的key，rows 为 [(key_hash, upstream, reason, created_at), ...]"""
+    try:
+        cursor.executemany(
+            "INSERT OR REPLACE INTO invalid_keys (key_hash, upstream, reason, created_at) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def get_invalid_keys(key_hashes, upstream: str, since: float) -> dict:
+    """查询 since 之后在 upstream 上记录的失效key，返回 {key_hash: reason}"""
+    key_hashes = list(key_hashes)
+    found = {}
+    # 分批查询，避免超过 SQLite 的参数个数限制
+    for i in range(0, len(key_hashes), 500):
+        chunk = key_hashes[i : i + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        cursor.execute(
+            f"SELECT key_hash, reason FROM invalid_keys WHERE key_hash IN ({placeholders}) AND upstream = ? AND created_at >= ?",
+            chunk + [upstream, since],
+        )
+        found.update(cursor.fetchall())
+    return found
+
+
+def delete_invalid_keys(key_hashes, upstream: str):
+    """删除 upstream 上的失效key记录（key重新验证有效后）"""
+    cursor.executemany(
+        "DELETE FROM invalid_keys WHERE key_hash = ? AND upstream = ?", ((h, upstream) for h in key_hashes)
+    )
+    conn.commit()
+
+
+def delete_invalid_keys_before(timestamp: float) -> int:
+    """删除 timestamp 之前记录的失效key，timestamp 为 None 时全部删除"""
+    if timestamp is None:
+        cursor.execute("DELETE FROM invalid_keys")
+    else:
+        cursor.execute("DELETE FROM invalid_keys WHERE created_at < ?", (timestamp,))
+    conn.commit()
+    return cursor.rowcount
+
+
+def count_invalid_keys(since: float) -> int:
+    """统计 since 之后记录的失效key数量"""
+    cursor.execute("SELECT COUNT(*) FROM invalid_keys WHERE created_at >= ?", (since,))
+    return cursor.fetchone()[0]
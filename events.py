@@ -0,0 +1,80 @@
+import asyncio
+import json
+import threading
+
+# 每个订阅者最多积压的事件数，超出后丢弃积压并通知前端重新加载
+SUBSCRIBER_QUEUE_SIZE = 256
+
+
+class Broker:
+    """管理页面的实时事件广播
+
+    每个事件只序列化一次，再放入各订阅者的队列，前端不必各自轮询数据库。
+    事件可能由线程池中运行的同步代码产生，因此统一投递到主事件循环中处理。
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+        self.loop = None
+        self._lock = threading.Lock()
+
+    def subscribe(self) -> asyncio.Queue:
+        with self._lock:
+            self.loop = asyncio.get_running_loop()
+            queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+            self.subscribers.add(queue)
+            return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        with self._lock:
+            self.subscribers.discard(queue)
+
+    def publish(self, event_type: str, data):
+        """广播事件，没有订阅者时直接返回"""
+        if not self.subscribers:
+            return
+        message = f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self._deliver(message)
+        elif self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._deliver, message)
+
+    def _deliver(self, message: str):
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for queue in subscribers:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # 前端处理不过来：丢弃积压，让其重新加载完整数据
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait("event: resync\ndata: {}\n\n")
+
+
+broker = Broker()
+
+
+def publish(event_type: str, data):
+    broker.publish(event_type, data)
+
+
+async def summary_loop(stop_event: asyncio.Event, get_summary, interval: float = 1):
+    """密钥池汇总有变化时推送 stats 事件，高频修改合并为每秒最多一次"""
+    last = None
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        if not broker.subscribers:
+            last = None
+            continue
+        summary = get_summary()
+        if summary != last:
+            last = summary
+            publish("stats", summary)
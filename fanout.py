@@ -0,0 +1,124 @@
+import asyncio
+import json
+import config
+import metrics
+
+# 大批量的 embeddings 输入和 rerank 文档列表拆成多个分块，并发发送到多个key，
+# 再按原顺序合并结果和用量，响应格式与上游一致。
+
+
+def _split(items: list, size: int) -> list:
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def embedding_chunks(req_json: dict):
+    """input 超过分块大小时返回各分块的 (请求体, 输入数)，不需要拆分时返回 None
+
+    input 为整数列表时是单个已分词的输入，不拆分
+    """
+    size = config.FANOUT_EMBEDDING_CHUNK_SIZE
+    inputs = req_json.get("input")
+    if not size or not isinstance(inputs, list) or len(inputs) <= size:
+        return None
+    if not all(isinstance(item, (str, list)) for item in inputs):
+        return None
+    return [(json.dumps({**req_json, "input": chunk}).encode(), len(chunk)) for chunk in _split(inputs, size)]
+
+
+def merge_embeddings(parts: list, sizes: list) -> dict:
+    """按分块顺序合并 embeddings 响应，index 换算回原始输入中的位置"""
+    merged = dict(parts[0])
+    data = []
+    prompt_tokens = total_tokens = offset = 0
+    for part, size in zip(parts, sizes):
+        for item in part.get("data", []):
+            data.append({**item, "index": item.get("index", 0) + offset})
+        usage = part.get("usage") or {}
+        prompt_tokens += usage.get("prompt_tokens", 0)
+        total_tokens += usage.get("total_tokens", 0)
+        offset += size
+    data.sort(key=lambda item: item["index"])
+    merged["data"] = data
+    merged["usage"] = {"prompt_tokens": prompt_tokens, "total_tokens": total_tokens}
+    return merged
+
+
+def rerank_chunks(req_json: dict):
+    """documents 超过分块大小时返回各分块的 (请求体, 文档数)，不需要拆分时返回 None
+
+    各分块返回全部文档的得分（去掉 top_n），合并后再按 top_n 截取
+    """
+    size = config.FANOUT_RERANK_CHUNK_SIZE
+    documents = req_json.get("documents")
+    if not size or not isinstance(documents, list) or len(documents) <= size:
+        return None
+    body = {k: v for k, v in req_json.items() if k != "top_n"}
+    return [(json.dumps({**body, "documents": chunk}).encode(), len(chunk)) for chunk in _split(documents, size)]
+
+
+def merge_rerank(parts: list, sizes: list, top_n=None) -> dict:
+    """合并 rerank 响应：index 换算回原始文档的位置，按得分从高到低排序并截取 top_n"""
+    merged = dict(parts[0])
+    results = []
+    input_tokens = output_tokens = offset = 0
+    for part, size in zip(parts, sizes):
+        for item in part.get("results", []):
+            results.append({**item, "index": item.get("index", 0) + offset})
+        tokens = (part.get("meta") or {}).get("tokens") or {}
+        input_tokens += tokens.get("input_tokens", 0)
+        output_tokens += tokens.get("output_tokens", 0)
+        offset += size
+    results.sort(key=lambda item: item.get("relevance_score", 0), reverse=True)
+    if isinstance(top_n, int) and top_n > 0:
+        results = results[:top_n]
+    merged["results"] = results
+    merged["meta"] = {
+        **(parts[0].get("meta") or {}),
+        "tokens": {"input_tokens": input_tokens, "output_tokens": output_tokens},
+    }
+    return merged
+
+
+async def dispatch(calls: list):
+    """并发执行各分块的请求，最多同时进行 fanout_concurrency 个
+
+    calls 中的每一项是返回 (key, 状态码, 响应) 的协程函数。任一分块失败时取消其余分块。
+
+    Returns:
+        (状态码, 失败分块的响应或 None, 与 calls 对应的结果列表，未完成的为 None)
+    """
+    semaphore = asyncio.Semaphore(max(1, config.FANOUT_CONCURRENCY))
+
+    async def run(call):
+        async with semaphore:
+            return await call()
+
+    metrics.inc("fanout_requests")
+    metrics.inc("fanout_chunks", len(calls))
+    tasks = [asyncio.ensure_future(run(call)) for call in calls]
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                _, status, data = task.result()
+                if status != 200:
+                    metrics.inc("fanout_failed")
+                    return status, data, _results(tasks)
+        return 200, None, _results(tasks)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()
+
+
+def _results(tasks: list) -> list:
+    results = []
+    for task in tasks:
+        if task.done() and not task.cancelled() and task.exception() is None:
+            results.append(task.result())
+        else:
+            results.append(None)
+    return results
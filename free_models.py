@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import time
+import config
+import db
+import providers
+import upstream
+
+logger = logging.getLogger(__name__)
+
+# 硅基流动标注为免费的常用模型，可通过配置项 free_models 补充
+BUILTIN_FREE_MODELS = {
+    "Qwen/Qwen2.5-7B-Instruct",
+    "Qwen/Qwen2.5-Coder-7B-Instruct",
+    "Qwen/Qwen2-7B-Instruct",
+    "Qwen/Qwen2-1.5B-Instruct",
+    "Qwen/Qwen3-8B",
+    "THUDM/glm-4-9b-chat",
+    "THUDM/GLM-4-9B-0414",
+    "THUDM/GLM-Z1-9B-0414",
+    "THUDM/chatglm3-6b",
+    "01-ai/Yi-1.5-9B-Chat-16K",
+    "01-ai/Yi-1.5-6B-Chat",
+    "internlm/internlm2_5-7b-chat",
+    "google/gemma-2-9b-it",
+    "meta-llama/Meta-Llama-3.1-8B-Instruct",
+    "deepseek-ai/DeepSeek-R1-Distill-Qwen-7B",
+    "deepseek-ai/DeepSeek-R1-0528-Qwen3-8B",
+    "BAAI/bge-m3",
+    "BAAI/bge-large-zh-v1.5",
+    "BAAI/bge-large-en-v1.5",
+    "BAAI/bge-reranker-v2-m3",
+    "netease-youdao/bce-embedding-base_v1",
+    "netease-youdao/bce-reranker-base_v1",
+    "Kwai-Kolors/Kolors",
+}
+
+# 通过调用结果学习到的记录的有效期，过期后重新学习
+LEARNED_TTL = 60 * 60 * 24
+
+# 余额为0的key调用收费模型时上游返回的状态码
+PAID_MODEL_STATUS = 402
+# 上游也会对余额不足返回403，只有响应中带有余额不足的错误码时才说明模型收费；
+# 其他403（如key被封禁或停用）与模型是否收费无关
+INSUFFICIENT_BALANCE_CODES = {30001}
+
+# model -> (is_free, source)，source 为 metadata 或 learned
+_pricing_cache = {}
+_upstream_models = set()
+_last_refresh = 0.0
+
+
+def is_free(model: str) -> bool:
+    """判断模型是否为免费模型
+
+    优先级：手动配置 > 调用结果学习 / 上游元数据 > 内置列表
+    """
+    if not model:
+        return False
+    if model in config.FREE_MODELS:
+        return True
+    cached = _pricing_cache.get(model)
+    if cached is not None:
+        return cached[0]
+    # Pro/ 前缀的模型是收费版本
+    if model.startswith("Pro/"):
+        return False
+    return model in BUILTIN_FREE_MODELS
+
+
+def _insufficient_balance(data) -> bool:
+    """上游的错误响应是否表示余额不足"""
+    if not isinstance(data, dict):
+        return False
+    return data.get("code") in INSUFFICIENT_BALANCE_CODES
+
+
+def record_result(model: str, status: int, data=None):
+    """根据余额为0的key的调用结果学习模型是否免费
+
+    data 为上游的响应JSON，用于区分余额不足的403和其他原因的403
+    """
+    if not model or model == "unknown":
+        return
+    if 200 <= status < 300:
+        learned = True
+    elif status == PAID_MODEL_STATUS or status == 403 and _insufficient_balance(data):
+        learned = False
+    else:
+        return
+    cached = _pricing_cache.get(model)
+    if cached == (learned, "learned"):
+        return
+    _pricing_cache[model] = (learned, "learned")
+    db.save_model_pricing(model, learned, "learned")
+    logger.info(f"Learned model pricing: {model} - {'free' if learned else 'paid'}")
+
+
+def _parse_metadata(entry: dict):
+    """从 /v1/models 的模型元数据中解析是否免费，无法判断时返回 None"""
+    if "is_free" in entry:
+        return bool(entry["is_free"])
+    pricing = entry.get("pricing")
+    if isinstance(pricing, dict):
+        try:
+            return all(float(v) == 0 for v in pricing.values())
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+async def refresh_free_models():
+    """从数据库和上游 /v1/models 刷新免费模型映射"""
+    global _upstream_models, _last_refresh
+
+    db.delete_model_pricing_before(time.time() - LEARNED_TTL)
+    cache = {
+        model: (bool(is_free_flag), source)
+        for model, is_free_flag, source, _ in db.get_model_pricing()
+    }
+
+    # 每个上游用自己的key查询模型列表，合并各上游提供的模型
+    models = set()
+    refreshed = False
+    for name in providers.names():
+        key = db.get_any_enabled_key(name)
+        if not key:
+            continue
+        try:
+            async with upstream.get_session().get(
+                f"{providers.base_url(name)}/v1/models",
+                headers={"Authorization": f"Bearer {key}"},
+                timeout=30,
+            ) as resp:
+                if resp.status != 200:
+                    continue
+                data = await resp.json()
+        except Exception as e:
+            logger.warning(f"刷新上游 {name or 'default'} 的模型列表失败: {str(e)}")
+            continue
+        refreshed = True
+        for entry in data.get("data", []):
+            model = entry.get("id")
+            if not model:
+                continue
+            models.add(model)
+            parsed = _parse_metadata(entry)
+            # 学习到的结果比元数据更可靠
+            if parsed is not None and cache.get(model, (None, ""))[1] != "learned":
+                cache[model] = (parsed, "metadata")
+                db.save_model_pricing(model, parsed, "metadata")
+    if refreshed:
+        _upstream_models = models
+
+    _pricing_cache.clear()
+    _pricing_cache.update(cache)
+    _last_refresh = time.time()
+
+
+def get_free_models_status():
+    """返回当前免费模型映射，供设置页展示"""
+    models = set(config.FREE_MODELS) | set(_pricing_cache) | BUILTIN_FREE_MODELS
+    if _upstream_models:
+        # 仅展示上游仍然提供的模型
+        models &= _upstream_models | set(config.FREE_MODELS)
+    return {
+        "free_models": sorted(m for m in models if is_free(m)),
+        "upstream_model_count": len(_upstream_models),
+        "last_refresh": _last_refresh,
+    }
+
+
+async def refresh_loop(stop_event: asyncio.Event):
+    """后台定期刷新免费模型映射"""
+    while not stop_event.is_set():
+        try:
+            await refresh_free_models()
+        except Exception as e:
+            logger.error(f"刷新免费模型列表失败: {str(e)}")
+        interval = max(1, int(config.FREE_MODELS_REFRESH_INTERVAL)) * 60
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,161 @@
+import asyncio
+import time
+from collections import deque
+import config
+import metrics
+
+# 对冲请求：非流式的短请求（embeddings/rerank）超过该接口近期的 p95 延迟仍未返回时，
+# 用另一个key再发一次，取先成功返回的结果并取消另一个。
+# 对冲请求的总量受预算限制：每个请求积累 hedging_max_ratio 个额度，发出一次对冲消耗 1 个。
+
+# 每个接口保留的最近延迟样本数
+WINDOW_SIZE = 500
+# 样本少于该数量时 p95 不可靠，不做对冲
+MIN_SAMPLES = 20
+# 每积累多少个新样本重新计算一次 p95
+RECOMPUTE_EVERY = 20
+# 预算最多积累的对冲次数，避免空闲一段时间后突发大量对冲
+BUDGET_CAP = 10
+
+
+class LatencyWindow:
+    """接口最近的延迟样本及其 p95"""
+
+    def __init__(self):
+        self.samples = deque(maxlen=WINDOW_SIZE)
+        self.p95 = None
+        self._pending = 0
+
+    def add(self, latency: float):
+        self.samples.append(latency)
+        self._pending += 1
+        if self._pending >= RECOMPUTE_EVERY or self.p95 is None and len(self.samples) >= MIN_SAMPLES:
+            self._pending = 0
+            ordered = sorted(self.samples)
+            self.p95 = ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]
+
+    def delay(self):
+        """发出对冲请求前等待的秒数，样本不足时返回 None"""
+        if len(self.samples) < MIN_SAMPLES or self.p95 is None:
+            return None
+        return max(self.p95, config.HEDGING_MIN_DELAY_MS / 1000)
+
+    def expected_beyond(self, elapsed: float) -> float:
+        """已经等了 elapsed 秒的请求预计还要多久返回，按样本中更慢的请求估算"""
+        slower = [s for s in self.samples if s > elapsed]
+        if not slower:
+            return 0.0
+        return sum(slower) / len(slower) - elapsed
+
+
+class _Stats:
+    __slots__ = ("requests", "hedged", "won", "skipped", "saved")
+
+    def __init__(self):
+        self.requests = 0
+        self.hedged = 0
+        self.won = 0
+        self.skipped = 0
+        self.saved = 0.0
+
+
+_windows = {}
+_stats = {}
+_budget = 0.0
+
+
+def _succeeded(task: asyncio.Task) -> bool:
+    if task.cancelled() or task.exception() is not None:
+        return False
+    status = task.result()[0]
+    return status < 500 and status != 429
+
+
+async def run(endpoint: str, key: str, send, pick_backup):
+    """发送请求，必要时对冲
+
+    Args:
+        endpoint: 接口名，每个接口分别统计延迟
+        key: 首选的key
+        send: send(key) 返回 (状态码, 响应数据) 的协程函数，被取消时不应计入key的失败
+        pick_backup: pick_backup() 返回另一个可用key，没有时返回 None
+
+    Returns:
+        (实际使用的key, 状态码, 响应数据)
+    """
+    global _budget
+    if not config.HEDGING_ENABLED:
+        status, data = await send(key)
+        return key, status, data
+
+    window = _windows.setdefault(endpoint, LatencyWindow())
+    stats = _stats.setdefault(endpoint, _Stats())
+    stats.requests += 1
+    _budget = min(_budget + config.HEDGING_MAX_RATIO, BUDGET_CAP)
+    metrics.inc("hedge_requests")
+
+    start = time.monotonic()
+    primary = asyncio.ensure_future(send(key))
+    tasks = {primary: key}
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=window.delay())
+        if not done:
+            backup = None
+            if _budget >= 1:
+                backup = pick_backup()
+            if backup is None or backup == key:
+                stats.skipped += 1
+                metrics.inc("hedge_skipped")
+            else:
+                _budget -= 1
+                stats.hedged += 1
+                metrics.inc("hedge_sent")
+                tasks[asyncio.ensure_future(send(backup))] = backup
+
+        # 取第一个成功的结果；都失败时使用首选key的结果
+        pending = set(tasks)
+        winner = None
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if _succeeded(task):
+                    winner = task
+                    break
+        if winner is None:
+            winner = primary
+
+        elapsed = time.monotonic() - start
+        if winner is not primary:
+            stats.won += 1
+            metrics.inc("hedge_won")
+            # 首选请求被取消，无法知道它实际会在何时返回，按同一接口更慢样本的平均值估算
+            saved = window.expected_beyond(elapsed)
+            stats.saved += saved
+            metrics.inc("hedge_saved_ms", round(saved * 1000))
+        # 对冲获胜时首选请求至少耗时 elapsed，作为样本保留，避免 p95 因对冲而逐渐降低
+        window.add(elapsed)
+        status, data = winner.result()
+        return tasks[winner], status, data
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # 标记落败请求的异常已处理
+                task.exception()
+
+
+def snapshot() -> dict:
+    endpoints = {}
+    for endpoint, stats in _stats.items():
+        window = _windows[endpoint]
+        endpoints[endpoint] = {
+            "p95_ms": round(window.p95 * 1000, 1) if window.p95 is not None else None,
+            "requests": stats.requests,
+            "hedged": stats.hedged,
+            "hedge_won": stats.won,
+            "skipped": stats.skipped,
+            "hedge_rate": round(stats.hedged / stats.requests, 4) if stats.requests else 0,
+            "saved_ms_avg": round(stats.saved * 1000 / stats.won, 1) if stats.won else 0,
+        }
+    return {"enabled": config.HEDGING_ENABLED, "endpoints": endpoints}
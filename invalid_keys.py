@@ -0,0 +1,57 @@
+import hashlib
+import time
+import config
+import db
+import metrics
+
+# 失效key缓存：refresh、调用失败后的检查和导入验证中被上游明确拒绝的key记录在数据库中（只保存哈希值），
+# 在 invalid_key_cache_ttl 天内再次导入到同一个上游时直接拒绝，不再逐个请求上游验证。
+# 被一个上游拒绝的key仍然可以导入到其他上游；过期记录由 utils.reconcile_loop 定期清理。
+
+# 一天的秒数
+DAY = 86400
+
+
+def hash_key(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def _since() -> float:
+    return time.time() - config.INVALID_KEY_CACHE_TTL * DAY
+
+
+def add(entries):
+    """记录失效的key，entries 为 [(key, 上游名称, 失效原因), ...]"""
+    if config.INVALID_KEY_CACHE_TTL <= 0 or not entries:
+        return
+    now = time.time()
+    db.add_invalid_keys([(hash_key(key), upstream, str(reason), now) for key, upstream, reason in entries])
+
+
+def lookup(keys, upstream: str) -> dict:
+    """返回 keys 中在 upstream 上仍处于缓存有效期内的失效key: {key: 失效原因}"""
+    if config.INVALID_KEY_CACHE_TTL <= 0:
+        return {}
+    hashes = {hash_key(key): key for key in keys}
+    found = db.get_invalid_keys(hashes, upstream, _since())
+    if found:
+        metrics.inc("invalid_key_cache_hits", len(found))
+    return {hashes[key_hash]: reason for key_hash, reason in found.items()}
+
+
+def remove(keys, upstream: str):
+    """key在 upstream 上重新验证有效后移出缓存"""
+    db.delete_invalid_keys((hash_key(key) for key in keys), upstream)
+
+
+def purge() -> int:
+    """删除过期的记录"""
+    return db.delete_invalid_keys_before(_since())
+
+
+def clear() -> int:
+    return db.delete_invalid_keys_before(None)
+
+
+def count() -> int:
+    return db.count_invalid_keys(_since())
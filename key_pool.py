@@ -0,0 +1,772 @@
+import asyncio
+import heapq
+import math
+import random
+import threading
+import time
+import config
+import events
+
+# 健康度统计的平滑系数
+EWMA_ALPHA = 0.2
+# 尚无延迟数据时假定的首包延迟(秒)
+DEFAULT_LATENCY = 1.0
+# 加权策略的权重表最短重建间隔(秒)，避免余额频繁变化时反复重建
+REBUILD_INTERVAL = 1.0
+# 平滑加权轮询每一轮的长度约为key数量的倍数，余额按比例换算为每轮被选中的次数
+RR_SLOTS_PER_KEY = 4
+
+# 熔断器状态
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class KeyState:
+    """单个API密钥在内存中的状态"""
+
+    __slots__ = (
+        "key",
+        "add_time",
+        "balance",
+        "usage_count",
+        "enabled",
+        "tag",
+        "upstream",
+        "in_flight",
+        "latency",
+        "error_rate",
+        "breaker",
+        "failures",
+        "open_count",
+        "opened_at",
+    )
+
+    def __init__(self, key, add_time, balance, usage_count, enabled, tag="", upstream=""):
+        self.key = key
+        self.add_time = add_time or 0
+        self.balance = float(balance or 0)
+        self.usage_count = usage_count or 0
+        self.enabled = bool(enabled)
+        self.tag = tag or ""
+        # 所属上游的名称，空字符串表示默认上游 (BASE_URL)
+        self.upstream = upstream or ""
+        self.in_flight = 0
+        self.latency = DEFAULT_LATENCY
+        self.error_rate = 0.0
+        self.breaker = CLOSED
+        self.failures = 0
+        self.open_count = 0
+        self.opened_at = 0.0
+
+    def cooldown(self) -> float:
+        """熔断后的隔离时长，连续熔断时指数退避"""
+        base = config.CIRCUIT_COOLDOWN * 2 ** max(self.open_count - 1, 0)
+        return min(base, config.CIRCUIT_MAX_COOLDOWN)
+
+    def to_dict(self):
+        return {
+            "key": self.key,
+            "balance": self.balance,
+            "usage_count": self.usage_count,
+            "enabled": self.enabled,
+            "tag": self.tag,
+            "upstream": self.upstream,
+            "circuit": self.breaker,
+        }
+
+    def health_cost(self) -> float:
+        """健康度代价，越小越好：综合首包延迟、错误率、并发数和余额"""
+        cost = self.latency * (1 + self.in_flight) * (1 + 4 * self.error_rate)
+        if self.balance > 0:
+            cost /= 1 + math.log10(1 + self.balance)
+        return cost
+
+
+class UpstreamHealth:
+    """单个上游的健康度统计，由真实请求和健康检查共同更新"""
+
+    __slots__ = ("latency", "error_rate", "requests")
+
+    def __init__(self):
+        self.latency = DEFAULT_LATENCY
+        self.error_rate = 0.0
+        self.requests = 0
+
+    def record(self, latency, success: bool):
+        self.requests += 1
+        if latency is not None:
+            self.latency += EWMA_ALPHA * (latency - self.latency)
+        self.error_rate += EWMA_ALPHA * ((0.0 if success else 1.0) - self.error_rate)
+
+    def cost(self) -> float:
+        """路由代价，越小越好"""
+        return self.latency * (1 + 4 * self.error_rate)
+
+
+class KeyList:
+    """支持 O(1) 添加、删除和随机抽取的集合"""
+
+    def __init__(self):
+        self.items = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def add(self, key):
+        if key in self.index:
+            return
+        self.index[key] = len(self.items)
+        self.items.append(key)
+
+    def remove(self, key):
+        idx = self.index.pop(key, None)
+        if idx is None:
+            return
+        last = self.items.pop()
+        if idx < len(self.items):
+            self.items[idx] = last
+            self.index[last] = idx
+
+    def choice(self):
+        return self.items[random.randrange(len(self.items))]
+
+
+class Partition:
+    """一组可被选择的密钥（按余额分为有余额和余额为0两组）
+
+    除了随机抽取外，还维护按并发数分桶的结构和加权策略所需的权重表：
+    - 最少并发：按 in_flight 分桶并记录最小非空桶，选择为 O(1)
+    - 余额加权随机：Vose 别名表，选择为 O(1)
+    - 平滑加权轮询：预先生成一轮按余额加权、交错排列的选择顺序，选择为 O(1)
+    """
+
+    def __init__(self):
+        self.keys = KeyList()
+        self.buckets = {}
+        self.min_in_flight = 0
+        self.dirty = True
+        self.built_at = 0.0
+        self.alias = None
+        # 最近一次重建时的 (keys, 余额权重)
+        self.weights = None
+        # 平滑加权轮询的一轮选择顺序，以及下一次选择的位置
+        self.rr = None
+        self.rr_pos = 0
+        self.rr_stale = True
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, state: KeyState):
+        self.keys.add(state.key)
+        self.buckets.setdefault(state.in_flight, KeyList()).add(state.key)
+        if len(self.keys) == 1 or state.in_flight < self.min_in_flight:
+            self.min_in_flight = state.in_flight
+        self.dirty = True
+
+    def remove(self, state: KeyState):
+        if state.key not in self.keys:
+            return
+        self.keys.remove(state.key)
+        bucket = self.buckets.get(state.in_flight)
+        if bucket is not None:
+            bucket.remove(state.key)
+            if not bucket:
+                del self.buckets[state.in_flight]
+        self._fix_min()
+        self.dirty = True
+
+    def move_in_flight(self, state: KeyState, old: int):
+        """key 的并发数从 old 变为 state.in_flight 时调整分桶"""
+        if state.key not in self.keys:
+            return
+        bucket = self.buckets.get(old)
+        if bucket is not None:
+            bucket.remove(state.key)
+            if not bucket:
+                del self.buckets[old]
+        self.buckets.setdefault(state.in_flight, KeyList()).add(state.key)
+        if state.in_flight < self.min_in_flight:
+            self.min_in_flight = state.in_flight
+        else:
+            self._fix_min()
+
+    def _fix_min(self):
+        if not self.keys:
+            self.min_in_flight = 0
+            return
+        # 并发数每次只变化 1，最小桶最多向上移动一格
+        while self.min_in_flight not in self.buckets:
+            self.min_in_flight += 1
+
+    def least_in_flight(self):
+        return self.buckets[self.min_in_flight].choice()
+
+    def _rebuild(self, states):
+        now = time.monotonic()
+        if not self.dirty and self.alias is not None:
+            return
+        if self.alias is not None and now - self.built_at < REBUILD_INTERVAL:
+            return
+        keys = list(self.keys.items)
+        weights = [max(states[k].balance, 0.0) for k in keys]
+        self.alias = _build_alias(keys, weights)
+        # 轮询顺序只在使用 swrr 策略时按需生成，已有的顺序在当前一轮结束后再更新
+        self.weights = (keys, weights)
+        self.rr_stale = True
+        self.dirty = False
+        self.built_at = now
+
+    def weighted_choice(self, states):
+        self._rebuild(states)
+        key = _alias_choice(self.alias)
+        # 权重表可能稍有滞后，选中已移除的key时退化为随机
+        return key if key in self.keys else self.keys.choice()
+
+    def smooth_round_robin(self, states):
+        """按预先生成的顺序轮询；key 或余额变化后在一轮结束时重新生成，生成的开销分摊到整轮的选择上"""
+        self._rebuild(states)
+        if self.rr is None or (self.rr_pos == 0 and self.rr_stale):
+            self.rr = _build_rr_sequence(*self.weights)
+            self.rr_stale = False
+        if not self.rr:
+            return self.keys.choice()
+        key = self.rr[self.rr_pos]
+        self.rr_pos = (self.rr_pos + 1) % len(self.rr)
+        # 权重表可能稍有滞后，选中已移除的key时退化为随机
+        return key if key in self.keys else self.keys.choice()
+
+
+def _build_rr_sequence(keys, weights):
+    """生成一轮平滑加权轮询的选择顺序
+
+    各key在一轮中出现的次数与余额成正比（至少一次，余额都为0时各一次），用步长调度交错排列：
+    每个key被选中后虚拟时间增加 1/次数，每次选择虚拟时间最小的key，
+    同一个key的出现尽量均匀地分散在整轮中，不会连续集中在一个key上（与 nginx 的平滑加权轮询效果相同）。
+    次数 5/1/1 时的顺序为 a, a, b, c, a, a, a。
+    生成为 O(L log n)，L 约为 n 的 RR_SLOTS_PER_KEY 倍；每轮只生成一次，均摊到每次选择为 O(log n)。
+    """
+    n = len(keys)
+    total = sum(weights)
+    if total > 0:
+        slots = RR_SLOTS_PER_KEY * n
+        counts = [max(1, round(w * slots / total)) for w in weights]
+    else:
+        counts = [1] * n
+    # (虚拟时间, 次数较少的优先, 序号)；初始虚拟时间取第一个步长的一半，使各key错开
+    heap = [(0.5 / c, c, i) for i, c in enumerate(counts)]
+    heapq.heapify(heap)
+    sequence = []
+    for _ in range(sum(counts)):
+        vtime, count, i = heapq.heappop(heap)
+        sequence.append(keys[i])
+        heapq.heappush(heap, (vtime + 1 / count, count, i))
+    return sequence
+
+
+def _build_alias(keys, weights):
+    """构建 Vose 别名表"""
+    n = len(keys)
+    total = sum(weights)
+    if n == 0:
+        return (keys, [], [])
+    if total <= 0:
+        return (keys, [1.0] * n, list(range(n)))
+    scaled = [w * n / total for w in weights]
+    prob = [0.0] * n
+    alias = list(range(n))
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        s = small.pop()
+        g = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = g
+        scaled[g] = scaled[g] + scaled[s] - 1.0
+        if scaled[g] < 1.0:
+            small.append(g)
+        else:
+            large.append(g)
+    for i in large + small:
+        prob[i] = 1.0
+    return (keys, prob, alias)
+
+
+def _alias_choice(table):
+    keys, prob, alias = table
+    i = random.randrange(len(keys))
+    return keys[i] if random.random() < prob[i] else keys[alias[i]]
+
+
+class Summary:
+    """密钥池的汇总计数，随每次修改增量更新，读取为 O(1)"""
+
+    def __init__(self):
+        self.total = 0
+        self.positive = 0
+        self.zero = 0
+        self.enabled = 0
+        # 有余额的key的余额合计
+        self.total_balance = 0.0
+        self.circuit = {CLOSED: 0, OPEN: 0, HALF_OPEN: 0}
+
+    def apply(self, state: KeyState, sign: int):
+        """计入 (sign=1) 或移出 (sign=-1) 一个key的贡献"""
+        self.total += sign
+        if state.balance > 0:
+            self.positive += sign
+            self.total_balance += sign * state.balance
+        else:
+            self.zero += sign
+        if state.enabled:
+            self.enabled += sign
+        self.circuit[state.breaker] += sign
+
+    def to_dict(self):
+        return {
+            "total_key_count": self.total,
+            "positive_balance_count": self.positive,
+            "zero_balance_count": self.zero,
+            "enabled_count": self.enabled,
+            "disabled_count": self.total - self.enabled,
+            "total_balance": round(self.total_balance, 4),
+            "circuit": dict(self.circuit),
+        }
+
+
+class KeyPool:
+    """API密钥的内存镜像，数据库仍是唯一的数据来源
+
+    所有对 api_keys 表的修改都需要同步到这里（见 db.py 中的辅助函数），
+    选择密钥时只访问内存，不再查询数据库。
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.states = {}
+        self.positive = Partition()
+        self.zero = Partition()
+        # 按标签划分的子池: (tag, 是否有余额) -> Partition
+        self.tagged = {}
+        # 按上游划分的子池: (上游, tag, 是否有余额) -> Partition，tag 为空表示该上游的所有key
+        self.by_upstream = {}
+        # 上游名称 -> UpstreamHealth
+        self.upstream_health = {}
+        # 每次变更递增，供缓存判断是否失效
+        self.version = 0
+        self.summary = Summary()
+
+    def _partitions_of(self, state: KeyState, create=False):
+        # 熔断中的key不参与选择
+        if not state.enabled or state.breaker == OPEN:
+            return ()
+        positive = state.balance > 0
+        partitions = [self.positive if positive else self.zero]
+        groups = [(self.by_upstream, (state.upstream, "", positive))]
+        if state.tag:
+            groups.append((self.tagged, (state.tag, positive)))
+            groups.append((self.by_upstream, (state.upstream, state.tag, positive)))
+        for group, group_key in groups:
+            partition = group.get(group_key)
+            if partition is None and create:
+                partition = group[group_key] = Partition()
+            if partition is not None:
+                partitions.append(partition)
+        return partitions
+
+    def _detach(self, state: KeyState):
+        for partition in self._partitions_of(state):
+            partition.remove(state)
+
+    def _attach(self, state: KeyState):
+        for partition in self._partitions_of(state, create=True):
+            partition.add(state)
+
+    def _set_breaker(self, state: KeyState, breaker: str):
+        self.summary.circuit[state.breaker] -= 1
+        self.summary.circuit[breaker] += 1
+        state.breaker = breaker
+        events.publish("key", state.to_dict())
+
+    def load(self, rows):
+        """从数据库行 (key, add_time, balance, usage_count, enabled, tag, upstream) 重建"""
+        with self.lock:
+            self.states = {}
+            self.positive = Partition()
+            self.zero = Partition()
+            self.tagged = {}
+            self.by_upstream = {}
+            self.summary = Summary()
+            for row in rows:
+                state = KeyState(*row)
+                self.states[state.key] = state
+                self._attach(state)
+                self.summary.apply(state, 1)
+            self.version += 1
+
+    def add(self, key, add_time, balance, usage_count=0, enabled=True, tag="", upstream=""):
+        with self.lock:
+            if key in self.states:
+                return
+            state = KeyState(key, add_time, balance, usage_count, enabled, tag, upstream)
+            self.states[key] = state
+            self._attach(state)
+            self.summary.apply(state, 1)
+            self.version += 1
+
+    def remove(self, key):
+        with self.lock:
+            state = self.states.pop(key, None)
+            if state is None:
+                return
+            self._detach(state)
+            self.summary.apply(state, -1)
+            self.version += 1
+
+    def set_enabled(self, key, enabled):
+        with self.lock:
+            state = self.states.get(key)
+            if state is None or state.enabled == bool(enabled):
+                return
+            self._detach(state)
+            self.summary.apply(state, -1)
+            state.enabled = bool(enabled)
+            self.summary.apply(state, 1)
+            self._attach(state)
+            self.version += 1
+
+    def set_balance(self, key, balance):
+        with self.lock:
+            state = self.states.get(key)
+            if state is None:
+                return
+            balance = float(balance or 0)
+            if balance == state.balance:
+                return
+            self._detach(state)
+            self.summary.apply(state, -1)
+            state.balance = balance
+            self.summary.apply(state, 1)
+            self._attach(state)
+            self.version += 1
+
+    def set_tag(self, key, tag):
+        with self.lock:
+            state = self.states.get(key)
+            if state is None or state.tag == (tag or ""):
+                return
+            self._detach(state)
+            state.tag = tag or ""
+            self._attach(state)
+            self.version += 1
+
+    def set_upstream(self, key, upstream):
+        with self.lock:
+            state = self.states.get(key)
+            if state is None or state.upstream == (upstream or ""):
+                return
+            self._detach(state)
+            state.upstream = upstream or ""
+            self._attach(state)
+            self.version += 1
+
+    def upstream_of(self, key):
+        state = self.states.get(key)
+        return state.upstream if state is not None else ""
+
+    def sync(self, rows):
+        """按数据库行校正内存状态，保留熔断、并发等运行时状态
+
+        Returns:
+            与数据库不一致而被校正的key数量
+        """
+        with self.lock:
+            fixed = 0
+            seen = set()
+            for key, add_time, balance, usage_count, enabled, tag, upstream in rows:
+                seen.add(key)
+                state = self.states.get(key)
+                if state is None:
+                    self.add(key, add_time, balance, usage_count, bool(enabled), tag or "", upstream or "")
+                    fixed += 1
+                    continue
+                if (
+                    float(balance or 0) != state.balance
+                    or bool(enabled) != state.enabled
+                    or (tag or "") != state.tag
+                    or (upstream or "") != state.upstream
+                ):
+                    fixed += 1
+                    self.set_balance(key, balance)
+                    self.set_enabled(key, enabled)
+                    self.set_tag(key, tag)
+                    self.set_upstream(key, upstream)
+                state.usage_count = usage_count
+            for key in [key for key in self.states if key not in seen]:
+                self.remove(key)
+                fixed += 1
+
+            # 重新计算汇总，消除余额浮点累加的误差
+            summary = Summary()
+            for state in self.states.values():
+                summary.apply(state, 1)
+            self.summary = summary
+            return fixed
+
+    def get_summary(self):
+        with self.lock:
+            return self.summary.to_dict()
+
+    def batch(self):
+        """批量修改时持有锁，选择key时不会看到只改了一半的状态"""
+        return self.lock
+
+    def filter_keys(self, balance_filter="all", tag=None, enabled=None, upstream=None):
+        """按余额、标签、启用状态和所属上游筛选key"""
+        with self.lock:
+            result = []
+            for state in self.states.values():
+                if balance_filter == "positive" and state.balance <= 0:
+                    continue
+                if balance_filter == "zero" and state.balance > 0:
+                    continue
+                if tag is not None and state.tag != tag:
+                    continue
+                if enabled is not None and state.enabled != enabled:
+                    continue
+                if upstream is not None and state.upstream != upstream:
+                    continue
+                result.append(state.key)
+            return result
+
+    def incr_usage(self, key):
+        with self.lock:
+            state = self.states.get(key)
+            if state is not None:
+                state.usage_count += 1
+
+    def _set_in_flight(self, state: KeyState, value: int):
+        old = state.in_flight
+        state.in_flight = max(0, value)
+        for partition in self._partitions_of(state):
+            partition.move_in_flight(state, old)
+
+    def lease(self, key):
+        """占用一个key用于上游请求，结束时记录延迟与成败"""
+        return KeyLease(self, key)
+
+    def _acquire(self, key):
+        with self.lock:
+            state = self.states.get(key)
+            if state is not None:
+                self._set_in_flight(state, state.in_flight + 1)
+
+    def _release(self, key, latency, success):
+        with self.lock:
+            state = self.states.get(key)
+            if state is None:
+                return
+            self._set_in_flight(state, state.in_flight - 1)
+            if success is None:
+                return
+            self._health_of(state.upstream).record(latency, success)
+            if latency is not None:
+                state.latency += EWMA_ALPHA * (latency - state.latency)
+            state.error_rate += EWMA_ALPHA * ((0.0 if success else 1.0) - state.error_rate)
+
+            if success:
+                state.failures = 0
+                if state.breaker == HALF_OPEN:
+                    self._set_breaker(state, CLOSED)
+                    state.open_count = 0
+                    self.version += 1
+            else:
+                state.failures += 1
+                # 半开状态下的试探请求失败立即重新熔断
+                if (
+                    state.breaker == HALF_OPEN
+                    or state.failures >= config.CIRCUIT_FAILURE_THRESHOLD
+                ):
+                    self._trip(state)
+
+    def _health_of(self, upstream: str) -> UpstreamHealth:
+        health = self.upstream_health.get(upstream)
+        if health is None:
+            health = self.upstream_health[upstream] = UpstreamHealth()
+        return health
+
+    def record_upstream(self, upstream: str, latency, success: bool):
+        """记录上游健康检查的结果"""
+        with self.lock:
+            self._health_of(upstream).record(latency, success)
+
+    def upstream_cost(self, upstream: str) -> float:
+        with self.lock:
+            return self._health_of(upstream).cost()
+
+    def upstream_stats(self, upstream: str) -> dict:
+        with self.lock:
+            health = self._health_of(upstream)
+            return {
+                "latency": round(health.latency, 4),
+                "error_rate": round(health.error_rate, 4),
+                "requests": health.requests,
+            }
+
+    def available(self, upstream=None, use_zero_balance=False, tag=None) -> int:
+        """可参与选择的key数量，upstream 为 None 时统计所有上游"""
+        with self.lock:
+            if upstream is None:
+                if tag:
+                    partition = self.tagged.get((tag, not use_zero_balance))
+                else:
+                    partition = self.zero if use_zero_balance else self.positive
+            else:
+                partition = self.by_upstream.get((upstream, tag or "", not use_zero_balance))
+            return len(partition) if partition else 0
+
+    def _trip(self, state: KeyState):
+        self._detach(state)
+        self._set_breaker(state, OPEN)
+        state.open_count += 1
+        state.opened_at = time.monotonic()
+        state.failures = 0
+        self.version += 1
+
+    def quarantine(self, key):
+        """因暂时性故障（超时、5xx 等）隔离key，冷却后再试探恢复"""
+        with self.lock:
+            state = self.states.get(key)
+            if state is not None:
+                self._trip(state)
+
+    def due_for_probe(self):
+        """返回隔离时长已满、等待试探的key"""
+        now = time.monotonic()
+        with self.lock:
+            return [
+                state.key
+                for state in self.states.values()
+                if state.breaker == OPEN and now - state.opened_at >= state.cooldown()
+            ]
+
+    def half_open(self, key):
+        """试探成功后进入半开状态，重新参与选择，下一次真实请求决定是否恢复"""
+        with self.lock:
+            state = self.states.get(key)
+            if state is None or state.breaker != OPEN:
+                return
+            self._set_breaker(state, HALF_OPEN)
+            self._attach(state)
+            self.version += 1
+
+    def key_info(self, key):
+        """返回key的当前状态，已删除时返回 None"""
+        with self.lock:
+            state = self.states.get(key)
+            return state.to_dict() if state is not None else None
+
+    def breaker_state(self, key):
+        state = self.states.get(key)
+        return state.breaker if state is not None else None
+
+    def select(self, strategy: str, use_zero_balance=False, tag=None, upstream=None):
+        """按策略从有余额或余额为0的密钥中选择一个，没有可用密钥时返回 None
+
+        指定 tag 时只在该标签的子池中选择；指定 upstream 时只选择该上游的key
+        """
+        with self.lock:
+            if upstream is not None:
+                partition = self.by_upstream.get((upstream, tag or "", not use_zero_balance))
+            elif tag:
+                partition = self.tagged.get((tag, not use_zero_balance))
+            else:
+                partition = self.zero if use_zero_balance else self.positive
+            if not partition:
+                return None
+            states = self.states
+
+            # 使用余额为0的key时余额没有意义，加权与基于余额的策略退化为随机
+            if strategy == "least_inflight":
+                return partition.least_in_flight()
+            if strategy == "p2c":
+                a = states[partition.keys.choice()]
+                b = states[partition.keys.choice()]
+                return (a if a.health_cost() <= b.health_cost() else b).key
+            if use_zero_balance:
+                return partition.keys.choice()
+            if strategy == "weighted":
+                return partition.weighted_choice(states)
+            if strategy == "swrr":
+                return partition.smooth_round_robin(states)
+
+            items = partition.keys.items
+            # 基于余额的策略
+            if strategy == "high":
+                return max(items, key=lambda k: states[k].balance)
+            elif strategy == "low":
+                return min(items, key=lambda k: states[k].balance)
+            # 基于使用次数的策略
+            elif strategy == "least_used":
+                return min(items, key=lambda k: states[k].usage_count)
+            elif strategy == "most_used":
+                return max(items, key=lambda k: states[k].usage_count)
+            # 基于添加时间的策略
+            elif strategy == "oldest":
+                return min(items, key=lambda k: states[k].add_time)
+            elif strategy == "newest":
+                return max(items, key=lambda k: states[k].add_time)
+            # 默认随机策略
+            return partition.keys.choice()
+
+
+class KeyLease:
+    """key 的一次占用，配合 with / async with 语句使用"""
+
+    def __init__(self, key_pool: KeyPool, key: str):
+        self.pool = key_pool
+        self.key = key
+        self.start = time.monotonic()
+        self.latency = None
+        self.success = False
+        self.discarded = False
+
+    def discard(self):
+        """本次请求被主动放弃（如对冲请求中落败的一方），结束时不计入key的成功或失败"""
+        self.discarded = True
+
+    def record(self, status: int):
+        """收到上游响应头时调用，429 和 5xx 视为失败"""
+        self.latency = time.monotonic() - self.start
+        self.success = status < 500 and status != 429
+
+    def __enter__(self):
+        self.pool._acquire(self.key)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 读取响应过程中出现的异常也算作失败，客户端主动断开除外
+        if exc_type is not None and not issubclass(
+            exc_type, (GeneratorExit, asyncio.CancelledError)
+        ):
+            self.success = False
+        if self.discarded:
+            self.pool._release(self.key, None, None)
+        else:
+            self.pool._release(self.key, self.latency, self.success)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+
+# 全局密钥池
+pool = KeyPool()
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+from fastapi.responses import JSONResponse
+import config
+
+logger = logging.getLogger(__name__)
+
+# 排空期间返回给客户端的建议重试间隔(秒)
+DRAIN_RETRY_AFTER = 5
+
+
+class Lifecycle:
+    """进程的排空状态与正在处理的 /v1 请求数"""
+
+    def __init__(self):
+        self.draining = False
+        self.drain_started = None
+        self.active = 0
+        self._idle = None
+
+    def _idle_event(self) -> asyncio.Event:
+        if self._idle is None:
+            self._idle = asyncio.Event()
+            if self.active == 0:
+                self._idle.set()
+        return self._idle
+
+    def start_drain(self):
+        """进入排空模式：不再接受新的 /v1 请求，已有请求继续完成"""
+        if self.draining:
+            return
+        self.draining = True
+        self.drain_started = time.time()
+        logger.info(f"开始排空，当前正在处理 {self.active} 个请求")
+
+    def enter(self):
+        self.active += 1
+        self._idle_event().clear()
+
+    def leave(self):
+        self.active -= 1
+        if self.active == 0:
+            self._idle_event().set()
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """等待正在处理的请求全部结束，超时返回 False"""
+        try:
+            await asyncio.wait_for(self._idle_event().wait(), timeout=max(0, timeout))
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def remaining(self) -> float:
+        """距离排空截止时间还剩多少秒"""
+        if self.drain_started is None:
+            return config.DRAIN_TIMEOUT
+        return max(0, self.drain_started + config.DRAIN_TIMEOUT - time.time())
+
+    def snapshot(self):
+        return {
+            "status": "draining" if self.draining else "ready",
+            "active_requests": self.active,
+            "drain_started": self.drain_started,
+            "drain_remaining": round(self.remaining(), 1) if self.draining else None,
+        }
+
+
+state = Lifecycle()
+
+
+async def drain():
+    """开始排空并等待正在处理的请求结束，最多等待 drain_timeout 秒"""
+    state.start_drain()
+    if not await state.wait_idle(state.remaining()):
+        logger.warning(f"排空超时，仍有 {state.active} 个请求未完成")
+
+
+class DrainMiddleware:
+    """排空期间对新的 /v1 请求返回503，并统计正在处理的请求（含流式响应）"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/v1/"):
+            await self.app(scope, receive, send)
+            return
+
+        if state.draining:
+            response = JSONResponse(
+                {"detail": "服务正在重启，请稍后重试"},
+                status_code=503,
+                headers={"Retry-After": str(DRAIN_RETRY_AFTER), "Connection": "close"},
+            )
+            await response(scope, receive, send)
+            return
+
+        state.enter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            state.leave()
@@ -1,11 +1,45 @@
-from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
-import uvicorn
+import sys
+import argparse
+import startup
+
+# --profile-startup: 输出各导入与初始化步骤的耗时
+startup.enabled = "--profile-startup" in sys.argv
+
+with startup.step("import fastapi/uvicorn"):
+    from fastapi import FastAPI
+    import uvicorn
 import logging
 from uvicorn.config import LOGGING_CONFIG
+import asyncio
+import signal
+import threading
 from contextlib import asynccontextmanager
-from db import init_db
-from routers import api_keys, generate, logs, config, static, stats, auth
+
+with startup.step("import core modules"):
+    from db import init_db
+    import config as runtime_config
+    import free_models
+    import client_tokens
+    import batch_jobs
+    import upstream
+    import providers
+    import lifecycle
+    import events
+    import profiler
+    import runtime
+    from key_pool import pool
+    from utils import probe_loop, reconcile_loop
+    from admission import AdmissionMiddleware
+    from lifecycle import DrainMiddleware
+    import recorder
+    from recorder import RecorderMiddleware
+    import assets
+    from assets import AssetFiles, CompressionMiddleware
+
+with startup.step("import routers"):
+    from routers import api_keys, generate, logs, config, static, stats, auth, tokens, health
+    from routers import events as events_router
+    from routers import profile, batches
 
 # 配置日志格式
 LOGGING_CONFIG["formatters"]["default"]["fmt"] = (
@@ -27,8 +61,80 @@ logging.basicConfig(level=logging.INFO)
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
+    # 所有有副作用的初始化都在这里进行，导入模块时不读写文件和数据库
+    with startup.step("ensure config file"):
+        runtime_config.ensure_config_file()
+    with startup.step("init_db"):
+        init_db()
+    with startup.step("load upstreams"):
+        providers.load()
+    with startup.step("load client tokens"):
+        client_tokens.load()
+    with startup.step("load batch jobs"):
+        batch_jobs.load()
+    with startup.step("load asset manifest"):
+        assets.load_manifest()
+    config.start_scheduler()
+
+    stop_event = asyncio.Event()
+    background_tasks = [
+        # 后台刷新免费模型映射
+        asyncio.create_task(free_models.refresh_loop(stop_event)),
+        # 试探被熔断隔离的key
+        asyncio.create_task(probe_loop(stop_event)),
+        # 检查各上游的健康状态和模型列表
+        asyncio.create_task(providers.probe_loop(stop_event)),
+        # 处理批量任务，重启前未完成的任务从结果文件继续
+        asyncio.create_task(batch_jobs.run(stop_event)),
+        # 批量写入客户端token用量
+        asyncio.create_task(client_tokens.flush_loop(stop_event)),
+        # 定期用数据库校正内存密钥池的汇总计数
+        asyncio.create_task(reconcile_loop(stop_event)),
+        # 向管理页面推送密钥池汇总的变化
+        asyncio.create_task(events.summary_loop(stop_event, pool.get_summary)),
+        # 监测事件循环延迟，记录阻塞循环的调用栈
+        asyncio.create_task(profiler.monitor.run(stop_event)),
+        # 写入录制的流量（未开启录制时没有记录，不会写文件）
+        asyncio.create_task(recorder.flush_loop(stop_event)),
+    ]
+    drain_on_exit_signals()
+    startup.report()
     yield
+    # 等待进行中的请求（尤其是长时间的流式响应）结束，再写入用量并关闭连接
+    await lifecycle.drain()
+    stop_event.set()
     config.stop_scheduler()
+    await asyncio.gather(*background_tasks)
+    await upstream.close()
+
+
+def drain_on_exit_signals():
+    """收到退出信号时先进入排空模式，进行中的请求结束或超时后再交给 uvicorn 退出；再次收到信号立即退出
+
+    uvicorn 在执行 lifespan 前已用 signal.signal 注册了 Server.handle_exit，这里包装它，
+    因此 python main.py 和 uvicorn main:app 两种启动方式都会先排空。uvicorn 退出时会恢复原来的信号处理。
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    loop = asyncio.get_running_loop()
+
+    async def exit_after_drain(handle_exit, sig, frame):
+        await lifecycle.drain()
+        handle_exit(sig, frame)
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        handle_exit = signal.getsignal(sig)
+        if not isinstance(getattr(handle_exit, "__self__", None), uvicorn.Server):
+            continue
+
+        def handler(sig, frame, handle_exit=handle_exit):
+            if lifecycle.state.draining:
+                handle_exit(sig, frame)
+                return
+            lifecycle.state.start_drain()
+            loop.call_soon_threadsafe(loop.create_task, exit_after_drain(handle_exit, sig, frame))
+
+        signal.signal(sig, handler)
 
 
 # 创建FastAPI应用
@@ -38,11 +144,21 @@ app = FastAPI(
     lifespan=lifespan,
 )
 
-# 初始化数据库
-init_db()
+# 上游并发已满时排队，超出等待上限返回429
+app.add_middleware(AdmissionMiddleware)
+# 排空期间拒绝新的 /v1 请求（先于准入控制）
+app.add_middleware(DrainMiddleware)
+# 可选的流量录制，放在最外层以便记录被拒绝的请求
+app.add_middleware(RecorderMiddleware)
+
+# 管理接口返回的 JSON 较大时压缩后再发送
+app.add_middleware(
+    CompressionMiddleware,
+    paths=["/logs", "/api/keys", "/api/tokens", "/api/stats", "/export_keys"],
+)
 
-# 挂载静态文件
-app.mount("/static", StaticFiles(directory="static"))
+# 挂载静态文件，使用 build_assets.py 生成的带哈希资源（如果有）
+app.mount("/static", AssetFiles(directory="static"))
 
 # 包含所有路由模块
 app.include_router(api_keys.router, tags=["API密钥管理"])
@@ -52,8 +168,18 @@ app.include_router(generate.router, tags=["API转发"])
 app.include_router(static.router, tags=["静态文件"])
 app.include_router(stats.router, tags=["统计数据"])
 app.include_router(auth.router, tags=["认证"])
+app.include_router(tokens.router, tags=["客户端Token管理"])
+app.include_router(health.router, tags=["健康检查"])
+app.include_router(events_router.router, tags=["实时事件"])
+app.include_router(profile.router, tags=["性能分析"])
+app.include_router(batches.router, tags=["批量任务"])
 
 
 # 启动入口
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=7898)
+    parser = argparse.ArgumentParser(description="Silicon Pool")
+    parser.add_argument("--runtime", choices=list(runtime.PROFILES), help="运行模式，默认使用配置中的 runtime_profile")
+    parser.add_argument("--profile-startup", action="store_true", help="输出启动各步骤的耗时")
+    args = parser.parse_args()
+    options = runtime.server_options(args.runtime)
+    uvicorn.run(app, host="0.0.0.0", port=7898, **options)
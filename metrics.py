@@ -0,0 +1,26 @@
+import threading
+
+# 进程内的简单指标：计数器与最大值，供统计页和排查问题使用
+_lock = threading.Lock()
+_counters = {}
+_maxima = {}
+
+
+def inc(name: str, value: float = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_max(name: str, value: float):
+    with _lock:
+        if value > _maxima.get(name, 0):
+            _maxima[name] = value
+
+
+def get(name: str, default: float = 0):
+    return _counters.get(name, _maxima.get(name, default))
+
+
+def snapshot():
+    with _lock:
+        return {"counters": dict(_counters), "maxima": dict(_maxima)}
@@ -0,0 +1,325 @@
+import argparse
+import asyncio
+import json
+import time
+from aiohttp import web
+
+# 模拟的上游服务，供 replay.py 回放压测使用，行为由代理原样转发的请求头控制：
+#   X-Mock-TTFB      首字节前等待的秒数
+#   X-Mock-Duration  整个响应的耗时（秒），流式响应的事件均匀分布在这段时间内
+#   X-Mock-Events    流式响应的事件数
+#   X-Mock-Status    返回的状态码
+#   X-Mock-Bytes     非流式响应的大致大小
+#
+# 可以启动多个实例模拟多个上游；HTTP/1.1 模式下可用 delay 给每个响应额外增加首字节延迟，
+# 用于测试按延迟路由。
+# 默认以 HTTP/1.1 提供服务；--h2 时以 HTTP/2（h2c，明文直连）提供服务，
+# 用于测试 upstream_backend 为 httpx_h2 时的多路复用，并统计建立的连接数。
+
+
+def _float_header(headers, name: str, default: float) -> float:
+    try:
+        return float(headers.get(name, default))
+    except ValueError:
+        return default
+
+
+def _usage(prompt_tokens: int, completion_tokens: int) -> dict:
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _stream_events(body: dict, chat: bool, events: int) -> list:
+    model = body.get("model", "mock")
+    created = int(time.time())
+    chunks = []
+    for _ in range(events):
+        if chat:
+            choice = {"index": 0, "delta": {"content": "tok "}, "finish_reason": None}
+        else:
+            choice = {"index": 0, "text": "tok ", "finish_reason": None}
+        chunk = {"id": "mock", "created": created, "model": model, "choices": [choice]}
+        chunks.append(f"data: {json.dumps(chunk)}\n\n".encode())
+    if (body.get("stream_options") or {}).get("include_usage"):
+        chunk = {"id": "mock", "created": created, "model": model, "choices": [], "usage": _usage(10, events)}
+        chunks.append(f"data: {json.dumps(chunk)}\n\n".encode())
+    chunks.append(b"data: [DONE]\n\n")
+    return chunks
+
+
+def plan_response(path: str, headers, body: dict) -> dict:
+    """根据路径和控制头决定响应，aiohttp 与 h2 两种服务共用
+
+    返回 {"status", "delay", "json"}，流式响应为 {"status", "delay", "interval", "events"}。
+    headers 需支持小写键名的 get。
+    """
+    ttfb = _float_header(headers, "x-mock-ttfb", 0.05)
+    duration = max(_float_header(headers, "x-mock-duration", ttfb), ttfb)
+    status = int(_float_header(headers, "x-mock-status", 200))
+    size = int(_float_header(headers, "x-mock-bytes", 64))
+    model = body.get("model", "mock")
+
+    if status >= 400:
+        return {"status": status, "delay": ttfb, "json": {"error": {"message": "mock upstream error", "code": status}}}
+
+    if path in ("/v1/chat/completions", "/v1/completions"):
+        chat = path == "/v1/chat/completions"
+        if body.get("stream"):
+            count = max(int(_float_header(headers, "x-mock-events", 20)), 1)
+            return {
+                "status": 200,
+                "delay": ttfb,
+                "interval": (duration - ttfb) / count,
+                "events": _stream_events(body, chat, count),
+            }
+        if chat:
+            payload = {
+                "id": "mock",
+                "object": "chat.completion",
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "x" * size}, "finish_reason": "stop"}],
+            }
+        else:
+            payload = {
+                "id": "mock",
+                "object": "text_completion",
+                "model": model,
+                "choices": [{"index": 0, "text": "x" * size, "finish_reason": "stop"}],
+            }
+        payload["usage"] = _usage(10, max(size // 4, 1))
+        return {"status": 200, "delay": duration, "json": payload}
+
+    if path == "/v1/embeddings":
+        inputs = body.get("input")
+        count = len(inputs) if isinstance(inputs, list) else 1
+        payload = {
+            "object": "list",
+            "model": model,
+            "data": [{"object": "embedding", "index": i, "embedding": [0.0] * 16} for i in range(count)],
+            "usage": _usage(count * 8, 0),
+        }
+        return {"status": 200, "delay": duration, "json": payload}
+
+    if path == "/v1/rerank":
+        documents = body.get("documents") or []
+        payload = {
+            "id": "mock",
+            "results": [{"index": i, "relevance_score": 1 / (i + 1)} for i in range(len(documents))],
+            "meta": {"tokens": {"input_tokens": len(documents) * 8, "output_tokens": 0}},
+        }
+        return {"status": 200, "delay": duration, "json": payload}
+
+    if path == "/v1/images/generations":
+        return {"status": 200, "delay": duration, "json": {"images": [{"url": "http://mock/image.png"}], "seed": 1}}
+
+    if path == "/v1/models":
+        payload = {"object": "list", "data": [{"id": "mock-model", "object": "model", "owned_by": "mock"}]}
+        return {"status": 200, "delay": 0, "json": payload}
+
+    if path == "/v1/user/info":
+        return {"status": 200, "delay": 0, "json": {"code": 20000, "status": True, "data": {"totalBalance": "14.0"}}}
+
+    return {"status": 404, "delay": 0, "json": {"error": {"message": "not found"}}}
+
+
+def _parse_body(raw: bytes) -> dict:
+    try:
+        body = json.loads(raw) if raw else {}
+    except Exception:
+        return {}
+    return body if isinstance(body, dict) else {}
+
+
+async def handle(request: web.Request):
+    plan = plan_response(request.path, request.headers, _parse_body(await request.read()))
+    stats = request.app["stats"]
+    stats["requests"] += 1
+    stats[request.path] = stats.get(request.path, 0) + 1
+    plan["delay"] += request.app["delay"]
+    if "events" not in plan:
+        await asyncio.sleep(plan["delay"])
+        return web.json_response(plan["json"], status=plan["status"])
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    await asyncio.sleep(plan["delay"])
+    for i, event in enumerate(plan["events"]):
+        if i and plan["interval"] > 0:
+            await asyncio.sleep(plan["interval"])
+        await response.write(event)
+    await response.write_eof()
+    return response
+
+
+def create_app(delay: float = 0) -> web.Application:
+    app = web.Application()
+    app["delay"] = delay
+    # 收到的请求数，按路径统计
+    app["stats"] = {"requests": 0}
+    app.router.add_route("*", "/{tail:.*}", handle)
+    return app
+
+
+# h2 模式下统计的连接数与请求数，用于确认多个请求复用了少量连接
+h2_stats = {"connections": 0, "open_connections": 0, "streams": 0, "max_concurrent_streams": 0}
+
+
+class H2MockProtocol(asyncio.Protocol):
+    """HTTP/2（h2c 直连）的模拟上游，每个请求一个流，响应逻辑与 aiohttp 版本相同"""
+
+    def __init__(self):
+        import h2.config
+        import h2.connection
+
+        self.conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+        )
+        self.transport = None
+        self.established = False
+        self.requests = {}
+        self.tasks = {}
+        self.window_updated = asyncio.Event()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def connection_lost(self, exc):
+        if self.established:
+            h2_stats["open_connections"] -= 1
+        for task in self.tasks.values():
+            task.cancel()
+        self.window_updated.set()
+
+    def data_received(self, data):
+        import h2.events
+        import h2.exceptions
+
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self.transport.write(self.conn.data_to_send())
+            self.transport.close()
+            return
+        if not self.established:
+            # 只统计完成 HTTP/2 握手的连接（不包括余额检查等 HTTP/1.1 请求）
+            self.established = True
+            h2_stats["connections"] += 1
+            h2_stats["open_connections"] += 1
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                self.requests[event.stream_id] = {"headers": dict(event.headers), "body": bytearray()}
+            elif isinstance(event, h2.events.DataReceived):
+                request = self.requests.get(event.stream_id)
+                if request is not None:
+                    request["body"] += event.data
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                request = self.requests.pop(event.stream_id, None)
+                if request is not None:
+                    h2_stats["streams"] += 1
+                    self.tasks[event.stream_id] = asyncio.create_task(
+                        self._respond(event.stream_id, request)
+                    )
+                    h2_stats["max_concurrent_streams"] = max(
+                        h2_stats["max_concurrent_streams"], len(self.tasks)
+                    )
+            elif isinstance(event, h2.events.StreamReset):
+                task = self.tasks.pop(event.stream_id, None)
+                if task is not None:
+                    task.cancel()
+            elif isinstance(event, h2.events.WindowUpdated):
+                self.window_updated.set()
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self.transport.close()
+        self.transport.write(self.conn.data_to_send())
+
+    async def _send(self, stream_id: int, data: bytes, end_stream: bool = False):
+        """按流控窗口发送数据"""
+        while data:
+            window = min(self.conn.local_flow_control_window(stream_id), self.conn.max_outbound_frame_size)
+            if window <= 0:
+                self.window_updated.clear()
+                await self.window_updated.wait()
+                if self.transport.is_closing():
+                    return
+                continue
+            chunk, data = data[:window], data[window:]
+            self.conn.send_data(stream_id, chunk, end_stream=end_stream and not data)
+            self.transport.write(self.conn.data_to_send())
+
+    async def _respond(self, stream_id: int, request: dict):
+        headers = request["headers"]
+        plan = plan_response(headers.get(":path", "/").split("?")[0], headers, _parse_body(bytes(request["body"])))
+        try:
+            await asyncio.sleep(plan["delay"])
+            if "events" not in plan:
+                body = json.dumps(plan["json"]).encode()
+                self.conn.send_headers(
+                    stream_id,
+                    [(":status", str(plan["status"])), ("content-type", "application/json"), ("content-length", str(len(body)))],
+                )
+                await self._send(stream_id, body, end_stream=True)
+                return
+            self.conn.send_headers(stream_id, [(":status", "200"), ("content-type", "text/event-stream")])
+            events = plan["events"]
+            for i, event in enumerate(events):
+                if i and plan["interval"] > 0:
+                    await asyncio.sleep(plan["interval"])
+                await self._send(stream_id, event, end_stream=i == len(events) - 1)
+        except Exception:
+            # 客户端重置了流或断开了连接
+            pass
+        finally:
+            self.tasks.pop(stream_id, None)
+            if not self.transport.is_closing():
+                self.transport.write(self.conn.data_to_send())
+
+
+async def start(host: str = "127.0.0.1", port: int = 0, h2: bool = False, delay: float = 0):
+    """启动模拟上游，返回 (关闭用的对象, 实际监听的地址)
+
+    HTTP/1.1 模式下 server.app["stats"] 为收到的请求数
+    """
+    if h2:
+        server = await asyncio.get_running_loop().create_server(H2MockProtocol, host, port)
+        bound = server.sockets[0].getsockname()
+        return server, f"http://{bound[0]}:{bound[1]}"
+    runner = web.AppRunner(create_app(delay), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound = site._server.sockets[0].getsockname()
+    return runner, f"http://{bound[0]}:{bound[1]}"
+
+
+async def stop(server):
+    if isinstance(server, web.AppRunner):
+        await server.cleanup()
+    else:
+        server.close()
+        await server.wait_closed()
+
+
+async def _serve_h2(host: str, port: int):
+    server, url = await start(host, port, h2=True)
+    print(f"HTTP/2 (h2c) 模拟上游: {url}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="模拟的硅基流动上游，用于压测")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7899)
+    parser.add_argument("--h2", action="store_true", help="以 HTTP/2（h2c）提供服务")
+    parser.add_argument("--delay", type=float, default=0, help="每个响应额外增加的首字节延迟（秒）")
+    args = parser.parse_args()
+    if args.h2:
+        asyncio.run(_serve_h2(args.host, args.port))
+    else:
+        web.run_app(create_app(args.delay), host=args.host, port=args.port, access_log=None)
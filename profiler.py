@@ -0,0 +1,206 @@
+import asyncio
+import collections
+import cProfile
+import io
+import logging
+import pstats
+import sys
+import threading
+import time
+import traceback
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 保留的最近几次事件循环阻塞记录
+SLOW_EVENTS_LIMIT = 20
+# 阻塞记录中保留的栈帧数
+STACK_LIMIT = 30
+# 保留最近多少次延迟采样，用于计算分位数
+LAG_WINDOW = 600
+
+
+class LoopMonitor:
+    """监测事件循环延迟，并在循环被阻塞时记录阻塞它的调用栈
+
+    事件循环中的心跳任务定期休眠并测量实际唤醒的延迟；
+    另一个看门狗线程发现心跳长时间没有更新时，抓取事件循环线程当前的调用栈，
+    即正在阻塞循环的处理函数（例如同步的 SQLite 查询、大 JSON 的解析）。
+    """
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.lags = collections.deque(maxlen=LAG_WINDOW)
+        self.slow_events = collections.deque(maxlen=SLOW_EVENTS_LIMIT)
+        self._beat = time.perf_counter()
+        self._loop_thread = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        # 当前这次阻塞是否已经抓取过调用栈
+        self._pending = None
+
+    @property
+    def threshold(self) -> float:
+        return config.LOOP_BLOCK_THRESHOLD_MS / 1000
+
+    async def run(self, stop_event: asyncio.Event):
+        self._loop_thread = threading.get_ident()
+        self._beat = time.perf_counter()
+        self._stopped.clear()
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        try:
+            while not stop_event.is_set():
+                start = time.perf_counter()
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                now = time.perf_counter()
+                lag = max(now - start - self.interval, 0)
+                self._beat = now
+                self.lags.append(lag)
+                metrics.set_max("loop_lag_max_ms", round(lag * 1000, 1))
+                event = self._pending
+                if event is not None:
+                    # 阻塞结束后补上实际阻塞的时长
+                    self._pending = None
+                    event["duration_ms"] = round(lag * 1000, 1)
+                    logger.warning(
+                        f"事件循环被阻塞 {event['duration_ms']} ms，阻塞时的调用栈:\n"
+                        + "".join(event["stack"])
+                    )
+        finally:
+            self._stopped.set()
+
+    def _watch(self):
+        while not self._stopped.wait(max(self.threshold / 2, 0.01)):
+            if self._pending is not None:
+                continue
+            stalled = time.perf_counter() - self._beat - self.interval
+            if stalled < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            stack = traceback.format_stack(frame, limit=STACK_LIMIT)
+            del frame
+            event = {"time": time.time(), "duration_ms": None, "stack": stack}
+            self._pending = event
+            self.slow_events.append(event)
+            metrics.inc("loop_blocked")
+
+    def snapshot(self) -> dict:
+        lags = sorted(self.lags)
+
+        def pct(p):
+            if not lags:
+                return 0
+            return round(lags[min(int(p / 100 * len(lags)), len(lags) - 1)] * 1000, 1)
+
+        return {
+            "lag_ms": round(self.lags[-1] * 1000, 1) if self.lags else 0,
+            "lag_p50_ms": pct(50),
+            "lag_p99_ms": pct(99),
+            "lag_max_ms": metrics.get("loop_lag_max_ms"),
+            "blocked": int(metrics.get("loop_blocked")),
+            "threshold_ms": config.LOOP_BLOCK_THRESHOLD_MS,
+        }
+
+
+monitor = LoopMonitor()
+
+
+class SamplingProfiler:
+    """定时抓取事件循环线程的调用栈，统计各调用路径出现的次数
+
+    开销很小，可以在线上开启。结果为 collapsed stack 格式（每行 `栈;帧 次数`），
+    可直接交给 flamegraph.pl 或 speedscope 生成火焰图。
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.total = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.samples[";".join(reversed(names))] += 1
+            self.total += 1
+
+    def result(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+class ProfileSession:
+    """一次限时的性能分析，同一时间只允许一个"""
+
+    def __init__(self, mode: str, seconds: float, interval: float):
+        self.mode = mode
+        self.seconds = seconds
+        self.started = time.time()
+        self.finished = None
+        self.output = None
+        self._sampler = None
+        self._profile = None
+        self._timer = None
+        if mode == "sample":
+            self._sampler = SamplingProfiler(threading.get_ident(), interval)
+            self._sampler.start()
+        else:
+            # cProfile 记录每次函数调用，结果精确但开销较大，只适合短时间使用
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._timer = asyncio.get_running_loop().call_later(seconds, self.stop)
+
+    @property
+    def running(self) -> bool:
+        return self.finished is None
+
+    def stop(self):
+        if not self.running:
+            return
+        self._timer.cancel()
+        if self._sampler is not None:
+            self._sampler.stop()
+            self.output = self._sampler.result()
+        else:
+            self._profile.disable()
+            stream = io.StringIO()
+            pstats.Stats(self._profile, stream=stream).sort_stats("cumulative").print_stats(100)
+            self.output = stream.getvalue()
+        self.finished = time.time()
+
+    def snapshot(self) -> dict:
+        end = self.finished or time.time()
+        return {
+            "mode": self.mode,
+            "seconds": self.seconds,
+            "running": self.running,
+            "started": self.started,
+            "elapsed": round(end - self.started, 2),
+            "samples": self._sampler.total if self._sampler is not None else None,
+        }
+
+
+# 最近一次（或正在进行的）分析
+session = None
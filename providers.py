@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import random
+import time
+import config
+import upstream
+from key_pool import pool
+
+logger = logging.getLogger(__name__)
+
+# 默认上游（config.BASE_URL）的名称，数据库中 upstream 列为空字符串的key属于它
+DEFAULT_UPSTREAM = ""
+
+
+class Provider:
+    """一个兼容 OpenAI 接口的上游，拥有自己的key子池"""
+
+    __slots__ = ("name", "url", "models", "probed_models", "healthy", "failures", "last_probe", "last_error")
+
+    def __init__(self, name: str, url: str = None, models=None):
+        self.name = name
+        # None 表示使用 config.BASE_URL（回放测试会在运行时替换它）
+        self.url = url.rstrip("/") if url else None
+        # 配置中声明的模型，为空时按健康检查获取的模型列表判断
+        self.models = set(models or [])
+        self.probed_models = None
+        self.healthy = True
+        self.failures = 0
+        self.last_probe = None
+        self.last_error = None
+
+    @property
+    def base_url(self) -> str:
+        return self.url or config.BASE_URL
+
+    def supports(self, model) -> bool:
+        """是否提供该模型，未知时视为提供"""
+        if not model:
+            return True
+        if self.models:
+            return model in self.models
+        if self.probed_models:
+            return model in self.probed_models
+        return True
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name or "default",
+            "base_url": self.base_url,
+            "healthy": self.healthy,
+            "failures": self.failures,
+            "last_probe": self.last_probe,
+            "last_error": self.last_error,
+            "models": sorted(self.models) if self.models else None,
+            "probed_models": len(self.probed_models) if self.probed_models is not None else None,
+            **pool.upstream_stats(self.name),
+            "keys": pool.available(self.name) + pool.available(self.name, use_zero_balance=True),
+        }
+
+
+_providers = {DEFAULT_UPSTREAM: Provider(DEFAULT_UPSTREAM)}
+
+
+def load():
+    """按配置重建上游列表，保留已有的健康状态"""
+    global _providers
+    providers = {DEFAULT_UPSTREAM: _providers.get(DEFAULT_UPSTREAM) or Provider(DEFAULT_UPSTREAM)}
+    for entry in config.UPSTREAMS or []:
+        name = (entry.get("name") or "").strip()
+        url = (entry.get("base_url") or "").strip()
+        if not name or not url:
+            logger.warning(f"忽略缺少 name 或 base_url 的上游配置: {entry}")
+            continue
+        previous = _providers.get(name)
+        provider = Provider(name, url, entry.get("models"))
+        if previous is not None and previous.base_url == provider.base_url:
+            provider.probed_models = previous.probed_models
+            provider.healthy = previous.healthy
+            provider.failures = previous.failures
+        providers[name] = provider
+    _providers = providers
+
+
+def names() -> list:
+    return list(_providers)
+
+
+def exists(name: str) -> bool:
+    return name in _providers
+
+
+def base_url(name: str) -> str:
+    """上游的地址，不在配置中的上游退回到默认上游"""
+    provider = _providers.get(name)
+    return provider.base_url if provider is not None else config.BASE_URL
+
+
+def base_url_of(key: str) -> str:
+    """key 所属上游的地址"""
+    return base_url(pool.upstream_of(key))
+
+
+def route(model=None, use_zero_balance=False, tag=None) -> list:
+    """按模型可用性和实测的延迟、错误率排列可以尝试的上游
+
+    第一个上游按 可用key数 / 代价 加权随机选择，使负载随key数量分布并偏向更快、更稳定的上游；
+    其余上游按代价排列，健康检查失败的上游排在最后，仅在其他上游都没有可用key时使用。
+    """
+    providers = list(_providers.values())
+    if len(providers) == 1:
+        return [providers[0].name]
+    candidates = [p for p in providers if p.supports(model)] or providers
+    healthy = [p for p in candidates if p.healthy]
+    unhealthy = [p for p in candidates if not p.healthy]
+
+    costs = {p.name: pool.upstream_cost(p.name) for p in candidates}
+    weights = [pool.available(p.name, use_zero_balance, tag) / costs[p.name] for p in healthy]
+    order = []
+    if sum(weights) > 0:
+        first = random.choices(healthy, weights=weights)[0]
+        order.append(first.name)
+    rest = sorted((p for p in healthy if p.name not in order), key=lambda p: costs[p.name])
+    order.extend(p.name for p in rest)
+    order.extend(p.name for p in sorted(unhealthy, key=lambda p: costs[p.name]))
+    return order
+
+
+async def probe(provider: Provider):
+    """请求上游的 /v1/models，更新模型列表、延迟和健康状态"""
+    keys = pool.filter_keys(enabled=True, upstream=provider.name)
+    if not keys:
+        return
+    start = time.monotonic()
+    try:
+        async with upstream.get_session().get(
+            f"{provider.base_url}/v1/models",
+            headers={"Authorization": f"Bearer {random.choice(keys)}"},
+            timeout=10,
+        ) as resp:
+            latency = time.monotonic() - start
+            if resp.status == 429 or resp.status >= 500:
+                raise RuntimeError(f"HTTP {resp.status}")
+            # 其他错误（如401）说明上游可以访问，只是用于检查的key有问题
+            data = await resp.json() if resp.status == 200 else None
+        if data is not None:
+            provider.probed_models = {entry.get("id") for entry in data.get("data", []) if entry.get("id")}
+        provider.failures = 0
+        provider.last_error = None
+        if not provider.healthy:
+            logger.info(f"上游 {provider.name or 'default'} 已恢复")
+        provider.healthy = True
+        pool.record_upstream(provider.name, latency, True)
+    except Exception as e:
+        provider.failures += 1
+        provider.last_error = str(e) or type(e).__name__
+        pool.record_upstream(provider.name, None, False)
+        if provider.healthy and provider.failures >= config.UPSTREAM_FAILURE_THRESHOLD:
+            provider.healthy = False
+            logger.warning(f"上游 {provider.name or 'default'} 健康检查连续失败，暂停路由: {provider.last_error}")
+    finally:
+        provider.last_probe = time.time()
+
+
+async def probe_loop(stop_event: asyncio.Event):
+    """后台定期检查所有上游；只有默认上游时不需要路由，不做检查"""
+    while not stop_event.is_set():
+        if len(_providers) > 1:
+            await asyncio.gather(*(probe(p) for p in list(_providers.values())))
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=config.UPSTREAM_PROBE_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def snapshot() -> list:
+    return [p.to_dict() for p in _providers.values()]
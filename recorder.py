@@ -0,0 +1,151 @@
+import asyncio
+import gzip
+import json
+import logging
+import time
+import config
+from client_tokens import hash_token
+
+logger = logging.getLogger(__name__)
+
+# 尚未写入文件的记录
+_pending = []
+
+
+# 需要脱敏的文本字段
+TEXT_FIELDS = {"content", "text", "prompt", "input", "query", "documents", "suffix", "url"}
+
+
+def redact(value, text: bool = False):
+    """把请求体中的文本替换为等长的占位符，保留结构、参数和长度"""
+    if isinstance(value, str):
+        return "x" * len(value) if text else value
+    if isinstance(value, list):
+        return [redact(item, text) for item in value]
+    if isinstance(value, dict):
+        return {key: redact(item, key in TEXT_FIELDS) for key, item in value.items()}
+    return value
+
+
+def _body_fields(body: bytes):
+    """从请求体中取出模型、是否流式，以及按配置处理后的请求体"""
+    try:
+        req_json = json.loads(body)
+    except Exception:
+        return None, False, None
+    if not isinstance(req_json, dict):
+        return None, False, None
+    mode = config.TRAFFIC_RECORD_BODIES
+    if mode == "full":
+        recorded = req_json
+    elif mode == "redacted":
+        recorded = redact(req_json)
+    else:
+        recorded = None
+    return req_json.get("model"), bool(req_json.get("stream")), recorded
+
+
+class RecorderMiddleware:
+    """记录 /v1 请求的元数据与耗时，供 replay.py 回放
+
+    每条记录包括相对时间、路径、模型、请求/响应大小、状态码、首字节时间、总耗时、
+    流式事件数，以及按配置处理后的请求体（不记录 / 脱敏 / 完整）。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            not config.TRAFFIC_RECORDING
+            or scope["type"] != "http"
+            or not scope["path"].startswith("/v1/")
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        start = time.time()
+        record = {
+            # 请求开始的时间戳，回放时据此还原请求间隔
+            "t": round(start, 4),
+            "method": scope["method"],
+            "path": scope["path"],
+            "status": 0,
+            "req_bytes": 0,
+            "resp_bytes": 0,
+            "events": 0,
+            "ttfb": None,
+        }
+        body = []
+
+        async def recording_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                record["req_bytes"] += len(chunk)
+                body.append(chunk)
+            return message
+
+        async def recording_send(message):
+            if message["type"] == "http.response.start":
+                record["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                if chunk and record["ttfb"] is None:
+                    record["ttfb"] = round(time.time() - start, 4)
+                record["resp_bytes"] += len(chunk)
+                record["events"] += chunk.count(b"\n\n")
+            await send(message)
+
+        try:
+            await self.app(scope, recording_receive, recording_send)
+        finally:
+            record["duration"] = round(time.time() - start, 4)
+            headers = dict(scope["headers"])
+            authorization = headers.get(b"authorization", b"").decode("latin-1")
+            if authorization:
+                # 只保存token哈希的前缀，用于区分不同客户端
+                token = authorization[7:] if authorization.startswith("Bearer ") else authorization
+                record["client"] = hash_token(token)[:12]
+            model, stream, recorded = _body_fields(b"".join(body))
+            record["model"] = model
+            record["stream"] = stream
+            if recorded is not None:
+                record["body"] = recorded
+            _pending.append(record)
+
+
+def flush():
+    """把内存中的记录追加到压缩文件（每次追加一个 gzip 成员，可直接整体读取）"""
+    if not _pending:
+        return
+    records = _pending[:]
+    del _pending[: len(records)]
+    data = "".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in records)
+    with gzip.open(config.TRAFFIC_RECORD_FILE, "ab") as f:
+        f.write(data.encode("utf-8"))
+
+
+def load(path: str):
+    """读取录制的记录，按时间排序"""
+    records = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    records.sort(key=lambda r: r["t"])
+    return records
+
+
+async def flush_loop(stop_event: asyncio.Event, interval: float = 5):
+    """后台定期写入录制的记录，停止时再写入一次"""
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            flush()
+        except Exception as e:
+            logger.error(f"写入流量记录失败: {str(e)}")
@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import aiohttp
+
+# 回放 recorder.py 录制的流量：在本地启动模拟上游和代理，按录制时的间隔（可加速）
+# 重新发送请求，输出延迟、首字节时间、吞吐和状态码统计，并可与基线结果比较。
+#
+#   python replay.py traffic.jsonl.gz --speed 2 --report after.json --baseline before.json
+
+
+def percentile(values, p: float):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return round(values[index], 4)
+
+
+def summarize(values) -> dict:
+    return {f"p{p}": percentile(values, p) for p in (50, 90, 95, 99)}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _synthesize_body(record: dict) -> dict:
+    """未录制请求体时，按路径和请求大小构造一个等价的请求"""
+    model = record.get("model") or "mock-model"
+    filler = "x" * max(record.get("req_bytes", 0) - 80, 1)
+    path = record["path"]
+    if path == "/v1/chat/completions":
+        body = {"model": model, "messages": [{"role": "user", "content": filler}]}
+    elif path == "/v1/completions":
+        body = {"model": model, "prompt": filler}
+    elif path == "/v1/embeddings":
+        body = {"model": model, "input": filler}
+    elif path == "/v1/rerank":
+        body = {"model": model, "query": "q", "documents": [filler]}
+    else:
+        body = {"model": model, "prompt": filler}
+    if record.get("stream"):
+        body["stream"] = True
+    return body
+
+
+def _mock_headers(record: dict) -> dict:
+    """把录制到的上游表现转成模拟上游的控制头"""
+    headers = {"X-Mock-Status": str(record.get("status") or 200)}
+    if record.get("ttfb") is not None:
+        headers["X-Mock-TTFB"] = str(record["ttfb"])
+    if record.get("duration") is not None:
+        headers["X-Mock-Duration"] = str(record["duration"])
+    if record.get("stream"):
+        # 录制的事件数包含 [DONE]
+        headers["X-Mock-Events"] = str(max(record.get("events", 1) - 1, 1))
+    else:
+        headers["X-Mock-Bytes"] = str(record.get("resp_bytes", 64))
+    return headers
+
+
+async def send_one(session: aiohttp.ClientSession, base: str, record: dict, result: dict):
+    body = record.get("body") or _synthesize_body(record)
+    headers = _mock_headers(record)
+    start = time.perf_counter()
+    try:
+        async with session.request(record.get("method", "POST"), base + record["path"], json=body, headers=headers) as resp:
+            result["status"] = resp.status
+            async for _ in resp.content.iter_any():
+                if result.get("ttfb") is None:
+                    result["ttfb"] = time.perf_counter() - start
+    except Exception as e:
+        result["status"] = 0
+        result["error"] = str(e)
+    result["latency"] = time.perf_counter() - start
+
+
+async def replay(records, base: str, speed: float) -> dict:
+    results = [dict() for _ in records]
+    origin = records[0]["t"]
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as session:
+        begin = time.perf_counter()
+        tasks = []
+        for record, result in zip(records, results):
+            delay = (record["t"] - origin) / speed - (time.perf_counter() - begin)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send_one(session, base, record, result)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - begin
+
+    statuses = {}
+    for result in results:
+        key = str(result.get("status", 0))
+        statuses[key] = statuses.get(key, 0) + 1
+    latencies = [r["latency"] for r in results if "latency" in r]
+    ttfbs = [r["ttfb"] for r in results if r.get("ttfb") is not None]
+    recorded = [r["duration"] for r in records if r.get("duration") is not None]
+    # 相对于录制时的额外延迟，反映代理自身的开销
+    overhead = [
+        res["latency"] - rec["duration"]
+        for rec, res in zip(records, results)
+        if rec.get("duration") is not None and "latency" in res
+    ]
+    return {
+        "requests": len(records),
+        "speed": speed,
+        "elapsed": round(elapsed, 3),
+        "throughput": round(len(records) / elapsed, 2) if elapsed else None,
+        "status": statuses,
+        "latency": summarize(latencies),
+        "ttfb": summarize(ttfbs),
+        "recorded_latency": summarize(recorded),
+        "overhead": summarize(overhead),
+    }
+
+
+def compare(report: dict, baseline: dict, threshold: float):
+    """返回超过阈值的退化项"""
+    regressions = []
+    for metric in ("latency", "ttfb", "overhead"):
+        for p in ("p50", "p95", "p99"):
+            current = report.get(metric, {}).get(p)
+            previous = baseline.get(metric, {}).get(p)
+            if current is None or previous is None or previous <= 0:
+                continue
+            if current > previous * (1 + threshold):
+                regressions.append(f"{metric}.{p}: {previous:.4f}s -> {current:.4f}s")
+    current, previous = report.get("throughput"), baseline.get("throughput")
+    if current and previous and current < previous * (1 - threshold):
+        regressions.append(f"throughput: {previous} -> {current} req/s")
+    return regressions
+
+
+async def sample_connections(upstream, interval: float = 0.1):
+    """回放期间定期采样上游连接数，记录最高值"""
+    while True:
+        upstream.connection_stats()
+        await asyncio.sleep(interval)
+
+
+async def run(args, options: dict) -> dict:
+    import recorder
+
+    records = recorder.load(args.trace)
+    if not records:
+        raise SystemExit("录制文件中没有请求")
+
+    # 使用临时的配置和数据库，不影响正在使用的数据
+    workdir = tempfile.mkdtemp(prefix="silicon-pool-replay-")
+    import config
+    import db
+
+    config.CONFIG_FILE = os.path.join(workdir, "config.json")
+    db.DB_FILE = os.path.join(workdir, "pool.db")
+    config.CUSTOM_API_KEY = ""
+    config.FREE_MODEL_API_KEY = ""
+    config.TRAFFIC_RECORDING = False
+
+    import mock_upstream
+
+    if args.h2:
+        # 用 HTTP/2 模拟上游测试多路复用的上游连接
+        config.UPSTREAM_BACKEND = "httpx_h2"
+    mock_server, mock_url = await mock_upstream.start(h2=args.h2)
+    config.BASE_URL = mock_url
+    # --upstreams N: 再启动 N-1 个模拟上游，最后一个按 --upstream-delay 变慢，用于测试按延迟路由
+    mocks = [("", mock_server)]
+    config.UPSTREAMS = []
+    for i in range(1, args.upstreams):
+        delay = args.upstream_delay if i == args.upstreams - 1 else 0
+        mock, url = await mock_upstream.start(h2=args.h2, delay=delay)
+        mocks.append((f"mock{i}", mock))
+        config.UPSTREAMS.append({"name": f"mock{i}", "base_url": url})
+    import uvicorn
+    import main
+    import metrics
+    import upstream
+
+    port = _free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning", **options)
+    )
+    serve_task = asyncio.create_task(server.serve())
+    while not server.started:
+        if serve_task.done():
+            serve_task.result()
+        await asyncio.sleep(0.05)
+
+    for i in range(args.keys):
+        db.insert_api_key(f"sk-replay{i:06d}", 14.0, upstream=mocks[i % len(mocks)][0])
+
+    sampler = asyncio.create_task(sample_connections(upstream))
+    try:
+        report = await replay(records, f"http://127.0.0.1:{port}", args.speed)
+        report["runtime"] = args.runtime or config.RUNTIME_PROFILE
+        report["upstream"] = upstream.connection_stats()
+        report["upstream"]["max_connections"] = metrics.get("upstream_connections_max")
+        if args.h2:
+            report["upstream"]["mock"] = dict(mock_upstream.h2_stats)
+        elif len(mocks) > 1:
+            # 各上游收到的请求数（含余额检查等辅助请求）
+            report["upstreams"] = {
+                name or "default": dict(mock.app["stats"]) for name, mock in mocks
+            }
+        return report
+    finally:
+        sampler.cancel()
+        server.should_exit = True
+        await serve_task
+        for _, mock in mocks:
+            await mock_upstream.stop(mock)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放录制的流量，用于性能回归测试")
+    parser.add_argument("trace", help="recorder 录制的文件，例如 traffic.jsonl.gz")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放速度倍数，2 表示请求间隔缩短一半")
+    parser.add_argument("--keys", type=int, default=100, help="密钥池中放入的模拟密钥数量")
+    parser.add_argument("--runtime", help="代理的运行模式（default/compat/performance），用于比较不同模式")
+    parser.add_argument("--h2", action="store_true", help="使用 HTTP/2 模拟上游和 httpx_h2 上游连接")
+    parser.add_argument("--upstreams", type=int, default=1, help="模拟上游的数量，密钥平均分配到各上游")
+    parser.add_argument("--upstream-delay", type=float, default=0, help="最后一个模拟上游额外增加的首字节延迟（秒）")
+    parser.add_argument("--report", help="把结果写入 JSON 文件")
+    parser.add_argument("--baseline", help="用于比较的基线结果")
+    parser.add_argument("--threshold", type=float, default=0.1, help="允许的退化比例，默认 10%%")
+    args = parser.parse_args()
+
+    import runtime
+
+    # 代理和发压端运行在同一个事件循环中，运行模式要求 uvloop 时在这里创建
+    options = runtime.server_options(args.runtime)
+    loop_factory = None
+    if options.get("loop") == "uvloop":
+        import uvloop
+
+        loop_factory = uvloop.new_event_loop
+    report = asyncio.run(run(args, options), loop_factory=loop_factory)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print("性能退化:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("未发现超过阈值的性能退化")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,94 @@
-from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import JSONResponse, Response
+from fastapi import APIRouter, Request, HTTPException, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import asyncio
-from db import conn, cursor
-from utils import validate_key_async, validate_key_format, clean_key
+import base64
+import csv
+import io
+import json
+import config
+import invalid_keys
+import providers
+from db import (
+    conn,
+    cursor,
+    insert_api_key,
+    update_key_balance,
+    delete_api_key,
+    set_key_enabled,
+    set_key_tag,
+    set_keys_enabled,
+    set_keys_tag,
+    set_keys_upstream,
+    apply_key_changes,
+)
+from key_pool import pool
+from routers.auth import validate_session
+from utils import (
+    validate_key_format,
+    clean_key,
+    check_key_async,
+    KEY_VALID,
+    KEY_INVALID,
+    KEY_ERROR,
+)
 
 router = APIRouter()
 
 
+# 密钥列表每页最多返回的条数
+MAX_PAGE_SIZE = 200
+
+# 按筛选条件缓存的总数: (余额筛选, 搜索词, 搜索方式) -> 总数，密钥池变化后失效
+_count_cache = {}
+_count_version = None
+
+
+def encode_cursor(value, key):
+    raw = json.dumps([value, key]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor_str):
+    try:
+        value, key = json.loads(base64.urlsafe_b64decode(cursor_str.encode("ascii")))
+        return value, key
+    except Exception:
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+
+
+def prefix_upper_bound(prefix: str) -> str:
+    """返回大于所有以 prefix 开头字符串的最小字符串，用于把前缀搜索转换为主键范围查询"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def count_keys(where_sql: str, params: list, cache_key):
+    global _count_version
+    if _count_version != pool.version:
+        _count_cache.clear()
+        _count_version = pool.version
+    total = _count_cache.get(cache_key)
+    if total is None:
+        cursor.execute(f"SELECT COUNT(*) FROM api_keys {where_sql}", params)
+        total = _count_cache[cache_key] = cursor.fetchone()[0]
+    return total
+
+
 @router.get("/api/keys")
 async def get_keys(
     page: int = 1,
     sort_field: str = "add_time",
     sort_order: str = "desc",
     balance_filter: str = "all",
+    page_size: int = 10,
+    search: str = "",
+    search_mode: str = "prefix",
+    cursor_token: str = Query(None, alias="cursor"),
 ):
+    """分页获取密钥列表
+
+    提供 cursor（上一页返回的 next_cursor）时使用键集分页，不受页码深度影响；
+    否则按 page 计算偏移量，便于跳转到任意页。
+    """
     allowed_fields = ["add_time", "balance", "usage_count", "enabled", "key"]
     allowed_orders = ["asc", "desc"]
     allowed_filters = ["all", "positive", "zero"]
@@ -24,26 +99,58 @@ async def get_keys(
         sort_order = "desc"
     if balance_filter not in allowed_filters:
         balance_filter = "all"
+    if search_mode not in ("prefix", "substring"):
+        search_mode = "prefix"
 
-    page_size = 10
-    offset = (page - 1) * page_size
+    page = max(1, page)
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    search = search.strip()
 
-    # 根据余额筛选条件构建 SQL WHERE 子句
-    filter_clause = ""
+    # 根据余额筛选条件和搜索词构建 SQL WHERE 子句
+    conditions = []
+    params = []
     if balance_filter == "positive":
-        filter_clause = "WHERE balance > 0"
+        conditions.append("balance > 0")
     elif balance_filter == "zero":
-        filter_clause = "WHERE balance <= 0"
-
-    # 计算总数
-    count_sql = f"SELECT COUNT(*) FROM api_keys {filter_clause}"
-    cursor.execute(count_sql)
-    total = cursor.fetchone()[0]
+        conditions.append("balance <= 0")
+    if search:
+        if search_mode == "prefix":
+            conditions.append("key >= ? AND key < ?")
+            params += [search, prefix_upper_bound(search)]
+        else:
+            conditions.append("instr(key, ?) > 0")
+            params.append(search)
+
+    where_sql = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    total = count_keys(where_sql, params, (balance_filter, search, search_mode))
+
+    # key 作为排序值相同时的次序，保证分页结果稳定
+    if sort_field == "key":
+        order_sql = f"ORDER BY key {sort_order}"
+    else:
+        order_sql = f"ORDER BY {sort_field} {sort_order}, key {sort_order}"
+
+    if cursor_token:
+        last_value, last_key = decode_cursor(cursor_token)
+        op = "<" if sort_order == "desc" else ">"
+        if sort_field == "key":
+            conditions.append(f"key {op} ?")
+            params.append(last_key)
+        else:
+            conditions.append(f"({sort_field}, key) {op} (?, ?)")
+            params += [last_value, last_key]
+        page_where = f"WHERE {' AND '.join(conditions)}"
+        limit_sql = "LIMIT ?"
+        page_params = params + [page_size]
+    else:
+        page_where = where_sql
+        limit_sql = "LIMIT ? OFFSET ?"
+        page_params = params + [page_size, (page - 1) * page_size]
 
     # 获取分页数据
     cursor.execute(
-        f"SELECT key, add_time, balance, usage_count, enabled FROM api_keys {filter_clause} ORDER BY {sort_field} {sort_order} LIMIT ? OFFSET ?",
-        (page_size, offset),
+        f"SELECT key, add_time, balance, usage_count, enabled, tag FROM api_keys {page_where} {order_sql} {limit_sql}",
+        page_params,
     )
     keys = cursor.fetchall()
 
@@ -55,12 +162,26 @@ async def get_keys(
             "balance": row[2],
             "usage_count": row[3],
             "enabled": bool(row[4]),
+            "tag": row[5] or "",
+            "circuit": pool.breaker_state(row[0]),
         }
         for row in keys
     ]
 
+    next_cursor = None
+    if len(keys) == page_size:
+        last = keys[-1]
+        columns = ["key", "add_time", "balance", "usage_count", "enabled"]
+        next_cursor = encode_cursor(last[columns.index(sort_field)], last[0])
+
     return JSONResponse(
-        {"keys": key_list, "total": total, "page": page, "page_size": page_size}
+        {
+            "keys": key_list,
+            "total": total,
+            "page": page,
+            "page_size": page_size,
+            "next_cursor": next_cursor,
+        }
     )
 
 
@@ -73,17 +194,20 @@ async def refresh_single_key(request: Request):
         raise HTTPException(status_code=400, detail="未提供API密钥")
 
     try:
-        valid, balance = await validate_key_async(key)
-
-        if valid and float(balance) > 0:
-            cursor.execute(
-                "UPDATE api_keys SET balance = ? WHERE key = ?", (balance, key)
-            )
-            conn.commit()
+        status, balance = await check_key_async(key)
+
+        if status == KEY_ERROR:
+            # 暂时性故障不删除key，只隔离等待恢复
+            pool.quarantine(key)
+            return JSONResponse({"message": f"刷新失败，密钥已暂时隔离: {balance}"})
+        if status == KEY_VALID and float(balance) > 0:
+            update_key_balance(key, balance)
             return JSONResponse({"message": f"密钥更新成功，当前余额: ¥{balance}"})
         else:
-            cursor.execute("DELETE FROM api_keys WHERE key = ?", (key,))
-            conn.commit()
+            upstream = pool.upstream_of(key)
+            delete_api_key(key)
+            if status == KEY_INVALID:
+                invalid_keys.add([(key, upstream, balance)])
             return JSONResponse({"message": "密钥已失效或余额为0，已从池中移除"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"刷新密钥失败: {str(e)}")
@@ -98,8 +222,7 @@ async def delete_key(request: Request):
         raise HTTPException(status_code=400, detail="未提供API密钥")
 
     try:
-        cursor.execute("DELETE FROM api_keys WHERE key = ?", (key,))
-        conn.commit()
+        delete_api_key(key)
         return JSONResponse({"message": "密钥已成功删除"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"删除密钥失败: {str(e)}")
@@ -118,20 +241,39 @@ async def toggle_key(request: Request):
         raise HTTPException(status_code=400, detail="未提供启用状态")
 
     try:
-        cursor.execute(
-            "UPDATE api_keys SET enabled = ? WHERE key = ?", (1 if enabled else 0, key)
-        )
-        conn.commit()
+        set_key_enabled(key, enabled)
         status = "启用" if enabled else "禁用"
         return JSONResponse({"message": f"密钥已成功{status}"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"更新密钥状态失败: {str(e)}")
 
 
+@router.post("/api/set_key_tag")
+async def update_key_tag(request: Request):
+    data = await request.json()
+    key = data.get("key")
+    tag = (data.get("tag") or "").strip()
+
+    if not key:
+        raise HTTPException(status_code=400, detail="未提供API密钥")
+
+    try:
+        set_key_tag(key, tag)
+        if tag:
+            return JSONResponse({"message": f"密钥已加入子池 {tag}"})
+        return JSONResponse({"message": "密钥已移出子池"})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"更新密钥标签失败: {str(e)}")
+
+
 @router.post("/import_keys")
 async def import_keys(request: Request):
     data = await request.json()
     keys_text = data.get("keys", "")
+    tag = (data.get("tag") or "").strip()
+    upstream = (data.get("upstream") or "").strip()
+    if not providers.exists(upstream):
+        raise HTTPException(status_code=400, detail="未知的上游")
 
     # 清理和验证密钥
     raw_keys = [k.strip() for k in keys_text.splitlines() if k.strip()]
@@ -143,96 +285,267 @@ async def import_keys(request: Request):
     if not keys:
         return JSONResponse({"message": "未提供有效的 API Key"}, status_code=400)
 
-    tasks = []
-    # 准备任务：对于重复的密钥，添加一个返回标记的虚拟任务
+    # 已在池中或在本次粘贴中重复出现的key不再验证
+    duplicate_count = 0
+    new_keys = []
+    seen = set()
     for key in keys:
-        cursor.execute("SELECT key FROM api_keys WHERE key = ?", (key,))
-        if cursor.fetchone():
-            tasks.append(asyncio.sleep(0, result=("duplicate", key)))
+        if key in seen or key in pool.states:
+            duplicate_count += 1
         else:
-            tasks.append(validate_key_async(key))
+            seen.add(key)
+            new_keys.append(key)
 
-    results = await asyncio.gather(*tasks)
+    # 缓存有效期内已确认失效的key直接拒绝，recheck 为 true 时仍然请求上游验证
+    known_invalid = {}
+    if not data.get("recheck"):
+        known_invalid = invalid_keys.lookup(new_keys, upstream)
+    pending = [key for key in new_keys if key not in known_invalid]
+
+    results = await check_keys(pending, providers.base_url(upstream))
     imported_count = 0
-    duplicate_count = 0
     invalid_count = 0
     zero_balance_count = 0
-
-    for idx, result in enumerate(results):
-        if result[0] == "duplicate":
-            duplicate_count += 1
+    imported = []
+    rejected = []
+
+    for key, (status, value) in zip(pending, results):
+        if status == KEY_VALID:
+            insert_api_key(key, value, tag, upstream)
+            imported_count += 1
+            imported.append(key)
+            if float(value) <= 0:
+                zero_balance_count += 1
         else:
-            valid, balance = result
-            if valid:
-                from db import insert_api_key
-
-                insert_api_key(keys[idx], balance)
-                imported_count += 1
-                if float(balance) <= 0:
-                    zero_balance_count += 1
-            else:
-                invalid_count += 1
+            invalid_count += 1
+            # 只缓存上游明确拒绝的key，网络错误、限流等暂时性故障下次导入时仍会重新验证
+            if status == KEY_INVALID:
+                rejected.append((key, upstream, value))
+
+    invalid_keys.add(rejected)
+    if data.get("recheck") and imported:
+        invalid_keys.remove(imported, upstream)
 
     message = f"导入成功 {imported_count} 个"
     if zero_balance_count > 0:
         message += f"（其中 {zero_balance_count} 个余额用尽，可用于免费模型）"
     message += f"，有重复 {duplicate_count} 个，格式无效 {invalid_format_count} 个，API 验证失败 {invalid_count} 个"
+    if known_invalid:
+        message += f"，已知失效 {len(known_invalid)} 个（未重新验证）"
 
     return JSONResponse({"message": message})
 
 
+@router.get("/api/keys/invalid_cache")
+async def get_invalid_key_cache(request: Request):
+    """失效key缓存中仍在有效期内的记录数"""
+    if not validate_session(request):
+        raise HTTPException(status_code=401, detail="未认证")
+    return JSONResponse({"count": invalid_keys.count(), "ttl_days": config.INVALID_KEY_CACHE_TTL})
+
+
+@router.delete("/api/keys/invalid_cache")
+async def clear_invalid_key_cache(request: Request):
+    """清空失效key缓存，之后导入的key都会重新请求上游验证"""
+    if not validate_session(request):
+        raise HTTPException(status_code=401, detail="未认证")
+    removed = invalid_keys.clear()
+    return JSONResponse({"message": f"已清空失效 Key 缓存，共 {removed} 条"})
+
+
+# 批量查询余额时的最大并发数
+REFRESH_CONCURRENCY = 50
+
+
+async def check_keys(keys, base_url=None):
+    """并发查询一批key的余额，返回与 keys 一一对应的 (状态, 余额或错误信息)
+
+    base_url 默认为各key所属上游的地址
+    """
+    semaphore = asyncio.Semaphore(REFRESH_CONCURRENCY)
+
+    async def check(key):
+        async with semaphore:
+            return await check_key_async(key, base_url)
+
+    return await asyncio.gather(*(check(key) for key in keys))
+
+
+async def refresh_key_set(keys):
+    """刷新一批key的余额，结果在一个事务中写入数据库
+
+    Returns:
+        (更新数, 其中余额用尽数, 删除数, 查询失败数)
+    """
+    results = await check_keys(keys)
+
+    balances = []
+    deleted = []
+    failed = []
+    zero_balance = 0
+    for key, (status, balance) in zip(keys, results):
+        if status == KEY_VALID:
+            balances.append((key, balance))
+            if float(balance) <= 0:
+                zero_balance += 1
+        elif status == KEY_INVALID:
+            deleted.append((key, pool.upstream_of(key), balance))
+        else:
+            failed.append(key)
+
+    apply_key_changes(balances, [key for key, _, _ in deleted])
+    invalid_keys.add(deleted)
+    # 暂时性故障的key只隔离不删除
+    for key in failed:
+        pool.quarantine(key)
+    return len(balances), zero_balance, len(deleted), len(failed)
+
+
 @router.post("/refresh")
 async def refresh_keys():
-    # 创建新的游标避免递归使用
-    local_cursor = conn.cursor()
+    # 在获取待筛选的key时仅获取余额大于0的key
+    all_keys = pool.filter_keys("positive")
 
-    try:
-        # 在获取待筛选的key时仅获取余额大于0的key
-        local_cursor.execute("SELECT key, balance FROM api_keys WHERE balance > 0")
-        key_balance_map = {row[0]: row[1] for row in local_cursor.fetchall()}
-        all_keys = list(key_balance_map.keys())
-
-        # 获取初始总余额
-        initial_balance = sum(key_balance_map.values())
-
-        # 创建并行验证任务
-        tasks = [validate_key_async(key) for key in all_keys]
-        results = await asyncio.gather(*tasks)
-
-        removed = 0
-        updated = 0
-        zero_balance = 0
-        for key, (valid, balance) in zip(all_keys, results):
-            if valid:
-                local_cursor.execute(
-                    "UPDATE api_keys SET balance = ? WHERE key = ?", (balance, key)
-                )
-                updated += 1
-                if float(balance) <= 0:
-                    zero_balance += 1
-            else:
-                local_cursor.execute("DELETE FROM api_keys WHERE key = ?", (key,))
-                removed += 1
+    # 获取初始总余额
+    cursor.execute("SELECT COALESCE(SUM(balance), 0) FROM api_keys WHERE balance > 0")
+    initial_balance = cursor.fetchone()[0]
+
+    updated, zero_balance, removed, failed = await refresh_key_set(all_keys)
+
+    # 计算新的总余额
+    cursor.execute("SELECT COALESCE(SUM(balance), 0) FROM api_keys WHERE balance > 0")
+    new_balance = cursor.fetchone()[0]
+    balance_change = new_balance - initial_balance
+
+    message = f"刷新完成，更新 {updated} 个 Key（其中 {zero_balance} 个余额用尽），移除 {removed} 个无效的 Key"
+    if failed > 0:
+        message += f"，{failed} 个 Key 查询失败已暂时隔离"
+    if balance_change > 0:
+        message += f"，余额增加了{round(balance_change, 2)}"
+    else:
+        balance_decrease = abs(balance_change)
+        message += f"，余额减少了{round(balance_decrease, 2)}"
+
+    return JSONResponse({"message": message})
 
-        conn.commit()
 
-        # 计算新的总余额
-        local_cursor.execute(
-            "SELECT COALESCE(SUM(balance), 0) FROM api_keys WHERE balance > 0"
+@router.post("/api/keys/bulk")
+async def bulk_keys(request: Request):
+    """对一批key批量执行 enable/disable/delete/refresh/set_tag/set_upstream
+
+    请求体中的 keys 指定具体的key；不提供时按 filter 筛选
+    （balance: all/positive/zero，tag，enabled，upstream）。
+    """
+    data = await request.json()
+    action = data.get("action")
+    if action not in ("enable", "disable", "delete", "refresh", "set_tag", "set_upstream"):
+        raise HTTPException(status_code=400, detail="无效的操作")
+
+    keys = data.get("keys")
+    if keys is not None:
+        keys = [k for k in dict.fromkeys(keys) if k in pool.states]
+    else:
+        key_filter = data.get("filter") or {}
+        balance_filter = key_filter.get("balance", "all")
+        if balance_filter not in ("all", "positive", "zero"):
+            raise HTTPException(status_code=400, detail="无效的余额筛选条件")
+        enabled = key_filter.get("enabled")
+        keys = pool.filter_keys(
+            balance_filter,
+            tag=key_filter.get("tag"),
+            enabled=None if enabled is None else bool(enabled),
+            upstream=key_filter.get("upstream"),
         )
-        new_balance = local_cursor.fetchone()[0]
-        balance_change = new_balance - initial_balance
 
+    if not keys:
+        return JSONResponse({"message": "没有符合条件的 Key", "count": 0})
+
+    try:
+        if action in ("enable", "disable"):
+            set_keys_enabled(keys, action == "enable")
+            status = "启用" if action == "enable" else "禁用"
+            return JSONResponse({"message": f"已{status} {len(keys)} 个 Key", "count": len(keys)})
+        if action == "delete":
+            apply_key_changes(deleted=keys)
+            return JSONResponse({"message": f"已删除 {len(keys)} 个 Key", "count": len(keys)})
+        if action == "set_tag":
+            tag = (data.get("tag") or "").strip()
+            set_keys_tag(keys, tag)
+            return JSONResponse({"message": f"已设置 {len(keys)} 个 Key 的标签", "count": len(keys)})
+        if action == "set_upstream":
+            upstream = (data.get("upstream") or "").strip()
+            if not providers.exists(upstream):
+                raise HTTPException(status_code=400, detail="未知的上游")
+            set_keys_upstream(keys, upstream)
+            return JSONResponse({"message": f"已设置 {len(keys)} 个 Key 的上游", "count": len(keys)})
+
+        updated, zero_balance, removed, failed = await refresh_key_set(keys)
         message = f"刷新完成，更新 {updated} 个 Key（其中 {zero_balance} 个余额用尽），移除 {removed} 个无效的 Key"
-        if balance_change > 0:
-            message += f"，余额增加了{round(balance_change, 2)}"
-        else:
-            balance_decrease = abs(balance_change)
-            message += f"，余额减少了{round(balance_decrease, 2)}"
+        if failed > 0:
+            message += f"，{failed} 个 Key 查询失败已暂时隔离"
+        return JSONResponse({"message": message, "count": len(keys)})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"批量操作失败: {str(e)}")
+
+
+# 流式导出时每次从数据库读取的行数
+EXPORT_BATCH_SIZE = 1000
 
-        return JSONResponse({"message": message})
+EXPORT_FILENAMES = {
+    "line": "keys.txt",
+    "line_with_balance": "keys.txt",
+    "csv": "keys.txt",
+    "csv_table": "keys.csv",
+    "jsonl": "keys.jsonl",
+}
+
+
+def iter_export(format: str, sql: str):
+    """分批读取数据库并逐块生成导出内容，不在内存中拼接全部key"""
+    # 使用独立游标，避免与其他请求共用的游标互相干扰
+    local_cursor = conn.cursor()
+    try:
+        local_cursor.execute(sql)
+        first = True
+        if format == "csv_table":
+            yield "key,balance,usage_count,enabled,tag,add_time\n"
+        while True:
+            rows = local_cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            if format == "line_with_balance":
+                lines = [f"{row[0]} (余额: ¥{row[1]:.2f})" for row in rows]
+            elif format == "csv_table":
+                buffer = io.StringIO()
+                csv.writer(buffer, lineterminator="\n").writerows(rows)
+                yield buffer.getvalue()
+                continue
+            elif format == "jsonl":
+                yield "".join(
+                    json.dumps(
+                        {
+                            "key": row[0],
+                            "balance": row[1],
+                            "usage_count": row[2],
+                            "enabled": bool(row[3]),
+                            "tag": row[4] or "",
+                            "add_time": row[5],
+                        },
+                        ensure_ascii=False,
+                    )
+                    + "\n"
+                    for row in rows
+                )
+                continue
+            else:
+                lines = [row[0] for row in rows]
+            separator = "," if format == "csv" else "\n"
+            chunk = separator.join(lines)
+            yield chunk if first else separator + chunk
+            first = False
     finally:
-        # 确保游标被关闭
         local_cursor.close()
 
 
@@ -240,6 +553,9 @@ async def refresh_keys():
 async def export_keys(
     format: str = "line", sort: str = "balance_desc", filter: str = "all"
 ):
+    if format not in EXPORT_FILENAMES:
+        raise HTTPException(status_code=400, detail="无效的导出格式")
+
     # 根据排序方式构建SQL语句
     sort_sql = ""
     if sort == "balance_desc":
@@ -258,46 +574,21 @@ async def export_keys(
     elif filter == "zero":
         filter_sql = "WHERE balance <= 0"
 
-    # 执行查询
-    cursor.execute(f"SELECT key, balance FROM api_keys {filter_sql} {sort_sql}")
-    all_keys = cursor.fetchall()
-
-    # 根据格式生成导出内容
-    content = ""
-    if format == "line":
-        content = "\n".join(row[0] for row in all_keys)
-    elif format == "line_with_balance":
-        content = "\n".join(f"{row[0]} (余额: ¥{row[1]:.2f})" for row in all_keys)
-    elif format == "csv":
-        content = ",".join(row[0] for row in all_keys)
-
-    headers = {"Content-Disposition": "attachment; filename=keys.txt"}
-    return Response(content=content, media_type="text/plain", headers=headers)
+    sql = f"SELECT key, balance, usage_count, enabled, tag, add_time FROM api_keys {filter_sql} {sort_sql}"
+    media_type = {"csv_table": "text/csv", "jsonl": "application/x-ndjson"}.get(
+        format, "text/plain"
+    )
+    headers = {"Content-Disposition": f"attachment; filename={EXPORT_FILENAMES[format]}"}
+    # 同步生成器由 Starlette 放到线程池中迭代，不会阻塞事件循环
+    return StreamingResponse(
+        iter_export(format, sql), media_type=media_type, headers=headers
+    )
 
 
 @router.get("/stats")
 async def stats():
-    # Get count and total balance of keys with positive balance
-    cursor.execute(
-        "SELECT COUNT(*), COALESCE(SUM(balance), 0) FROM api_keys WHERE balance > 0"
-    )
-    positive_count, total_balance = cursor.fetchone()
-
-    # Get count of keys with zero balance
-    cursor.execute("SELECT COUNT(*) FROM api_keys WHERE balance <= 0")
-    zero_balance_count = cursor.fetchone()[0]
-
-    # Get total key count
-    total_key_count = positive_count + zero_balance_count
-
-    return JSONResponse(
-        {
-            "total_key_count": total_key_count,
-            "positive_balance_count": positive_count,
-            "zero_balance_count": zero_balance_count,
-            "total_balance": total_balance,
-        }
-    )
+    # 汇总计数在密钥池中增量维护，无需每次扫描数据库
+    return JSONResponse(pool.get_summary())
 
 
 # CORS预检请求处理
@@ -0,0 +1,76 @@
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.requests import ClientDisconnect
+import batch_jobs
+from routers.generate import check_api_key
+
+router = APIRouter()
+
+# 下载结果文件时每次读取的字节数
+OUTPUT_CHUNK_SIZE = 64 * 1024
+
+
+def _get_job(request: Request, batch_id: str):
+    check_api_key(request)
+    job = batch_jobs.get(batch_id, request.state.client_token)
+    if job is None:
+        raise HTTPException(status_code=404, detail="批量任务不存在")
+    return job
+
+
+@router.post("/v1/batches")
+async def create_batch(request: Request):
+    """上传 JSONL 请求文件（请求体即文件内容）创建批量任务，后台处理"""
+    free_token = check_api_key(request)
+    try:
+        raw = await request.body()
+    except ClientDisconnect:
+        return JSONResponse({"error": "客户端断开连接"}, status_code=499)
+    job = batch_jobs.create(raw, request.state.client_token, free_token)
+    return JSONResponse(job.to_dict())
+
+
+@router.get("/v1/batches")
+async def list_batches(request: Request):
+    check_api_key(request)
+    jobs = batch_jobs.list_jobs(request.state.client_token)
+    return JSONResponse({"object": "list", "data": [job.to_dict() for job in jobs]})
+
+
+@router.get("/v1/batches/{batch_id}")
+async def get_batch(request: Request, batch_id: str):
+    """任务状态与进度"""
+    return JSONResponse(_get_job(request, batch_id).to_dict())
+
+
+@router.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(request: Request, batch_id: str):
+    job = _get_job(request, batch_id)
+    batch_jobs.cancel(job)
+    return JSONResponse(job.to_dict())
+
+
+@router.get("/v1/batches/{batch_id}/output")
+async def get_batch_output(request: Request, batch_id: str):
+    """下载结果文件，任务进行中时返回已完成的部分"""
+    job = _get_job(request, batch_id)
+    # 结果文件仍在追加，只发送请求时已写入的部分
+    size = batch_jobs.output_size(job)
+
+    def iter_output():
+        if not size:
+            return
+        with open(job.output_file, "rb") as f:
+            remaining = size
+            while remaining > 0:
+                chunk = f.read(min(OUTPUT_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    return StreamingResponse(
+        iter_output(),
+        media_type="application/jsonl",
+        headers={"Content-Disposition": f'attachment; filename="{job.id}_output.jsonl"'},
+    )
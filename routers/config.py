@@ -3,15 +3,16 @@ from fastapi.responses import JSONResponse
 import json
 from pathlib import Path
 from typing import Dict, Any
-import threading
 import asyncio
 import logging
+import config as runtime_config
+import free_models
 from routers.api_keys import refresh_keys
 
 router = APIRouter()
 config_file = Path("config.json")
-scheduler_thread = None
-stop_event = threading.Event()
+# 自动刷新任务，运行在主事件循环上
+scheduler_task = None
 
 # 初始化配置
 default_config = {
@@ -19,14 +20,11 @@ default_config = {
     "custom_api_key": "",
     "free_model_api_key": "",
     "refresh_interval": 0,  # 单位: 分钟，0表示不自动刷新
+    "free_model_routing": True,
+    "free_models": [],
+    "free_models_refresh_interval": 60,  # 单位: 分钟
 }
 
-# 确保配置文件存在
-if not config_file.exists():
-    with open(config_file, "w", encoding="utf-8") as f:
-        json.dump(default_config, f, ensure_ascii=False, indent=4)
-
-
 # 读取配置
 def read_config() -> Dict[str, Any]:
     try:
@@ -53,7 +51,7 @@ def write_config(config: Dict[str, Any]):
 
 # 刷新定时任务函数
 async def refresh_task():
-    while not stop_event.is_set():
+    while True:
         config = read_config()
         interval = config.get("refresh_interval", 0)
 
@@ -64,11 +62,8 @@ async def refresh_task():
                 logging.debug(f"自动刷新API密钥任务完成，等待{interval}分钟后再次执行")
             except Exception as e:
                 logging.error(f"自动刷新API密钥任务失败: {str(e)}")
-                
-            for _ in range(interval * 60):  # 将分钟转换为秒
-                if stop_event.is_set():
-                    break
-                await asyncio.sleep(1)
+
+            await asyncio.sleep(interval * 60)  # 将分钟转换为秒
         else:
             # 如果间隔为0，则休眠一段时间后再次检查配置
             await asyncio.sleep(60)
@@ -76,34 +71,27 @@ async def refresh_task():
 
 # 启动定时任务
 def start_scheduler():
-    global scheduler_thread, stop_event
-    if scheduler_thread and scheduler_thread.is_alive():
-        return
-
-    stop_event.clear()
+    """在当前事件循环中启动自动刷新
 
-    def run_async_task():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(refresh_task())
+    刷新与转发请求共用绑定在主事件循环上的上游会话，因此不能放到单独的线程和事件循环中运行。
+    """
+    global scheduler_task
+    if scheduler_task is not None and not scheduler_task.done():
+        return
 
-    scheduler_thread = threading.Thread(target=run_async_task)
-    scheduler_thread.daemon = True
-    scheduler_thread.start()
+    scheduler_task = asyncio.get_running_loop().create_task(refresh_task())
     logging.info("API密钥自动刷新任务已启动")
 
 
 # 停止定时任务
 def stop_scheduler():
-    global stop_event
-    stop_event.set()
+    global scheduler_task
+    if scheduler_task is not None:
+        scheduler_task.cancel()
+        scheduler_task = None
     logging.info("API密钥自动刷新任务已停止")
 
 
-# 在应用启动时启动定时任务
-start_scheduler()
-
-
 @router.get("/config/strategy")
 async def get_strategy():
     config = read_config()
@@ -123,6 +111,10 @@ async def update_strategy(request: Request):
         "most_used",
         "oldest",
         "newest",
+        "weighted",
+        "least_inflight",
+        "p2c",
+        "swrr",
     ]
 
     if strategy not in allowed_strategies:
@@ -132,6 +124,9 @@ async def update_strategy(request: Request):
     config["call_strategy"] = strategy
     write_config(config)
 
+    # 立即生效，无需重启
+    runtime_config.CALL_STRATEGY = strategy
+
     return JSONResponse({"message": f"调用策略已更新为: {strategy}"})
 
 
@@ -202,3 +197,53 @@ async def update_refresh_interval(request: Request):
         return JSONResponse({"message": f"自动刷新间隔已设置为 {interval} 分钟"})
     else:
         return JSONResponse({"message": "已关闭自动刷新"})
+
+
+@router.get("/config/free_models")
+async def get_free_models():
+    config = read_config()
+    status = free_models.get_free_models_status()
+    return JSONResponse(
+        {
+            "free_model_routing": config.get("free_model_routing", True),
+            "custom_free_models": config.get("free_models", []),
+            "free_models_refresh_interval": config.get("free_models_refresh_interval", 60),
+            **status,
+        }
+    )
+
+
+@router.post("/config/free_models")
+async def update_free_models(request: Request):
+    data = await request.json()
+    enabled = data.get("free_model_routing", True)
+    models = data.get("free_models", [])
+
+    if not isinstance(models, list) or not all(isinstance(m, str) for m in models):
+        return JSONResponse({"message": "免费模型列表格式错误"}, status_code=400)
+    models = [m.strip() for m in models if m.strip()]
+    interval = data.get("free_models_refresh_interval", runtime_config.FREE_MODELS_REFRESH_INTERVAL)
+    if not isinstance(interval, int) or interval < 1:
+        return JSONResponse({"message": "模型列表刷新间隔必须是正整数"}, status_code=400)
+
+    config = read_config()
+    config["free_model_routing"] = bool(enabled)
+    config["free_models"] = models
+    config["free_models_refresh_interval"] = interval
+    write_config(config)
+
+    # 立即生效，无需重启；刷新间隔在下一次刷新后生效
+    runtime_config.FREE_MODEL_ROUTING = bool(enabled)
+    runtime_config.FREE_MODELS = models
+    runtime_config.FREE_MODELS_REFRESH_INTERVAL = interval
+
+    if enabled:
+        return JSONResponse({"message": "免费模型自动路由已开启"})
+    else:
+        return JSONResponse({"message": "免费模型自动路由已关闭"})
+
+
+@router.post("/config/free_models/refresh")
+async def refresh_free_models():
+    await free_models.refresh_free_models()
+    return JSONResponse({"message": "免费模型列表已刷新", **free_models.get_free_models_status()})
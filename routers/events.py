@@ -0,0 +1,48 @@
+import asyncio
+import json
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import StreamingResponse
+import events
+import lifecycle
+from key_pool import pool
+from routers.auth import validate_session
+
+router = APIRouter()
+
+# 没有事件时发送心跳的间隔(秒)，防止代理断开空闲连接
+HEARTBEAT_INTERVAL = 15
+
+
+@router.get("/api/events")
+async def stream_events(request: Request):
+    """管理页面的实时事件流（SSE）
+
+    事件类型: stats(密钥池汇总)、log(新的调用日志)、key(单个key状态变化)、
+    keys_changed(批量操作)、resync(积压过多，需重新加载)
+    """
+    if not validate_session(request):
+        raise HTTPException(status_code=401, detail="未认证")
+
+    queue = events.broker.subscribe()
+
+    async def generate():
+        try:
+            summary = json.dumps(pool.get_summary(), ensure_ascii=False)
+            yield f"event: stats\ndata: {summary}\n\n"
+            while not lifecycle.state.draining:
+                try:
+                    message = await asyncio.wait_for(queue.get(), HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": ping\n\n"
+                    continue
+                yield message
+        finally:
+            events.broker.unsubscribe(queue)
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
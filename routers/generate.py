@@ -4,52 +4,343 @@ from starlette.requests import ClientDisconnect
 import config
 import json
 import time
-import aiohttp
-from db import conn, cursor, log_completion
+import asyncio
+import free_models
+import client_tokens
+import upstream
+import providers
+import hedging
+import fanout
+import batcher
+import admission
+from stream_relay import StreamStats, relay_events, inject_include_usage
+from token_estimator import estimate_prompt_tokens
+from db import increment_key_usage, log_completion
+from key_pool import pool
 from utils import select_api_key, check_and_remove_key
 
 router = APIRouter()
 
-# API基础URL
-BASE_URL = "https://api.siliconflow.cn"
 
+def check_api_key(request: Request, allow_free_token: bool = True) -> bool:
+    """校验客户端提供的token，返回是否使用了免费模型专用token
 
-@router.post("/v1/chat/completions")
-async def chat_completions(request: Request, background_tasks: BackgroundTasks):
-    # 检查是否应该使用余额为0的key
-    use_zero_balance = False
-    if config.FREE_MODEL_API_KEY and config.FREE_MODEL_API_KEY.strip():
-        request_api_key = request.headers.get("Authorization", "")
+    匹配到客户端token时保存到 request.state.client_token，供配额检查和用量统计使用
+    """
+    request_api_key = request.headers.get("Authorization", "")
+    client = client_tokens.lookup(request_api_key)
+    request.state.client_token = client
+    if client is not None:
+        return False
+
+    if allow_free_token and config.FREE_MODEL_API_KEY and config.FREE_MODEL_API_KEY.strip():
         if request_api_key == f"Bearer {config.FREE_MODEL_API_KEY}":
-            use_zero_balance = True
+            return True
 
-    # 如果不使用余额为0的key，检查自定义API KEY
-    if not use_zero_balance and config.CUSTOM_API_KEY and config.CUSTOM_API_KEY.strip():
-        request_api_key = request.headers.get("Authorization")
+    if config.CUSTOM_API_KEY and config.CUSTOM_API_KEY.strip():
         if request_api_key != f"Bearer {config.CUSTOM_API_KEY}":
             raise HTTPException(status_code=403, detail="无效的API_KEY")
-
-    cursor.execute("SELECT key, balance FROM api_keys WHERE enabled = 1")
-    keys_with_balance = cursor.fetchall()
-    if not keys_with_balance:
+    return False
+
+
+def pick_api_key(model: str, free_token: bool = False, client=None):
+    """为请求选择API密钥，返回 (密钥, 是否为余额为0的密钥)
+
+    使用免费模型专用token时只使用余额为0的key；否则免费模型优先使用余额为0的key，
+    没有可用的余额为0的key时再使用有余额的key。
+    使用客户端token时先检查模型权限与配额，并只从该token的key子池中选择。
+    """
+    tag = None
+    if client is not None:
+        denied = client_tokens.check_quota(client, model)
+        if denied:
+            status_code, message, retry_after = denied
+            headers = {"Retry-After": str(retry_after)} if retry_after else None
+            raise HTTPException(status_code=status_code, detail=message, headers=headers)
+        tag = client.key_tag or None
+
+    if not pool.states:
         raise HTTPException(status_code=500, detail="没有可用的api-key")
 
-    selected = select_api_key(keys_with_balance, use_zero_balance)
-    if not selected:
-        if use_zero_balance:
+    if free_token:
+        selected = select_api_key(use_zero_balance=True, model=model)
+        if not selected:
             raise HTTPException(status_code=500, detail="没有余额为0的可用api-key")
-        else:
-            raise HTTPException(status_code=500, detail="没有可用的api-key")
+        return selected, True
 
-    # 增加使用计数
-    cursor.execute(
-        "UPDATE api_keys SET usage_count = usage_count + 1 WHERE key = ?", (selected,)
+    if config.FREE_MODEL_ROUTING and free_models.is_free(model):
+        selected = select_api_key(use_zero_balance=True, tag=tag, model=model)
+        if selected:
+            return selected, True
+
+    selected = select_api_key(tag=tag, model=model)
+    if not selected:
+        raise HTTPException(status_code=500, detail="没有可用的api-key")
+    return selected, False
+
+
+def pick_backup_key(model: str, zero_balance: bool, client, exclude: str = None):
+    """从首选key所在的子池中再选择一个与 exclude 不同的key，用于对冲和分块请求，没有时返回 None"""
+    tag = client.key_tag or None if client is not None else None
+    for _ in range(3):
+        selected = select_api_key(use_zero_balance=zero_balance, tag=tag, model=model)
+        if selected and selected != exclude:
+            return selected
+    return None
+
+
+async def post_json(selected: str, path: str, forward_headers: dict, req_body: bytes, timeout: int):
+    """用指定的key转发非流式请求，返回 (状态码, 响应JSON)
+
+    请求被取消（客户端断开或对冲请求中落败）时不计入key的失败
+    """
+    headers = dict(forward_headers)
+    headers["Authorization"] = f"Bearer {selected}"
+    async with pool.lease(selected) as lease:
+        try:
+            async with upstream.get_session().post(
+                f"{providers.base_url_of(selected)}{path}",
+                headers=headers,
+                data=req_body,
+                timeout=timeout,
+            ) as resp:
+                lease.record(resp.status)
+                return resp.status, await resp.json()
+        except asyncio.CancelledError:
+            lease.discard()
+            raise
+
+
+async def forward_chunks(
+    endpoint: str,
+    path: str,
+    bodies: list,
+    selected: str,
+    forward_headers: dict,
+    timeout: int,
+    model: str,
+    zero_balance: bool,
+    client,
+):
+    """把拆分后的请求并发发送到同一子池的多个key，每个分块使用的key都计入使用次数（包括 selected）
+
+    Returns:
+        (状态码, 失败分块的响应或 None, [(key, 状态码, 响应) 或 None, ...])
+    """
+    # 分块的请求体长度与原请求不同
+    headers = {k: v for k, v in forward_headers.items() if k.lower() != "content-length"}
+
+    def chunk_call(index: int, body: bytes):
+        async def call():
+            # 第一个分块使用已选定的key，其余分块在发送时再选择，使负载分散到多个key
+            key = selected
+            if index:
+                key = pick_backup_key(model, zero_balance, client) or selected
+            increment_key_usage(key)
+
+            async def send(k):
+                return await post_json(k, path, headers, body, timeout)
+
+            return await hedging.run(
+                endpoint, key, send, lambda: pick_backup_key(model, zero_balance, client, key)
+            )
+
+        return call
+
+    return await fanout.dispatch([chunk_call(i, body) for i, body in enumerate(bodies)])
+
+
+# 批量任务支持的接口: 路径 -> (日志中的接口名, 超时)
+BATCH_ENDPOINTS = {
+    "/v1/chat/completions": ("chat_completions", 1800),
+    "/v1/completions": ("completions", 1800),
+    "/v1/embeddings": ("embeddings", 30),
+}
+
+
+async def forward_offline(path: str, req_json: dict, free_token: bool = False, client=None):
+    """转发批量任务中的一个请求（总是非流式）并记录用量，返回 (状态码, 响应JSON)
+
+    批量任务不经过 AdmissionMiddleware，这里以最低优先级占用准入名额，交互请求排队时先放行交互请求。
+    配额不足、没有可用key或准入排队失败时抛出 HTTPException，由调用方决定是否重试
+    """
+    client_id = f"batch:{client.token_hash if client is not None else ''}"
+    try:
+        await admission.controller.acquire(client_id, admission.PRIORITIES["low"])
+    except admission.AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=e.message, headers={"Retry-After": str(e.retry_after)})
+    start = time.monotonic()
+    try:
+        return await _forward_offline(path, req_json, free_token, client)
+    finally:
+        admission.controller.release(time.monotonic() - start)
+
+
+async def _forward_offline(path: str, req_json: dict, free_token: bool, client):
+    endpoint, timeout = BATCH_ENDPOINTS[path]
+    req_json = {k: v for k, v in req_json.items() if k not in ("stream", "stream_options")}
+    model = req_json.get("model", "unknown")
+    call_time_stamp = time.time()
+
+    selected, zero_balance = pick_api_key(model, free_token, client)
+    increment_key_usage(selected)
+
+    status, data = await post_json(
+        selected,
+        path,
+        {"Content-Type": "application/json"},
+        json.dumps(req_json).encode(),
+        timeout,
+    )
+    if zero_balance:
+        free_models.record_result(model, status, data)
+    usage = (data.get("usage") if isinstance(data, dict) else None) or {}
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    log_completion(
+        selected,
+        model,
+        call_time_stamp,
+        prompt_tokens,
+        completion_tokens,
+        usage.get("total_tokens", prompt_tokens + completion_tokens),
+        endpoint,
     )
-    conn.commit()
+    client_tokens.record_usage(client, prompt_tokens, completion_tokens)
+    # 批量任务的请求很多，只在出错时检查key余额
+    if status != 200:
+        await check_and_remove_key(selected)
+    return status, data
+
+
+# 流式转发时检查客户端是否断开的间隔(秒)
+DISCONNECT_POLL_INTERVAL = 0.5
+
+# 流式响应头，禁止中间代理缓冲
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+async def watch_disconnect(request: Request, resp, cancelled: asyncio.Event):
+    """客户端断开时关闭上游响应，让转发循环尽快退出并释放连接"""
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+    cancelled.set()
+    resp.close()
+
+
+async def relay_stream(
+    request: Request,
+    path: str,
+    endpoint: str,
+    timeout: int,
+    forward_headers: dict,
+    req_body: bytes,
+    selected: str,
+    model: str,
+    call_time_stamp: float,
+    zero_balance: bool,
+    client,
+    strip_usage: bool = False,
+):
+    """将上游的流式响应按 SSE 事件转发给客户端
+
+    上游与客户端之间有有界缓冲，客户端读得慢时暂停读取上游；
+    客户端中途断开时立即中止上游请求，并以 client_cancelled 状态记录已产生的用量。
+    上游没有返回 usage 时按请求和生成的文本估算，并在日志中标记为估算值
+    """
+    stats = StreamStats()
+    status = None
+    cancelled = asyncio.Event()
+    watcher = None
 
-    # 使用选定的key转发请求到BASE_URL
-    forward_headers = dict(request.headers)
-    forward_headers["Authorization"] = f"Bearer {selected}"
+    try:
+        async with pool.lease(selected) as lease:
+            async with upstream.get_session().post(
+                f"{providers.base_url_of(selected)}{path}",
+                headers=forward_headers,
+                data=req_body,
+                timeout=timeout,
+            ) as resp:
+                lease.record(resp.status)
+                if resp.status != 200:
+                    # 上游返回的错误不是事件流，原样转发，也不估算用量
+                    stats.text = None
+                    error_body = await resp.read()
+                    if zero_balance:
+                        try:
+                            error_json = json.loads(error_body)
+                        except ValueError:
+                            error_json = None
+                        free_models.record_result(model, resp.status, error_json)
+                    yield error_body
+                else:
+                    if zero_balance:
+                        free_models.record_result(model, resp.status)
+                    watcher = asyncio.create_task(watch_disconnect(request, resp, cancelled))
+                    try:
+                        async for data in relay_events(
+                            resp.content, stats, strip_usage=strip_usage
+                        ):
+                            yield data
+                    except (asyncio.CancelledError, GeneratorExit):
+                        # 客户端断开，不计入key的成功或失败
+                        lease.discard()
+                        raise
+                    except Exception:
+                        # 上游连接是因客户端断开而被主动关闭的
+                        if not cancelled.is_set():
+                            raise
+                    if cancelled.is_set():
+                        lease.discard()
+        status = "client_cancelled" if cancelled.is_set() else "success"
+
+    except (asyncio.CancelledError, GeneratorExit):
+        status = "client_cancelled"
+        raise
+    except Exception as e:
+        if cancelled.is_set():
+            status = "client_cancelled"
+        else:
+            error_json = json.dumps({"error": f"请求失败: {str(e)}"}, ensure_ascii=False)
+            yield f"data: {error_json}\n\n".encode("utf-8")
+            yield b"data: [DONE]\n\n"
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        if status is not None:
+            stats.finish()
+            usage = stats.usage or {}
+            prompt_tokens = usage.get("prompt_tokens", 0)
+            completion_tokens = usage.get("completion_tokens", 0)
+            total_tokens = usage.get("total_tokens", 0)
+            usage_estimated = False
+            if not stats.usage and stats.text is not None:
+                prompt_tokens = estimate_prompt_tokens(req_body)
+                completion_tokens = stats.text.tokens()
+                total_tokens = prompt_tokens + completion_tokens
+                usage_estimated = True
+            # 流结束（或客户端中途断开）后记录token数量
+            log_completion(
+                selected,
+                model,
+                call_time_stamp,
+                prompt_tokens,
+                completion_tokens,
+                total_tokens,
+                endpoint,
+                status,
+                usage_estimated,
+            )
+            client_tokens.record_usage(client, prompt_tokens, completion_tokens)
+
+    if status == "success":
+        await check_and_remove_key(selected)
+
+
+@router.post("/v1/chat/completions")
+async def chat_completions(request: Request, background_tasks: BackgroundTasks):
+    free_token = check_api_key(request)
+    client = request.state.client_token
 
     try:
         req_body = await request.body()
@@ -59,76 +350,56 @@ async def chat_completions(request: Request, background_tasks: BackgroundTasks):
     req_json = await request.json()
     model = req_json.get("model", "unknown")
     call_time_stamp = time.time()
-    is_stream = req_json.get("stream", False)
 
-    if is_stream:
+    selected, zero_balance = pick_api_key(model, free_token, client)
 
-        async def generate_stream():
-            completion_tokens = 0
-            prompt_tokens = 0
-            total_tokens = 0
-
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        f"{BASE_URL}/v1/chat/completions",
-                        headers=forward_headers,
-                        data=req_body,
-                        timeout=1800,
-                    ) as resp:
-                        async for chunk in resp.content.iter_any():
-                            try:
-                                chunk_str = chunk.decode("utf-8")
-                                if chunk_str == "[DONE]":
-                                    continue
-                                if chunk_str.startswith("data: "):
-                                    data = json.loads(chunk_str[6:])
-                                    usage = data.get("usage", {})
-                                    prompt_tokens = usage.get("prompt_tokens", 0)
-                                    completion_tokens = usage.get(
-                                        "completion_tokens", 0
-                                    )
-                                    total_tokens = usage.get("total_tokens", 0)
-                            except Exception:
-                                pass
-                            yield chunk
-
-                # 流结束后记录完整token数量
-                log_completion(
-                    selected,
-                    model,
-                    call_time_stamp,
-                    prompt_tokens,
-                    completion_tokens,
-                    total_tokens,
-                    "chat_completions",
-                )
-                await check_and_remove_key(selected)
+    # 增加使用计数
+    increment_key_usage(selected)
 
-            except Exception as e:
-                error_json = json.dumps({"error": f"请求失败: {str(e)}"}).encode(
-                    "utf-8"
-                )
-                yield f"data: {error_json}\n\n".encode("utf-8")
-                yield b"data: [DONE]\n\n"
+    # 使用选定的key转发请求到key所属的上游
+    forward_headers = dict(request.headers)
+    forward_headers["Authorization"] = f"Bearer {selected}"
+    is_stream = req_json.get("stream", False)
 
+    if is_stream:
+        # 让上游在最后返回 usage，客户端没有要求时再把这个事件去掉
+        req_body, strip_usage = inject_include_usage(req_body)
+        if strip_usage:
+            forward_headers.pop("content-length", None)
         try:
             return StreamingResponse(
-                generate_stream(),
-                headers={"Content-Type": "application/octet-stream"},
+                relay_stream(
+                    request,
+                    "/v1/chat/completions",
+                    "chat_completions",
+                    1800,
+                    forward_headers,
+                    req_body,
+                    selected,
+                    model,
+                    call_time_stamp,
+                    zero_balance,
+                    client,
+                    strip_usage,
+                ),
+                media_type="text/event-stream",
+                headers=SSE_HEADERS,
             )
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
     else:
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{BASE_URL}/v1/chat/completions",
+            async with pool.lease(selected) as lease:
+                async with upstream.get_session().post(
+                    f"{providers.base_url_of(selected)}/v1/chat/completions",
                     headers=forward_headers,
                     data=req_body,
                     timeout=1800,
                 ) as resp:
+                    lease.record(resp.status)
                     resp_json = await resp.json()
+                    if zero_balance:
+                        free_models.record_result(model, resp.status, resp_json)
                     usage = resp_json.get("usage", {})
                     prompt_tokens = usage.get("prompt_tokens", 0)
                     completion_tokens = usage.get("completion_tokens", 0)
@@ -144,6 +415,7 @@ async def chat_completions(request: Request, background_tasks: BackgroundTasks):
                         total_tokens,
                         "chat_completions",
                     )
+                    client_tokens.record_usage(client, prompt_tokens, completion_tokens)
 
                     # 后台检查key余额
                     background_tasks.add_task(check_and_remove_key, selected)
@@ -154,104 +426,103 @@ async def chat_completions(request: Request, background_tasks: BackgroundTasks):
 
 @router.post("/v1/embeddings")
 async def embeddings(request: Request, background_tasks: BackgroundTasks):
-    # 检查是否应该使用余额为0的key
-    use_zero_balance = False
-    if config.FREE_MODEL_API_KEY and config.FREE_MODEL_API_KEY.strip():
-        request_api_key = request.headers.get("Authorization", "")
-        if request_api_key == f"Bearer {config.FREE_MODEL_API_KEY}":
-            use_zero_balance = True
+    free_token = check_api_key(request)
+    client = request.state.client_token
 
-    # 如果不使用余额为0的key，检查自定义API KEY
-    if not use_zero_balance and config.CUSTOM_API_KEY and config.CUSTOM_API_KEY.strip():
-        request_api_key = request.headers.get("Authorization")
-        if request_api_key != f"Bearer {config.CUSTOM_API_KEY}":
-            raise HTTPException(status_code=403, detail="无效的API_KEY")
+    try:
+        req_body = await request.body()
+    except ClientDisconnect:
+        return JSONResponse({"error": "客户端断开连接"}, status_code=499)
 
-    cursor.execute("SELECT key, balance FROM api_keys WHERE enabled = 1")
-    keys_with_balance = cursor.fetchall()
-    if not keys_with_balance:
-        raise HTTPException(status_code=500, detail="没有可用的api-key")
+    req_json = await request.json()
+    model = req_json.get("model", "unknown")
 
-    selected = select_api_key(keys_with_balance, use_zero_balance)
-    if not selected:
-        if use_zero_balance:
-            raise HTTPException(status_code=500, detail="没有余额为0的可用api-key")
-        else:
-            raise HTTPException(status_code=500, detail="没有可用的api-key")
+    selected, zero_balance = pick_api_key(model, free_token, client)
 
     forward_headers = dict(request.headers)
-    forward_headers["Authorization"] = f"Bearer {selected}"
 
+    async def send(key):
+        return await post_json(key, "/v1/embeddings", forward_headers, req_body, 30)
+
+    chunks = fanout.embedding_chunks(req_json)
+    batched = False
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{BASE_URL}/v1/embeddings",
-                headers=forward_headers,
-                data=await request.body(),
-                timeout=30,
-            ) as resp:
-                data = await resp.json()
-                # 记录嵌入调用
-                req_json = await request.json()
-                model = req_json.get("model", "unknown")
-                resp_json = await resp.json()
-                usage = resp_json.get("usage", {})
-                prompt_tokens = usage.get("prompt_tokens", 0)
-                call_time_stamp = time.time()
+        if chunks is None and batcher.batchable(req_json):
+            # 与同一子池的其他小请求合并成一次上游调用
+            batch_headers = {k: v for k, v in forward_headers.items() if k.lower() != "content-length"}
 
-                log_completion(
-                    selected,
-                    model,
-                    call_time_stamp,
-                    prompt_tokens,
-                    0,
-                    prompt_tokens,
+            async def send_batch(key, body):
+                async def send_one(k):
+                    return await post_json(k, "/v1/embeddings", batch_headers, body, 30)
+
+                return await hedging.run(
+                    "embeddings", key, send_one, lambda: pick_backup_key(model, zero_balance, client, key)
+                )
+
+            tag = client.key_tag if client is not None else None
+            parts = [await batcher.submit((zero_balance, tag), req_json, selected, send_batch)]
+            _, status, data = parts[0]
+            batched = True
+        elif chunks is None:
+            # 开启对冲时，超过近期 p95 仍未返回会用另一个key再发一次
+            parts = [
+                await hedging.run(
                     "embeddings",
+                    selected,
+                    send,
+                    lambda: pick_backup_key(model, zero_balance, client, selected),
                 )
+            ]
+            _, status, data = parts[0]
+        else:
+            # input 很多时拆分后并发发送到多个key，再按原顺序合并
+            status, data, results = await forward_chunks(
+                "embeddings",
+                "/v1/embeddings",
+                [body for body, _ in chunks],
+                selected,
+                forward_headers,
+                30,
+                model,
+                zero_balance,
+                client,
+            )
+            parts = [part for part in results if part is not None and part[1] == 200]
+            if status == 200:
+                data = fanout.merge_embeddings([part[2] for part in parts], [size for _, size in chunks])
+        if zero_balance:
+            free_models.record_result(model, status, data)
+        # 记录嵌入调用，分块请求按各分块使用的key分别记录
+        call_time_stamp = time.time()
+        total_prompt_tokens = 0
+        for key, _, resp_json in parts:
+            usage = resp_json.get("usage") or {}
+            prompt_tokens = usage.get("prompt_tokens", 0)
+            total_prompt_tokens += prompt_tokens
+            log_completion(
+                key,
+                model,
+                call_time_stamp,
+                prompt_tokens,
+                0,
+                prompt_tokens,
+                "embeddings",
+            )
+        client_tokens.record_usage(client, total_prompt_tokens, 0)
 
-                # 后台检查key余额
-                background_tasks.add_task(check_and_remove_key, selected)
-                return JSONResponse(content=data, status_code=resp.status)
+        # 后台检查key余额，合并发送的批次由 batcher 在每次上游调用后检查一次
+        if not batched:
+            for key in dict.fromkeys(part[0] for part in parts):
+                background_tasks.add_task(check_and_remove_key, key)
+        return JSONResponse(content=data, status_code=status)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
 
 
 @router.post("/v1/completions")
 async def completions(request: Request, background_tasks: BackgroundTasks):
-    # 检查是否应该使用余额为0的key
-    use_zero_balance = False
-    if config.FREE_MODEL_API_KEY and config.FREE_MODEL_API_KEY.strip():
-        request_api_key = request.headers.get("Authorization", "")
-        if request_api_key == f"Bearer {config.FREE_MODEL_API_KEY}":
-            use_zero_balance = True
-
-    # 如果不使用余额为0的key，检查自定义API KEY
-    if not use_zero_balance and config.CUSTOM_API_KEY and config.CUSTOM_API_KEY.strip():
-        request_api_key = request.headers.get("Authorization")
-        if request_api_key != f"Bearer {config.CUSTOM_API_KEY}":
-            raise HTTPException(status_code=403, detail="无效的API_KEY")
-
-    cursor.execute("SELECT key, balance FROM api_keys WHERE enabled = 1")
-    keys_with_balance = cursor.fetchall()
-    if not keys_with_balance:
-        raise HTTPException(status_code=500, detail="没有可用的api-key")
-
-    selected = select_api_key(keys_with_balance, use_zero_balance)
-    if not selected:
-        if use_zero_balance:
-            raise HTTPException(status_code=500, detail="没有余额为0的可用api-key")
-        else:
-            raise HTTPException(status_code=500, detail="没有可用的api-key")
-
-    # 增加使用计数
-    cursor.execute(
-        "UPDATE api_keys SET usage_count = usage_count + 1 WHERE key = ?", (selected,)
-    )
-    conn.commit()
-
-    # 使用选定的key转发请求到BASE_URL
-    forward_headers = dict(request.headers)
-    forward_headers["Authorization"] = f"Bearer {selected}"
+    free_token = check_api_key(request)
+    client = request.state.client_token
 
     try:
         req_body = await request.body()
@@ -261,76 +532,56 @@ async def completions(request: Request, background_tasks: BackgroundTasks):
     req_json = await request.json()
     model = req_json.get("model", "unknown")
     call_time_stamp = time.time()
-    is_stream = req_json.get("stream", False)
 
-    if is_stream:
+    selected, zero_balance = pick_api_key(model, free_token, client)
 
-        async def generate_stream():
-            completion_tokens = 0
-            prompt_tokens = 0
-            total_tokens = 0
-
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        f"{BASE_URL}/v1/completions",
-                        headers=forward_headers,
-                        data=req_body,
-                        timeout=300,
-                    ) as resp:
-                        async for chunk in resp.content.iter_any():
-                            try:
-                                chunk_str = chunk.decode("utf-8")
-                                if chunk_str == "[DONE]":
-                                    continue
-                                if chunk_str.startswith("data: "):
-                                    data = json.loads(chunk_str[6:])
-                                    usage = data.get("usage", {})
-                                    prompt_tokens = usage.get("prompt_tokens", 0)
-                                    completion_tokens = usage.get(
-                                        "completion_tokens", 0
-                                    )
-                                    total_tokens = usage.get("total_tokens", 0)
-                            except Exception:
-                                pass
-                            yield chunk
-
-                # 流结束后记录完整token数量
-                log_completion(
-                    selected,
-                    model,
-                    call_time_stamp,
-                    prompt_tokens,
-                    completion_tokens,
-                    total_tokens,
-                    "completions",
-                )
-                await check_and_remove_key(selected)
+    # 增加使用计数
+    increment_key_usage(selected)
 
-            except Exception as e:
-                error_json = json.dumps({"error": f"请求失败: {str(e)}"}).encode(
-                    "utf-8"
-                )
-                yield f"data: {error_json}\n\n".encode("utf-8")
-                yield b"data: [DONE]\n\n"
+    # 使用选定的key转发请求到key所属的上游
+    forward_headers = dict(request.headers)
+    forward_headers["Authorization"] = f"Bearer {selected}"
+    is_stream = req_json.get("stream", False)
 
+    if is_stream:
+        # 让上游在最后返回 usage，客户端没有要求时再把这个事件去掉
+        req_body, strip_usage = inject_include_usage(req_body)
+        if strip_usage:
+            forward_headers.pop("content-length", None)
         try:
             return StreamingResponse(
-                generate_stream(),
-                headers={"Content-Type": "application/octet-stream"},
+                relay_stream(
+                    request,
+                    "/v1/completions",
+                    "completions",
+                    300,
+                    forward_headers,
+                    req_body,
+                    selected,
+                    model,
+                    call_time_stamp,
+                    zero_balance,
+                    client,
+                    strip_usage,
+                ),
+                media_type="text/event-stream",
+                headers=SSE_HEADERS,
             )
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
     else:
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{BASE_URL}/v1/completions",
+            async with pool.lease(selected) as lease:
+                async with upstream.get_session().post(
+                    f"{providers.base_url_of(selected)}/v1/completions",
                     headers=forward_headers,
                     data=req_body,
                     timeout=300,
                 ) as resp:
+                    lease.record(resp.status)
                     resp_json = await resp.json()
+                    if zero_balance:
+                        free_models.record_result(model, resp.status, resp_json)
                     usage = resp_json.get("usage", {})
                     prompt_tokens = usage.get("prompt_tokens", 0)
                     completion_tokens = usage.get("completion_tokens", 0)
@@ -346,6 +597,7 @@ async def completions(request: Request, background_tasks: BackgroundTasks):
                         total_tokens,
                         "completions",
                     )
+                    client_tokens.record_usage(client, prompt_tokens, completion_tokens)
 
                     # 后台检查key余额
                     background_tasks.add_task(check_and_remove_key, selected)
@@ -356,43 +608,34 @@ async def completions(request: Request, background_tasks: BackgroundTasks):
 
 @router.post("/v1/images/generations")
 async def images_generations(request: Request, background_tasks: BackgroundTasks):
-    if config.CUSTOM_API_KEY and config.CUSTOM_API_KEY.strip():
-        request_api_key = request.headers.get("Authorization")
-        if request_api_key != f"Bearer {config.CUSTOM_API_KEY}":
-            raise HTTPException(status_code=403, detail="无效的API_KEY")
+    check_api_key(request, allow_free_token=False)
+    client = request.state.client_token
 
-    cursor.execute("SELECT key, balance FROM api_keys WHERE enabled = 1")
-    keys_with_balance = cursor.fetchall()
-    if not keys_with_balance:
-        raise HTTPException(status_code=500, detail="没有可用的api-key")
+    req_body = await request.body()
+    req_json = await request.json()
+    model = req_json.get("model", "unknown")
+    call_time_stamp = time.time()
 
-    selected = select_api_key(keys_with_balance)
-    if not selected:
-        raise HTTPException(status_code=500, detail="没有可用的api-key")
+    selected, zero_balance = pick_api_key(model, client=client)
 
     # 增加使用计数
-    cursor.execute(
-        "UPDATE api_keys SET usage_count = usage_count + 1 WHERE key = ?", (selected,)
-    )
-    conn.commit()
+    increment_key_usage(selected)
 
     forward_headers = dict(request.headers)
     forward_headers["Authorization"] = f"Bearer {selected}"
 
     try:
-        req_body = await request.body()
-        req_json = await request.json()
-        model = req_json.get("model", "unknown")
-        call_time_stamp = time.time()
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{BASE_URL}/v1/images/generations",
+        async with pool.lease(selected) as lease:
+            async with upstream.get_session().post(
+                f"{providers.base_url_of(selected)}/v1/images/generations",
                 headers=forward_headers,
                 data=req_body,
                 timeout=120,  # 图像生成可能需要更长时间
             ) as resp:
+                lease.record(resp.status)
                 data = await resp.json()
+                if zero_balance:
+                    free_models.record_result(model, resp.status, data)
 
                 # 图像生成接口可能没有token信息，设置为0
                 prompt_tokens = 0
@@ -409,6 +652,7 @@ async def images_generations(request: Request, background_tasks: BackgroundTasks
                     total_tokens,
                     "images_generations",
                 )
+                client_tokens.record_usage(client, prompt_tokens, completion_tokens)
 
                 # 后台检查key余额
                 background_tasks.add_task(check_and_remove_key, selected)
@@ -434,40 +678,8 @@ async def options_images_generations():
 
 @router.post("/v1/rerank")
 async def rerank(request: Request, background_tasks: BackgroundTasks):
-    # 检查是否应该使用余额为0的key
-    use_zero_balance = False
-    if config.FREE_MODEL_API_KEY and config.FREE_MODEL_API_KEY.strip():
-        request_api_key = request.headers.get("Authorization", "")
-        if request_api_key == f"Bearer {config.FREE_MODEL_API_KEY}":
-            use_zero_balance = True
-
-    # 如果不使用余额为0的key，检查自定义API KEY
-    if not use_zero_balance and config.CUSTOM_API_KEY and config.CUSTOM_API_KEY.strip():
-        request_api_key = request.headers.get("Authorization")
-        if request_api_key != f"Bearer {config.CUSTOM_API_KEY}":
-            raise HTTPException(status_code=403, detail="无效的API_KEY")
-
-    cursor.execute("SELECT key, balance FROM api_keys WHERE enabled = 1")
-    keys_with_balance = cursor.fetchall()
-    if not keys_with_balance:
-        raise HTTPException(status_code=500, detail="没有可用的api-key")
-
-    selected = select_api_key(keys_with_balance, use_zero_balance)
-    if not selected:
-        if use_zero_balance:
-            raise HTTPException(status_code=500, detail="没有余额为0的可用api-key")
-        else:
-            raise HTTPException(status_code=500, detail="没有可用的api-key")
-
-    # 增加使用计数
-    cursor.execute(
-        "UPDATE api_keys SET usage_count = usage_count + 1 WHERE key = ?", (selected,)
-    )
-    conn.commit()
-
-    # 使用选定的key转发请求到BASE_URL
-    forward_headers = dict(request.headers)
-    forward_headers["Authorization"] = f"Bearer {selected}"
+    free_token = check_api_key(request)
+    client = request.state.client_token
 
     try:
         req_body = await request.body()
@@ -478,55 +690,89 @@ async def rerank(request: Request, background_tasks: BackgroundTasks):
     model = req_json.get("model", "unknown")
     call_time_stamp = time.time()
 
+    selected, zero_balance = pick_api_key(model, free_token, client)
+
+    # 使用选定的key转发请求到key所属的上游
+    forward_headers = dict(request.headers)
+
+    async def send(key):
+        return await post_json(key, "/v1/rerank", forward_headers, req_body, 300)
+
+    chunks = fanout.rerank_chunks(req_json)
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{BASE_URL}/v1/rerank",
-                headers=forward_headers,
-                data=req_body,
-                timeout=300,
-            ) as resp:
-                resp_json = await resp.json()
-                meta_data = resp_json.get("meta", {})
-                tokens_usage = meta_data.get("tokens", {})
-                input_tokens = tokens_usage.get("input_tokens", 0)
-                output_tokens = tokens_usage.get("output_tokens", 0)
-                # 记录API调用
-                log_completion(
-                    selected,
-                    model,
-                    call_time_stamp,
-                    input_tokens,  # prompt_tokens
-                    output_tokens,  # completion_tokens
-                    input_tokens + output_tokens,  # total_tokens
+        if chunks is None:
+            # 增加使用计数，分块请求由 forward_chunks 为每个分块的key计数
+            increment_key_usage(selected)
+            # 开启对冲时，超过近期 p95 仍未返回会用另一个key再发一次
+            parts = [
+                await hedging.run(
                     "rerank",
+                    selected,
+                    send,
+                    lambda: pick_backup_key(model, zero_balance, client, selected),
                 )
-                # 后台检查key余额
-                background_tasks.add_task(check_and_remove_key, selected)
-                return JSONResponse(content=resp_json, status_code=resp.status)
+            ]
+            _, status, data = parts[0]
+        else:
+            # 文档很多时拆分后并发发送到多个key，合并后再按得分排序
+            status, data, results = await forward_chunks(
+                "rerank",
+                "/v1/rerank",
+                [body for body, _ in chunks],
+                selected,
+                forward_headers,
+                300,
+                model,
+                zero_balance,
+                client,
+            )
+            parts = [part for part in results if part is not None and part[1] == 200]
+            if status == 200:
+                data = fanout.merge_rerank(
+                    [part[2] for part in parts], [size for _, size in chunks], req_json.get("top_n")
+                )
+        if zero_balance:
+            free_models.record_result(model, status, data)
+        # 记录API调用，分块请求按各分块使用的key分别记录
+        total_input_tokens = total_output_tokens = 0
+        for key, _, resp_json in parts:
+            meta_data = resp_json.get("meta") or {}
+            tokens_usage = meta_data.get("tokens") or {}
+            input_tokens = tokens_usage.get("input_tokens", 0)
+            output_tokens = tokens_usage.get("output_tokens", 0)
+            total_input_tokens += input_tokens
+            total_output_tokens += output_tokens
+            log_completion(
+                key,
+                model,
+                call_time_stamp,
+                input_tokens,  # prompt_tokens
+                output_tokens,  # completion_tokens
+                input_tokens + output_tokens,  # total_tokens
+                "rerank",
+            )
+        client_tokens.record_usage(client, total_input_tokens, total_output_tokens)
+        # 后台检查key余额
+        for key in dict.fromkeys(part[0] for part in parts):
+            background_tasks.add_task(check_and_remove_key, key)
+        return JSONResponse(content=data, status_code=status)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"请求转发失败: {str(e)}")
 
 
 @router.get("/v1/models")
 async def list_models(request: Request):
-    cursor.execute("SELECT key, balance FROM api_keys WHERE enabled = 1")
-    keys_with_balance = cursor.fetchall()
-    if not keys_with_balance:
-        raise HTTPException(status_code=500, detail="没有可用的api-key")
-
-    selected = select_api_key(keys_with_balance)
-    if not selected:
-        raise HTTPException(status_code=500, detail="没有可用的api-key")
+    selected, _ = pick_api_key("")
 
     forward_headers = dict(request.headers)
     forward_headers["Authorization"] = f"Bearer {selected}"
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{BASE_URL}/v1/models", headers=forward_headers, timeout=30
+        async with pool.lease(selected) as lease:
+            async with upstream.get_session().get(
+                f"{providers.base_url_of(selected)}/v1/models", headers=forward_headers, timeout=30
             ) as resp:
+                lease.record(resp.status)
                 data = await resp.json()
                 return JSONResponse(content=data, status_code=resp.status)
     except Exception as e:
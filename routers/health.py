@@ -0,0 +1,37 @@
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import JSONResponse
+import lifecycle
+import providers
+from routers.auth import validate_session
+
+router = APIRouter()
+
+
+@router.get("/health/live")
+async def live():
+    """存活检查：进程能响应即可"""
+    return JSONResponse({"status": "ok"})
+
+
+@router.get("/health/ready")
+async def ready():
+    """就绪检查：排空期间返回503，供负载均衡摘除流量"""
+    snapshot = lifecycle.state.snapshot()
+    return JSONResponse(snapshot, status_code=503 if lifecycle.state.draining else 200)
+
+
+@router.post("/api/drain")
+async def start_drain(request: Request):
+    """手动进入排空模式，新的 /v1 请求将返回503，已有请求继续完成"""
+    if not validate_session(request):
+        raise HTTPException(status_code=401, detail="未认证")
+    lifecycle.state.start_drain()
+    return JSONResponse({"message": "已进入排空模式", **lifecycle.state.snapshot()})
+
+
+@router.get("/api/upstreams")
+async def list_upstreams(request: Request):
+    """各上游的健康状态、实测延迟与错误率和可用key数"""
+    if not validate_session(request):
+        raise HTTPException(status_code=401, detail="未认证")
+    return JSONResponse({"upstreams": providers.snapshot()})
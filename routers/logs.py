@@ -46,7 +46,7 @@ async def get_logs(
 
     # 获取过滤后的日志
     logs_query = f"""
-        SELECT used_key, model, call_time, input_tokens, output_tokens, total_tokens, endpoint 
+        SELECT used_key, model, call_time, input_tokens, output_tokens, total_tokens, endpoint, status, usage_estimated
         FROM logs 
         WHERE {where_clause} 
         ORDER BY call_time DESC 
@@ -65,6 +65,8 @@ async def get_logs(
             "output_tokens": row[4],
             "total_tokens": row[5],
             "endpoint": row[6] or "未知",  # 为了向后兼容，对空值使用默认值
+            "status": row[7] or "success",
+            "usage_estimated": bool(row[8]),
         }
         for row in logs
     ]
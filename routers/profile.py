@@ -0,0 +1,81 @@
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse
+import profiler
+from routers.auth import validate_session
+
+router = APIRouter()
+
+# 单次分析的最长时间（秒）
+MAX_PROFILE_SECONDS = 300
+
+
+def _require_session(request: Request):
+    if not validate_session(request):
+        raise HTTPException(status_code=401, detail="未认证")
+
+
+@router.get("/api/profile")
+async def profile_status(request: Request):
+    """事件循环延迟、最近的阻塞记录（含调用栈）和当前分析的状态"""
+    _require_session(request)
+    session = profiler.session
+    return JSONResponse(
+        {
+            "loop": profiler.monitor.snapshot(),
+            "slow_events": list(reversed(profiler.monitor.slow_events)),
+            "session": session.snapshot() if session is not None else None,
+        }
+    )
+
+
+@router.post("/api/profile/start")
+async def start_profile(request: Request):
+    """开始一次限时的性能分析
+
+    mode 为 sample（定时采样调用栈，开销小）或 cprofile（记录每次函数调用，开销大）；
+    seconds 为分析时长，interval_ms 为采样间隔。
+    """
+    _require_session(request)
+    data = await request.json()
+    mode = data.get("mode", "sample")
+    if mode not in ("sample", "cprofile"):
+        raise HTTPException(status_code=400, detail="无效的分析模式")
+    try:
+        seconds = float(data.get("seconds", 30))
+        interval = float(data.get("interval_ms", 5)) / 1000
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="无效的参数")
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"分析时长需在 0-{MAX_PROFILE_SECONDS} 秒之间")
+    if not 0.001 <= interval <= 1:
+        raise HTTPException(status_code=400, detail="采样间隔需在 1-1000 毫秒之间")
+
+    if profiler.session is not None and profiler.session.running:
+        raise HTTPException(status_code=409, detail="已有正在进行的分析")
+    profiler.session = profiler.ProfileSession(mode, seconds, interval)
+    return JSONResponse({"message": "已开始分析", **profiler.session.snapshot()})
+
+
+@router.post("/api/profile/stop")
+async def stop_profile(request: Request):
+    """提前结束当前的分析"""
+    _require_session(request)
+    session = profiler.session
+    if session is None:
+        raise HTTPException(status_code=404, detail="没有进行中的分析")
+    session.stop()
+    return JSONResponse({"message": "已结束分析", **session.snapshot()})
+
+
+@router.get("/api/profile/result")
+async def download_profile(request: Request):
+    """下载最近一次分析的结果"""
+    _require_session(request)
+    session = profiler.session
+    if session is None or session.output is None:
+        raise HTTPException(status_code=404, detail="没有已完成的分析结果")
+    filename = "profile.collapsed.txt" if session.mode == "sample" else "profile.pstats.txt"
+    return PlainTextResponse(
+        session.output,
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
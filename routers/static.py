@@ -1,14 +1,14 @@
-from fastapi import APIRouter
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Request
+import assets
 
 router = APIRouter()
 
 
 @router.get("/")
-async def root():
-    return FileResponse("static/index.html")
+async def root(request: Request):
+    return assets.html_response(request.headers, "static/index.html")
 
 
 @router.get("/login")
-async def login():
-    return FileResponse("static/login.html")
+async def login(request: Request):
+    return assets.html_response(request.headers, "static/login.html")
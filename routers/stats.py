@@ -1,6 +1,11 @@
 from fastapi import APIRouter
 from fastapi.responses import JSONResponse
 from db import cursor
+import batcher
+import hedging
+import metrics
+import profiler
+import upstream
 import time
 from datetime import datetime, timedelta
 
@@ -173,3 +178,17 @@ async def get_monthly_stats():
             "model_tokens": model_tokens,
         }
     )
+
+
+@router.get("/api/stats/runtime")
+async def get_runtime_stats():
+    """获取进程内的运行指标（如流式转发缓冲的最高水位、事件循环延迟、上游连接数、对冲请求、embeddings 微批处理）"""
+    return JSONResponse(
+        {
+            **metrics.snapshot(),
+            "loop": profiler.monitor.snapshot(),
+            "upstream": upstream.connection_stats(),
+            "hedging": hedging.snapshot(),
+            "embedding_batching": batcher.snapshot(),
+        }
+    )
@@ -0,0 +1,86 @@
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import JSONResponse
+import client_tokens
+from admission import PRIORITIES
+from routers.auth import validate_session
+
+router = APIRouter()
+
+
+def parse_token_fields(data: dict):
+    """解析并校验token配置字段"""
+    name = (data.get("name") or "").strip()
+    if not name:
+        raise HTTPException(status_code=400, detail="名称不能为空")
+
+    try:
+        rpm = int(data.get("rpm") or 0)
+        tpm = int(data.get("tpm") or 0)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="RPM/TPM 必须是整数")
+    if rpm < 0 or tpm < 0:
+        raise HTTPException(status_code=400, detail="RPM/TPM 不能为负数")
+
+    allowed_models = data.get("allowed_models") or []
+    if isinstance(allowed_models, str):
+        allowed_models = allowed_models.split(",")
+    allowed_models = [m.strip() for m in allowed_models if m.strip()]
+
+    priority = data.get("priority") or "normal"
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail="无效的优先级")
+
+    key_tag = (data.get("key_tag") or "").strip()
+    return name, rpm, tpm, allowed_models, key_tag, priority
+
+
+@router.get("/api/tokens")
+async def list_tokens(request: Request):
+    if not validate_session(request):
+        raise HTTPException(status_code=401, detail="未认证")
+    return JSONResponse({"tokens": client_tokens.list_tokens()})
+
+
+@router.post("/api/tokens")
+async def create_token(request: Request):
+    if not validate_session(request):
+        raise HTTPException(status_code=401, detail="未认证")
+
+    data = await request.json()
+    name, rpm, tpm, allowed_models, key_tag, priority = parse_token_fields(data)
+    token = client_tokens.create_token(name, rpm, tpm, allowed_models, key_tag, priority)
+    return JSONResponse(
+        {"message": "token 已创建，请妥善保存，之后将无法再次查看", "token": token}
+    )
+
+
+@router.post("/api/tokens/update")
+async def update_token(request: Request):
+    if not validate_session(request):
+        raise HTTPException(status_code=401, detail="未认证")
+
+    data = await request.json()
+    token_hash = data.get("token_hash")
+    if not token_hash:
+        raise HTTPException(status_code=400, detail="未提供 token")
+
+    name, rpm, tpm, allowed_models, key_tag, priority = parse_token_fields(data)
+    enabled = bool(data.get("enabled", True))
+    client_tokens.update_token(
+        token_hash, name, rpm, tpm, allowed_models, key_tag, priority, enabled
+    )
+    return JSONResponse({"message": "token 已更新"})
+
+
+@router.post("/api/tokens/delete")
+async def delete_token(request: Request):
+    if not validate_session(request):
+        raise HTTPException(status_code=401, detail="未认证")
+
+    data = await request.json()
+    token_hash = data.get("token_hash")
+    if not token_hash:
+        raise HTTPException(status_code=400, detail="未提供 token")
+
+    client_tokens.delete_token(token_hash)
+    return JSONResponse({"message": "token 已删除"})
@@ -0,0 +1,65 @@
+import importlib.util
+import logging
+import sys
+import config
+
+logger = logging.getLogger(__name__)
+
+# 服务器运行参数的预设，通过配置 runtime_profile 或启动参数 --runtime 选择
+PROFILES = {
+    # uvicorn 的默认设置：已安装 uvloop/httptools 时自动使用
+    "default": {},
+    # 纯 Python 实现，便于调试和排查兼容性问题
+    "compat": {"loop": "asyncio", "http": "h11"},
+    # 高并发：uvloop 事件循环、httptools 解析器，加大连接队列，
+    # keep-alive 超时长于常见负载均衡的空闲超时（60 秒），并关闭逐请求的访问日志
+    "performance": {
+        "loop": "uvloop",
+        "http": "httptools",
+        "backlog": 4096,
+        "timeout_keep_alive": 75,
+        "access_log": False,
+    },
+}
+
+# 允许通过 server_options 覆盖的 uvicorn 参数
+SERVER_OPTIONS = {
+    "loop",
+    "http",
+    "backlog",
+    "timeout_keep_alive",
+    "access_log",
+    "limit_concurrency",
+    "limit_max_requests",
+    "h11_max_incomplete_event_size",
+}
+
+
+def _installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def server_options(profile: str = None) -> dict:
+    """返回指定预设（默认取配置中的 runtime_profile）合并 server_options 后的 uvicorn 参数
+
+    需要的扩展（uvloop/httptools）未安装时退回到纯 Python 实现，而不是启动失败。
+    """
+    profile = profile or config.RUNTIME_PROFILE
+    if profile not in PROFILES:
+        logger.warning(f"未知的运行模式 {profile}，使用 default")
+        profile = "default"
+    options = dict(PROFILES[profile])
+    for key, value in (config.SERVER_OPTIONS or {}).items():
+        if key in SERVER_OPTIONS:
+            options[key] = value
+        else:
+            logger.warning(f"忽略不支持的服务器参数 {key}")
+
+    if options.get("loop") == "uvloop" and (sys.platform == "win32" or not _installed("uvloop")):
+        logger.warning("未安装 uvloop（或当前系统不支持），使用 asyncio 事件循环")
+        options["loop"] = "asyncio"
+    if options.get("http") == "httptools" and not _installed("httptools"):
+        logger.warning("未安装 httptools，使用 h11 解析 HTTP")
+        options["http"] = "h11"
+    logger.info(f"运行模式 {profile}: {options}")
+    return options
@@ -0,0 +1,35 @@
+import logging
+import time
+from contextlib import contextmanager
+
+# 尽早导入本模块，以便把各模块的导入时间也计算在内
+_start = time.perf_counter()
+_steps = []
+
+# 由 main.py 根据 --profile-startup 参数开启
+enabled = False
+
+
+@contextmanager
+def step(name: str):
+    """记录一个启动步骤的耗时"""
+    if not enabled:
+        yield
+        return
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        _steps.append((name, time.perf_counter() - begin))
+
+
+def report():
+    """输出各启动步骤的耗时，以及从进程启动到可以接受请求的总耗时"""
+    if not enabled:
+        return
+    total = time.perf_counter() - _start
+    logger = logging.getLogger(__name__)
+    lines = [f"启动耗时 {total * 1000:.1f} ms"]
+    for name, elapsed in sorted(_steps, key=lambda item: item[1], reverse=True):
+        lines.append(f"  {elapsed * 1000:8.1f} ms  {name}")
+    logger.info("\n".join(lines))
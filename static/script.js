@@ -49,11 +49,45 @@ async function logout() {
 async function fetchStats() {
     const response = await fetch("/stats");
     const data = await response.json();
+    renderStats(data);
+}
+
+/**
+ * 显示系统统计数据
+ * @param {object} data /stats 返回的数据或 stats 事件的内容
+ */
+function renderStats(data) {
     document.getElementById("totalKeyCount").textContent = data.total_key_count;
     document.getElementById("positiveBalanceCount").textContent = data.positive_balance_count;
     document.getElementById("totalBalance").textContent = Number(data.total_balance).toFixed(2);
 }
 
+/**
+ * 订阅服务端推送的实时事件，断线后浏览器会自动重连
+ * @param {object} handlers 事件类型到处理函数的映射，如 { stats: renderStats }
+ * @returns {EventSource}
+ */
+function subscribeEvents(handlers) {
+    const source = new EventSource('/api/events');
+    Object.entries(handlers).forEach(([type, handler]) => {
+        source.addEventListener(type, event => handler(JSON.parse(event.data)));
+    });
+    return source;
+}
+
+/**
+ * 合并短时间内的多次调用，只在最后一次调用后执行一次
+ * @param {Function} fn 要执行的函数
+ * @param {number} wait 等待时间(毫秒)
+ */
+function debounce(fn, wait) {
+    let timer = null;
+    return (...args) => {
+        clearTimeout(timer);
+        timer = setTimeout(() => fn(...args), wait);
+    };
+}
+
 /**
  * 刷新所有密钥
  */
@@ -0,0 +1,250 @@
+import asyncio
+import json
+import logging
+import re
+import time
+import config
+import metrics
+from token_estimator import TextCounter
+
+logger = logging.getLogger(__name__)
+
+# 队列结束标记
+_END = object()
+
+# choices 为空的事件，注入 include_usage 后上游最后返回的 usage 事件是这种格式
+_EMPTY_CHOICES = re.compile(rb'"choices"\s*:\s*\[\s*\]')
+# 生成文本所在的字段（delta.content、delta.reasoning_content、text）的字符串值，估算 token 时直接在字节上查找
+_TEXT_FIELD = re.compile(rb'"(?:content|reasoning_content|text)"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+class SSEParser:
+    """把上游任意切分的字节流重新切分为完整的 SSE 事件（以空行结尾）"""
+
+    def __init__(self):
+        self.buffer = b""
+
+    def feed(self, chunk: bytes):
+        self.buffer += chunk
+        # 兼容 \r\n 换行
+        if b"\r\n" in self.buffer:
+            self.buffer = self.buffer.replace(b"\r\n", b"\n")
+        events = []
+        while True:
+            idx = self.buffer.find(b"\n\n")
+            if idx < 0:
+                break
+            events.append(self.buffer[: idx + 2])
+            self.buffer = self.buffer[idx + 2 :]
+        return events
+
+    def flush(self):
+        """返回剩余的不完整内容（例如上游返回的非流式错误信息）"""
+        rest, self.buffer = self.buffer, b""
+        return rest
+
+
+def inject_include_usage(req_body: bytes):
+    """为流式请求加上 stream_options.include_usage，让上游在最后返回 usage
+
+    Returns:
+        (转发的请求体, 是否需要去掉客户端没有要求的 usage 事件)
+    """
+    if not config.STREAM_INCLUDE_USAGE:
+        return req_body, False
+    try:
+        req_json = json.loads(req_body)
+    except Exception:
+        return req_body, False
+    if not isinstance(req_json, dict) or not req_json.get("stream"):
+        return req_body, False
+    options = req_json.get("stream_options")
+    if not isinstance(options, dict):
+        options = {}
+    if options.get("include_usage"):
+        return req_body, False
+    options["include_usage"] = True
+    req_json["stream_options"] = options
+    return json.dumps(req_json, ensure_ascii=False).encode("utf-8"), True
+
+
+def _parse_event(event: bytes):
+    """解析 SSE 事件中 data 行的 JSON 对象"""
+    for line in event.split(b"\n"):
+        if not line.startswith(b"data:"):
+            continue
+        payload = line[5:].strip()
+        if not payload or payload == b"[DONE]":
+            continue
+        try:
+            data = json.loads(payload)
+        except Exception:
+            continue
+        if isinstance(data, dict):
+            yield data
+
+
+def _count_text(event: bytes, counter):
+    """累计事件中生成文本的字符数，不解析整个事件；只有含转义字符的字符串才解码"""
+    for match in _TEXT_FIELD.finditer(event):
+        raw = match.group(1)
+        if not raw:
+            continue
+        if b"\\" in raw:
+            try:
+                text = json.loads(b'"' + raw + b'"')
+            except Exception:
+                continue
+        else:
+            text = raw.decode("utf-8", "ignore")
+        counter.add(text)
+
+
+def inspect_event(event: bytes, stats, strip_usage: bool = False) -> bool:
+    """记录包含 usage 的事件，需要估算时逐个事件累计生成文本的字符数
+
+    转发过程中只做字节查找，不做 JSON 解析，也不暂存事件；只有可能需要去掉的 usage 事件才解析。
+
+    Returns:
+        是否需要转发给客户端（注入 include_usage 后上游额外返回的 usage 事件不转发）
+    """
+    if stats.text is not None:
+        _count_text(event, stats.text)
+    if b'"usage"' not in event:
+        return True
+    # 上游可能在每个事件中都带 usage（多为 null），只保留最后一个，流结束后解析
+    stats.usage_event = event
+    if strip_usage and _EMPTY_CHOICES.search(event):
+        for data in _parse_event(event):
+            if data.get("usage") and not data.get("choices"):
+                return False
+    return True
+
+
+class StreamStats:
+    """单个流的缓冲统计"""
+
+    def __init__(self):
+        self.events = 0
+        self.bytes = 0
+        self.queued_events = 0
+        self.queued_bytes = 0
+        self.max_queued_events = 0
+        self.max_queued_bytes = 0
+        self.usage = None
+        self.first_event_at = None
+        # 需要估算 token 时累计生成的文本，不需要时为 None
+        self.text = TextCounter() if config.USAGE_ESTIMATION else None
+        # 最后一个包含 usage 的事件，流结束后才解析
+        self.usage_event = None
+
+    def finish(self):
+        """流结束后解析最后一个包含 usage 的事件"""
+        if self.usage_event is not None:
+            for data in _parse_event(self.usage_event):
+                if data.get("usage"):
+                    self.usage = data["usage"]
+            self.usage_event = None
+
+    def on_enqueue(self, size: int):
+        self.queued_events += 1
+        self.queued_bytes += size
+        if self.queued_events > self.max_queued_events:
+            self.max_queued_events = self.queued_events
+        if self.queued_bytes > self.max_queued_bytes:
+            self.max_queued_bytes = self.queued_bytes
+
+    def on_dequeue(self, size: int):
+        self.queued_events -= 1
+        self.queued_bytes -= size
+        self.events += 1
+        self.bytes += size
+
+
+async def _pump(content, queue: asyncio.Queue, stats: StreamStats):
+    """读取上游响应并放入有界队列；队列满时暂停读取，由 TCP 流控把压力传回上游"""
+    parser = SSEParser()
+    try:
+        async for chunk in content.iter_any():
+            for event in parser.feed(chunk):
+                stats.on_enqueue(len(event))
+                await queue.put(event)
+        rest = parser.flush()
+        if rest:
+            stats.on_enqueue(len(rest))
+            await queue.put(rest)
+        await queue.put(_END)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        await queue.put(e)
+
+
+async def relay_events(
+    content, stats: StreamStats, flush_policy: str = None, strip_usage: bool = False
+):
+    """按 SSE 事件转发上游响应内容
+
+    strip_usage: 去掉只包含 usage 的事件（客户端没有要求 include_usage 时）
+    flush_policy:
+        immediate: 每个事件到达后立即发送，首字延迟最低
+        coalesce: 合并短时间内到达的多个事件再发送，减少小包数量，吞吐更高
+    """
+    flush_policy = flush_policy or config.STREAM_FLUSH_POLICY
+    queue = asyncio.Queue(maxsize=max(1, config.STREAM_BUFFER_EVENTS))
+    pump = asyncio.create_task(_pump(content, queue, stats))
+    coalesce_bytes = config.STREAM_COALESCE_BYTES
+    coalesce_window = config.STREAM_COALESCE_MS / 1000
+
+    def take(item):
+        stats.on_dequeue(len(item))
+        if stats.first_event_at is None:
+            stats.first_event_at = time.monotonic()
+        return inspect_event(item, stats, strip_usage)
+
+    try:
+        while True:
+            item = await queue.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            if not take(item):
+                continue
+
+            if flush_policy != "coalesce":
+                yield item
+                continue
+
+            parts = [item]
+            size = len(item)
+            deadline = time.monotonic() + coalesce_window
+            finished = None
+            while size < coalesce_bytes:
+                remaining = deadline - time.monotonic()
+                try:
+                    if queue.empty() and remaining > 0:
+                        nxt = await asyncio.wait_for(queue.get(), remaining)
+                    else:
+                        nxt = queue.get_nowait()
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+                if nxt is _END or isinstance(nxt, Exception):
+                    finished = nxt
+                    break
+                if take(nxt):
+                    parts.append(nxt)
+                    size += len(nxt)
+            yield b"".join(parts)
+            if finished is _END:
+                return
+            if finished is not None:
+                raise finished
+    finally:
+        pump.cancel()
+        metrics.set_max("stream_buffer_high_water_events", stats.max_queued_events)
+        metrics.set_max("stream_buffer_high_water_bytes", stats.max_queued_bytes)
+        logger.debug(
+            f"Stream relayed {stats.events} events / {stats.bytes} bytes, "
+            f"buffer high-water {stats.max_queued_events} events / {stats.max_queued_bytes} bytes"
+        )
@@ -0,0 +1,75 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from aiohttp import web
+import uvicorn
+import config
+import db
+import lifecycle
+import mock_upstream
+import upstream
+from key_pool import pool
+
+# 测试在临时目录中启动真实的代理服务（含 lifespan）和本地模拟上游 (mock_upstream.py)，
+# 运行: python -m unittest discover tests 或 python -m pytest tests
+
+
+class ProxyTestCase(unittest.IsolatedAsyncioTestCase):
+    """每个测试使用独立的工作目录、数据库和模拟上游"""
+
+    async def asyncSetUp(self):
+        import main
+
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(self.workdir)
+
+        config.CONFIG_FILE = os.path.join(self.workdir, "config.json")
+        db.DB_FILE = os.path.join(self.workdir, "pool.db")
+        # 重新打开数据库连接，其他模块持有的 conn/cursor 代理同样指向新数据库
+        db.conn._target = None
+        db.cursor._target = None
+        lifecycle.state = lifecycle.Lifecycle()
+        # key在启动时从新数据库重新加载，上游健康统计不会，需要手动清空
+        pool.upstream_health.clear()
+
+        self.mock_app = mock_upstream.create_app()
+        # 模拟上游各请求结束的时间: [(路径, 事件循环时间, 是否因连接断开而结束)]
+        self.upstream_finished = []
+        self.mock_app.middlewares.append(self._track_upstream)
+        self.mock_runner = web.AppRunner(self.mock_app)
+        await self.mock_runner.setup()
+        site = web.TCPSite(self.mock_runner, "127.0.0.1", 0)
+        await site.start()
+        config.BASE_URL = f"http://127.0.0.1:{self.mock_runner.addresses[0][1]}"
+
+        self.server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=0, log_level="warning"))
+        self.server_task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    @web.middleware
+    async def _track_upstream(self, request, handler):
+        disconnected = False
+        try:
+            return await handler(request)
+        except (ConnectionError, asyncio.CancelledError):
+            disconnected = True
+            raise
+        finally:
+            self.upstream_finished.append((request.path, asyncio.get_running_loop().time(), disconnected))
+
+    async def asyncTearDown(self):
+        self.server.should_exit = True
+        await self.server_task
+        await upstream.close()
+        await self.mock_runner.cleanup()
+        db.conn.close()
+        db.conn._target = None
+        db.cursor._target = None
@@ -0,0 +1,59 @@
+import asyncio
+import unittest
+from unittest import mock
+import admission
+import config
+from admission import PRIORITIES, AdmissionController, AdmissionRejected
+
+
+class AdmissionControllerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patcher = mock.patch.multiple(
+            config, ADMISSION_MAX_CONCURRENCY=1, ADMISSION_QUEUE_SIZE=10, ADMISSION_MAX_WAIT=5
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.controller = AdmissionController()
+
+    async def test_higher_priority_admitted_first(self):
+        await self.controller.acquire("a", PRIORITIES["normal"])
+        order = []
+
+        async def wait(client_id, priority):
+            await self.controller.acquire(client_id, priority)
+            order.append(client_id)
+
+        tasks = [
+            asyncio.create_task(wait("low", PRIORITIES["low"])),
+            asyncio.create_task(wait("high", PRIORITIES["high"])),
+        ]
+        await asyncio.sleep(0)
+        self.assertEqual(self.controller.queued, 2)
+        self.controller.release(0)
+        await asyncio.sleep(0)
+        self.controller.release(0)
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, ["high", "low"])
+        self.assertEqual(self.controller.active, 1)
+
+    async def test_timeout_after_wake_returns_slot(self):
+        await self.controller.acquire("a", PRIORITIES["normal"])
+
+        async def racing_wait_for(future, timeout):
+            # 名额在等待超时的同一轮事件循环中被放行
+            self.controller.release(0)
+            self.assertTrue(future.done())
+            raise asyncio.TimeoutError
+
+        with mock.patch.object(admission.asyncio, "wait_for", racing_wait_for):
+            with self.assertRaises(AdmissionRejected):
+                await self.controller.acquire("b", PRIORITIES["normal"])
+        self.assertEqual(self.controller.active, 0)
+        self.assertEqual(self.controller.queued, 0)
+        # 名额没有泄漏，新的请求可以直接放行
+        await asyncio.wait_for(self.controller.acquire("c", PRIORITIES["normal"]), 1)
+        self.assertEqual(self.controller.active, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,18 @@
+import aiohttp
+from tests.support import ProxyTestCase
+
+
+class CorsPreflightTest(ProxyTestCase):
+    async def test_options_on_v1_routes(self):
+        async with aiohttp.ClientSession() as session:
+            for path in ("/v1/chat/completions", "/v1/embeddings", "/v1/completions", "/v1/images/generations"):
+                async with session.options(f"{self.base_url}{path}") as resp:
+                    self.assertEqual(resp.status, 200, path)
+                    self.assertEqual(resp.headers.get("Access-Control-Allow-Origin"), "*", path)
+                    self.assertIn("POST", resp.headers.get("Access-Control-Allow-Methods", ""), path)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
@@ -0,0 +1,46 @@
+import asyncio
+from unittest import mock
+import aiohttp
+import config
+import db
+from tests.support import ProxyTestCase
+
+KEY = "sk-embeddingbatch"
+
+
+class EmbeddingBatchingTest(ProxyTestCase):
+    async def test_balance_checked_once_per_upstream_call(self):
+        db.insert_api_key(KEY, 10)
+        patcher = mock.patch.multiple(
+            config, EMBEDDING_BATCHING=True, EMBEDDING_BATCH_MAX_SIZE=32, EMBEDDING_BATCH_MAX_WAIT_MS=50
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        async with aiohttp.ClientSession() as session:
+
+            async def embed(i):
+                body = {"model": "mock-embedding", "input": f"text {i}"}
+                async with session.post(f"{self.base_url}/v1/embeddings", json=body) as resp:
+                    self.assertEqual(resp.status, 200)
+                    data = await resp.json()
+                    self.assertEqual(len(data["data"]), 1)
+
+            await asyncio.gather(*(embed(i) for i in range(50)))
+
+        stats = self.mock_app["stats"]
+        calls = stats.get("/v1/embeddings", 0)
+        self.assertLess(calls, 50)
+        # 等待后台余额检查完成
+        for _ in range(100):
+            if stats.get("/v1/user/info", 0) >= calls:
+                break
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        self.assertEqual(stats.get("/v1/user/info", 0), calls)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
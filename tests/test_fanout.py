@@ -0,0 +1,48 @@
+from unittest import mock
+import aiohttp
+import config
+import db
+from key_pool import pool
+from tests.support import ProxyTestCase
+
+KEYS = [f"sk-fanout{i}" for i in range(4)]
+
+
+class FanoutUsageTest(ProxyTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        for key in KEYS:
+            db.insert_api_key(key, 10)
+        patcher = mock.patch.multiple(config, FANOUT_EMBEDDING_CHUNK_SIZE=2, FANOUT_RERANK_CHUNK_SIZE=2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def usage_counts(self) -> dict:
+        db.cursor.execute("SELECT key, usage_count FROM api_keys")
+        return dict(db.cursor.fetchall())
+
+    async def post(self, path: str, body: dict):
+        async with aiohttp.ClientSession() as session:
+            async with session.post(f"{self.base_url}{path}", json=body) as resp:
+                self.assertEqual(resp.status, 200)
+                return await resp.json()
+
+    async def test_every_embedding_chunk_key_is_counted(self):
+        data = await self.post("/v1/embeddings", {"model": "mock-embedding", "input": [f"t{i}" for i in range(8)]})
+        self.assertEqual(len(data["data"]), 8)
+        counts = self.usage_counts()
+        # 4 个分块，每个分块使用的key各计一次
+        self.assertEqual(sum(counts.values()), 4)
+        self.assertEqual(sum(pool.states[key].usage_count for key in KEYS), 4)
+
+    async def test_every_rerank_chunk_key_is_counted(self):
+        body = {"model": "mock-rerank", "query": "q", "documents": [f"d{i}" for i in range(8)]}
+        data = await self.post("/v1/rerank", body)
+        self.assertEqual(len(data["results"]), 8)
+        self.assertEqual(sum(self.usage_counts().values()), 4)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
@@ -0,0 +1,74 @@
+import asyncio
+from unittest import mock
+import aiohttp
+import config
+import db
+import mock_upstream
+import upstream
+from tests.support import ProxyTestCase
+
+KEY = "sk-http2upstream"
+
+
+class Http2UpstreamTest(ProxyTestCase):
+    """upstream_backend 为 httpx_h2 时经 h2c 模拟上游 (mock_upstream.py --h2) 转发"""
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.h2_server, h2_url = await mock_upstream.start(h2=True)
+        self.addAsyncCleanup(mock_upstream.stop, self.h2_server)
+        patcher = mock.patch.multiple(config, UPSTREAM_BACKEND="httpx_h2", UPSTREAM_H2_CONNECTIONS=2, BASE_URL=h2_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # 会话在首次使用时按当前配置创建
+        await upstream.close()
+        db.insert_api_key(KEY, 10)
+
+    async def runtime_stats(self, session) -> dict:
+        async with session.get(f"{self.base_url}/api/stats/runtime") as resp:
+            self.assertEqual(resp.status, 200)
+            return (await resp.json())["upstream"]
+
+    async def test_requests_share_http2_connections(self):
+        streams = mock_upstream.h2_stats["streams"]
+        connections = mock_upstream.h2_stats["connections"]
+        body = {"model": "mock-model", "messages": [{"role": "user", "content": "hi"}]}
+
+        async with aiohttp.ClientSession() as session:
+
+            async def chat(stream):
+                async with session.post(f"{self.base_url}/v1/chat/completions", json={**body, "stream": stream}) as resp:
+                    self.assertEqual(resp.status, 200)
+                    text = await resp.text()
+                    if stream:
+                        self.assertIn("[DONE]", text)
+
+            await asyncio.gather(*(chat(i % 2 == 0) for i in range(10)))
+            stats = await self.runtime_stats(session)
+
+        # 每个请求之后还有一次后台余额检查，同样经 HTTP/2 发送
+        self.assertGreaterEqual(mock_upstream.h2_stats["streams"] - streams, 10)
+        # 10 个并发请求复用每个上游地址最多 2 个连接
+        self.assertLessEqual(mock_upstream.h2_stats["connections"] - connections, 2)
+        self.assertEqual(stats["backend"], "httpx_h2")
+        self.assertEqual(stats["origins"], 1)
+        self.assertIn(stats["connections"], (1, 2))
+        self.assertIn("streams", stats)
+
+    async def test_stats_survive_missing_client_internals(self):
+        async with aiohttp.ClientSession() as session:
+            body = {"model": "mock-model", "messages": [{"role": "user", "content": "hi"}]}
+            async with session.post(f"{self.base_url}/v1/chat/completions", json=body) as resp:
+                self.assertEqual(resp.status, 200)
+            # 依赖升级后读取不到连接池内部结构时，统计接口仍然可用
+            with mock.patch.object(upstream, "_pool_connections", return_value=None):
+                stats = await self.runtime_stats(session)
+        self.assertIsNone(stats["connections"])
+        self.assertIsNone(stats["active_connections"])
+        self.assertEqual(stats["backend"], "httpx_h2")
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+from collections import Counter
+from key_pool import KeyPool, _build_rr_sequence
+
+
+def make_pool(balances: dict) -> KeyPool:
+    pool = KeyPool()
+    pool.load([(key, i, balance, 0, 1, "", "") for i, (key, balance) in enumerate(balances.items())])
+    return pool
+
+
+class SelectionStrategyTest(unittest.TestCase):
+    def test_least_inflight_picks_idle_key(self):
+        pool = make_pool({"a": 10, "b": 10, "c": 10})
+        pool._acquire("a")
+        pool._acquire("b")
+        for _ in range(20):
+            self.assertEqual(pool.select("least_inflight"), "c")
+        pool._acquire("c")
+        pool._acquire("c")
+        self.assertIn(pool.select("least_inflight"), {"a", "b"})
+
+    def test_p2c_prefers_healthier_key(self):
+        pool = make_pool({"a": 10, "b": 10})
+        pool.states["a"].error_rate = 1.0
+        pool.states["a"].latency = 5.0
+        counts = Counter(pool.select("p2c") for _ in range(2000))
+        # 只有两次都抽到 a 时才会选择 a，约占 1/4
+        self.assertGreater(counts["b"], counts["a"] * 2)
+
+    def test_weighted_follows_balance(self):
+        pool = make_pool({"a": 30, "b": 10})
+        counts = Counter(pool.select("weighted") for _ in range(8000))
+        self.assertAlmostEqual(counts["a"] / 8000, 0.75, delta=0.03)
+
+    def test_swrr_sequence_interleaves_by_balance(self):
+        sequence = _build_rr_sequence(["a", "b", "c"], [5, 1, 1])
+        self.assertEqual("".join(sequence), "aabcaaaaabcaa")
+        # 余额都为0时每个key各出现一次
+        self.assertEqual(_build_rr_sequence(["a", "b"], [0, 0]), ["a", "b"])
+
+    def test_swrr_cycles_through_sequence(self):
+        pool = make_pool({"a": 1, "b": 3})
+        picks = [pool.select("swrr") for _ in range(16)]
+        self.assertEqual(picks[:8], picks[8:])
+        self.assertEqual(Counter(picks[:8]), {"a": 2, "b": 6})
+
+    def test_swrr_uses_new_balances_from_next_cycle(self):
+        pool = make_pool({"a": 1, "b": 1})
+        first = [pool.select("swrr") for _ in range(8)]
+        self.assertEqual(Counter(first), {"a": 4, "b": 4})
+        pool.set_balance("b", 3)
+        # 跳过权重表的最短重建间隔
+        pool.positive.built_at = 0
+        picks = [pool.select("swrr") for _ in range(8)]
+        self.assertEqual(Counter(picks), {"a": 2, "b": 6})
+
+    def test_swrr_skips_removed_key(self):
+        pool = make_pool({"a": 5, "b": 1})
+        pool.select("swrr")
+        pool.remove("b")
+        self.assertEqual({pool.select("swrr") for _ in range(50)}, {"a"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import asyncio
+import aiohttp
+import config
+import db
+from key_pool import CLOSED, pool
+from tests.support import ProxyTestCase
+
+KEYS = [f"sk-scheduledrefresh{i}" for i in range(5)]
+
+
+class ScheduledRefreshTest(ProxyTestCase):
+    async def test_scheduled_refresh_updates_balances(self):
+        for key in KEYS:
+            db.insert_api_key(key, 10)
+
+        async with aiohttp.ClientSession() as session:
+            login = {"username": config.ADMIN_USERNAME, "password": config.ADMIN_PASSWORD}
+            async with session.post(f"{self.base_url}/api/login", json=login) as resp:
+                self.assertEqual(resp.status, 200)
+            # 设置刷新间隔后定时任务立即执行一次刷新
+            async with session.post(f"{self.base_url}/config/refresh_interval", json={"refresh_interval": 1}) as resp:
+                self.assertEqual(resp.status, 200)
+
+        stats = self.mock_app["stats"]
+        for _ in range(200):
+            if stats.get("/v1/user/info", 0) >= len(KEYS) and all(pool.states[k].balance == 14.0 for k in KEYS):
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(stats.get("/v1/user/info", 0), len(KEYS))
+        for key in KEYS:
+            # 刷新与转发共用上游会话，不能因为跨事件循环而被当作暂时性故障隔离
+            self.assertEqual(pool.states[key].breaker, CLOSED)
+            self.assertEqual(pool.states[key].balance, 14.0)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
@@ -0,0 +1,104 @@
+from unittest import mock
+import aiohttp
+from aiohttp import web
+import config
+import db
+import mock_upstream
+import providers
+from tests.support import ProxyTestCase
+
+DEFAULT_KEY = "sk-providerdefault"
+SECOND_KEY = "sk-providersecond"
+
+
+class MultiUpstreamTest(ProxyTestCase):
+    """默认上游与第二个模拟上游 second 之间的路由、健康检查与故障转移"""
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        # 第二个上游，second_down 为 True 时所有请求返回 503
+        self.second_down = False
+        self.second_app = mock_upstream.create_app()
+        self.second_app.middlewares.append(self._maybe_down)
+        runner = web.AppRunner(self.second_app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        self.addAsyncCleanup(runner.cleanup)
+        second_url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+        patcher = mock.patch.multiple(
+            config,
+            UPSTREAMS=[{"name": "second", "base_url": second_url, "models": ["mock-model", "second-only"]}],
+            UPSTREAM_FAILURE_THRESHOLD=2,
+        )
+        patcher.start()
+        self.addCleanup(providers.load)
+        self.addCleanup(patcher.stop)
+        providers.load()
+        default = providers._providers[providers.DEFAULT_UPSTREAM]
+        default.healthy, default.failures = True, 0
+        # 默认上游的模型列表按健康检查的结果判断
+        default.probed_models = {"mock-model"}
+        self.addCleanup(setattr, default, "probed_models", None)
+
+        db.insert_api_key(DEFAULT_KEY, 10)
+        db.insert_api_key(SECOND_KEY, 10, upstream="second")
+        self.second = providers._providers["second"]
+
+    @web.middleware
+    async def _maybe_down(self, request, handler):
+        if self.second_down:
+            return web.json_response({"error": {"message": "unavailable"}}, status=503)
+        return await handler(request)
+
+    async def chat(self, model: str) -> int:
+        body = {"model": model, "messages": [{"role": "user", "content": "hi"}]}
+        async with aiohttp.ClientSession() as session:
+            async with session.post(f"{self.base_url}/v1/chat/completions", json=body) as resp:
+                await resp.read()
+                return resp.status
+
+    def test_route_only_offers_upstreams_serving_the_model(self):
+        self.assertEqual(providers.route("second-only"), ["second"])
+        self.assertEqual(set(providers.route("mock-model")), {"", "second"})
+
+    def test_route_spreads_first_choice_by_available_keys(self):
+        firsts = {providers.route("mock-model")[0] for _ in range(200)}
+        self.assertEqual(firsts, {"", "second"})
+
+    async def test_unhealthy_upstream_is_routed_last_until_it_recovers(self):
+        self.second_down = True
+        await providers.probe(self.second)
+        # 连续失败次数未达到阈值前仍然参与路由
+        self.assertTrue(self.second.healthy)
+        await providers.probe(self.second)
+        self.assertFalse(self.second.healthy)
+        self.assertEqual(self.second.failures, 2)
+        for _ in range(20):
+            self.assertEqual(providers.route("mock-model"), ["", "second"])
+
+        # 请求都转发到默认上游
+        second_requests = self.second_app["stats"]["requests"]
+        for _ in range(5):
+            self.assertEqual(await self.chat("mock-model"), 200)
+        self.assertEqual(self.second_app["stats"]["requests"], second_requests)
+        self.assertGreaterEqual(self.mock_app["stats"].get("/v1/chat/completions", 0), 5)
+
+        # 健康检查成功后恢复路由
+        self.second_down = False
+        await providers.probe(self.second)
+        self.assertTrue(self.second.healthy)
+        self.assertEqual(self.second.failures, 0)
+        self.assertIn("second-only", self.second.models)
+
+    async def test_unhealthy_upstream_still_used_when_it_is_the_only_choice(self):
+        self.second.healthy = False
+        self.assertEqual(await self.chat("second-only"), 200)
+        self.assertEqual(self.second_app["stats"].get("/v1/chat/completions", 0), 1)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
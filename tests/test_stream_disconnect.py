@@ -0,0 +1,54 @@
+import asyncio
+import json
+import aiohttp
+import db
+from key_pool import pool
+from tests.support import ProxyTestCase
+
+KEY = "sk-streamdisconnect"
+
+
+class StreamDisconnectTest(ProxyTestCase):
+    async def test_client_disconnect_closes_upstream(self):
+        db.insert_api_key(KEY, 10)
+        body = {"model": "mock-model", "stream": True, "messages": [{"role": "user", "content": "hi"}]}
+        # 200 个事件、每 50ms 一个，正常结束需要约 10 秒
+        headers = {"X-Mock-Events": "200", "X-Mock-Duration": "10", "X-Mock-TTFB": "0"}
+
+        async with aiohttp.ClientSession() as session:
+            resp = await session.post(f"{self.base_url}/v1/chat/completions", json=body, headers=headers)
+            self.assertEqual(resp.status, 200)
+            await resp.content.readuntil(b"\n\n")
+            self.assertEqual(pool.states[KEY].in_flight, 1)
+            disconnected_at = asyncio.get_running_loop().time()
+            resp.close()
+
+        for _ in range(200):
+            finished = [entry for entry in self.upstream_finished if entry[0] == "/v1/chat/completions"]
+            if finished:
+                break
+            await asyncio.sleep(0.01)
+        self.assertTrue(finished, "模拟上游在 2 秒内没有看到连接关闭")
+        _, finished_at, upstream_disconnected = finished[0]
+        self.assertTrue(upstream_disconnected)
+        self.assertLess(finished_at - disconnected_at, 1.0)
+
+        # 等待代理记录日志并归还key
+        for _ in range(100):
+            db.cursor.execute("SELECT status FROM logs WHERE used_key = ?", (KEY,))
+            rows = db.cursor.fetchall()
+            if rows:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(rows, [("client_cancelled",)])
+        self.assertEqual(pool.states[KEY].in_flight, 0)
+        # 被放弃的请求不计入key和上游的成功或失败
+        health = pool.upstream_health.get("")
+        self.assertTrue(health is None or health.requests == 0)
+        self.assertEqual(self.mock_app["stats"].get("/v1/user/info", 0), 0)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
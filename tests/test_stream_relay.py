@@ -0,0 +1,66 @@
+import json
+import unittest
+from unittest import mock
+import config
+import stream_relay
+from stream_relay import StreamStats, inspect_event
+
+
+def event(data) -> bytes:
+    return f"data: {json.dumps(data)}\n\n".encode()
+
+
+def chunk(text, usage=None, choices=True) -> bytes:
+    data = {"choices": [{"index": 0, "delta": {"content": text}}] if choices else []}
+    if usage is not False:
+        data["usage"] = usage
+    return event(data)
+
+
+USAGE = {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5}
+
+
+class InspectEventTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(config, "USAGE_ESTIMATION", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_events_are_not_parsed_while_relaying(self):
+        stats = StreamStats()
+        events = [chunk("hello", None) for _ in range(50)] + [chunk("", USAGE, choices=False), b"data: [DONE]\n\n"]
+        with mock.patch.object(stream_relay.json, "loads", wraps=json.loads) as loads:
+            for item in events:
+                self.assertTrue(inspect_event(item, stats))
+            self.assertEqual(loads.call_count, 0)
+            stats.finish()
+            # 上游返回了 usage，只解析最后一个包含 usage 的事件
+            self.assertEqual(loads.call_count, 1)
+        self.assertEqual(stats.usage, USAGE)
+
+    def test_missing_usage_is_estimated_from_streamed_text(self):
+        stats = StreamStats()
+        for _ in range(10):
+            inspect_event(chunk("abcd", False), stats)
+        stats.finish()
+        self.assertIsNone(stats.usage)
+        self.assertEqual(stats.text.tokens(), 10)
+
+    def test_text_is_counted_as_events_pass(self):
+        stats = StreamStats()
+        inspect_event(event({"choices": [{"index": 0, "delta": {"content": "ab\"c\n你好"}}]}), stats)
+        inspect_event(event({"choices": [{"index": 0, "delta": {"reasoning_content": "xyz"}}]}), stats)
+        # 事件转发后不再保留，只留下累计的字符数
+        self.assertEqual((stats.text.ascii_chars, stats.text.other_chars), (8, 2))
+        self.assertIsNone(stats.usage_event)
+
+    def test_injected_usage_event_is_stripped(self):
+        stats = StreamStats()
+        self.assertTrue(inspect_event(chunk("hi", None), stats, strip_usage=True))
+        self.assertFalse(inspect_event(chunk("", USAGE, choices=False), stats, strip_usage=True))
+        # choices 为空但没有 usage 的事件仍然转发
+        self.assertTrue(inspect_event(chunk("", None, choices=False), stats, strip_usage=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import json
+import math
+
+# 粗略估算 token 数：英文等 ASCII 文本约 4 个字符一个 token，
+# 中文等非 ASCII 文本约 1.5 个字符一个 token。仅在上游没有返回 usage 时使用。
+ASCII_CHARS_PER_TOKEN = 4
+OTHER_CHARS_PER_TOKEN = 1.5
+# 每条消息的角色、分隔符等额外开销
+TOKENS_PER_MESSAGE = 4
+
+
+class TextCounter:
+    """累计文本的字符数，用于估算 token"""
+
+    __slots__ = ("ascii_chars", "other_chars")
+
+    def __init__(self):
+        self.ascii_chars = 0
+        self.other_chars = 0
+
+    def add(self, text: str):
+        ascii_chars = len(text.encode("ascii", "ignore"))
+        self.ascii_chars += ascii_chars
+        self.other_chars += len(text) - ascii_chars
+
+    def tokens(self) -> int:
+        return math.ceil(
+            self.ascii_chars / ASCII_CHARS_PER_TOKEN
+            + self.other_chars / OTHER_CHARS_PER_TOKEN
+        )
+
+
+def estimate_text_tokens(text: str) -> int:
+    counter = TextCounter()
+    counter.add(text)
+    return counter.tokens()
+
+
+def estimate_prompt_tokens(req_body: bytes) -> int:
+    """估算 chat/completions 请求的输入 token 数"""
+    try:
+        req_json = json.loads(req_body)
+    except Exception:
+        return 0
+
+    counter = TextCounter()
+    overhead = 0
+    for message in req_json.get("messages") or []:
+        overhead += TOKENS_PER_MESSAGE
+        content = message.get("content")
+        if isinstance(content, str):
+            counter.add(content)
+        elif isinstance(content, list):
+            for part in content:
+                if isinstance(part, dict) and isinstance(part.get("text"), str):
+                    counter.add(part["text"])
+
+    prompt = req_json.get("prompt")
+    if isinstance(prompt, str):
+        counter.add(prompt)
+    elif isinstance(prompt, list):
+        for item in prompt:
+            if isinstance(item, str):
+                counter.add(item)
+    suffix = req_json.get("suffix")
+    if isinstance(suffix, str):
+        counter.add(suffix)
+
+    return counter.tokens() + overhead
@@ -0,0 +1,308 @@
+import asyncio
+import json
+import logging
+from urllib.parse import urlsplit
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 所有转发请求共用一个连接池，避免每个请求重新建立 TCP/TLS 连接
+_session = None
+# 当前会话实际使用的实现（依赖缺失时可能与配置不同）
+_session_backend = None
+
+# HTTP/2 禁止的逐跳请求头；Host 由 :authority 代替，Content-Length 由客户端重新计算
+HOP_BY_HOP_HEADERS = {
+    "host",
+    "connection",
+    "keep-alive",
+    "proxy-connection",
+    "transfer-encoding",
+    "upgrade",
+    "te",
+    "content-length",
+}
+
+
+class _Http2Content:
+    """提供与 aiohttp StreamReader 相同的 iter_any()，供流式转发使用"""
+
+    def __init__(self, response):
+        self._response = response
+        self._reader = None
+        self.closed = False
+
+    async def iter_any(self):
+        chunks = self._response.aiter_bytes()
+        while True:
+            if self.closed:
+                raise ConnectionResetError("上游响应已关闭")
+            self._reader = asyncio.current_task()
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                return
+            except asyncio.CancelledError:
+                if not self.closed:
+                    raise
+                # 读取被 interrupt() 中断，任务本身没有被取消
+                self._reader.uncancel()
+                raise ConnectionResetError("上游响应已关闭")
+            finally:
+                self._reader = None
+            yield chunk
+
+    def interrupt(self):
+        """中断正在等待上游数据的读取，与 aiohttp 关闭响应时的行为一致"""
+        self.closed = True
+        if self._reader is not None:
+            self._reader.cancel()
+
+
+class _Http2Response:
+    """把 httpx 的响应包装成转发代码使用的 aiohttp 响应接口"""
+
+    def __init__(self, response):
+        self._response = response
+        self.status = response.status_code
+        self.headers = response.headers
+        self.content = _Http2Content(response)
+
+    async def read(self) -> bytes:
+        return await self._response.aread()
+
+    async def json(self):
+        return json.loads(await self._response.aread())
+
+    def close(self):
+        # 客户端断开时调用；在 HTTP/2 上只重置这一个流，连接继续被其他请求复用
+        self.content.interrupt()
+        asyncio.ensure_future(self._response.aclose())
+
+
+class _Http2Request:
+    def __init__(self, session, method: str, url: str, headers=None, data=None, timeout=None):
+        self._session = session
+        self._method = method
+        self._url = url
+        self._headers = {
+            k: v for k, v in (headers or {}).items() if k.lower() not in HOP_BY_HOP_HEADERS
+        }
+        self._data = data
+        self._timeout = timeout
+        self._group = None
+        self._index = None
+        self._response = None
+
+    async def __aenter__(self) -> _Http2Response:
+        import httpx
+
+        self._group, self._index = self._session.acquire(self._url)
+        client = self._group.clients[self._index]
+        request = client.build_request(
+            self._method,
+            self._url,
+            headers=self._headers,
+            content=self._data,
+            timeout=httpx.Timeout(self._timeout) if self._timeout else httpx.USE_CLIENT_DEFAULT,
+        )
+        try:
+            self._response = await client.send(request, stream=True)
+        except BaseException:
+            self._group.release(self._index)
+            raise
+        return _Http2Response(self._response)
+
+    async def __aexit__(self, *exc_info):
+        try:
+            if self._response is not None:
+                await self._response.aclose()
+        finally:
+            self._group.release(self._index)
+
+
+def _origin(url: str) -> tuple:
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    return parts.scheme, parts.hostname, port
+
+
+class _Http2Origin:
+    """到同一个上游 (scheme, host, port) 的 max_connections 个单连接客户端"""
+
+    def __init__(self, scheme: str, max_connections: int):
+        import httpx
+
+        self.clients = [
+            httpx.AsyncClient(
+                http2=True,
+                # http:// 上游使用 h2c 直连（不经过 HTTP/1.1 升级），用于本地的 h2 模拟上游
+                http1=scheme != "http",
+                limits=httpx.Limits(max_connections=1, max_keepalive_connections=1, keepalive_expiry=60),
+                timeout=httpx.Timeout(60),
+            )
+            for _ in range(max(1, max_connections))
+        ]
+        self.inflight = [0] * len(self.clients)
+
+    def acquire(self) -> int:
+        index = min(range(len(self.clients)), key=self.inflight.__getitem__)
+        self.inflight[index] += 1
+        return index
+
+    def release(self, index: int):
+        self.inflight[index] -= 1
+
+
+class Http2Session:
+    """基于 httpx 的 HTTP/2 上游会话，接口与转发代码使用的 aiohttp.ClientSession 子集相同
+
+    多个并发请求作为不同的流复用少量连接，而不是每个并发请求占用一个 TCP/TLS 连接。
+    httpx 会把请求都排在同一个 HTTP/2 连接上，超过上游允许的并发流数（通常为 100）后只能等待，
+    因此对每个上游 (scheme, host, port) 在首次请求时建立 max_connections 个各自只有一个连接的客户端，
+    每个请求交给该上游进行中请求最少的那个；不同上游之间互不排队。
+    """
+
+    def __init__(self, max_connections: int):
+        self.max_connections = max_connections
+        self.origins = {}
+        self.closed = False
+
+    def acquire(self, url: str):
+        origin = _origin(url)
+        group = self.origins.get(origin)
+        if group is None:
+            group = self.origins[origin] = _Http2Origin(origin[0], self.max_connections)
+        return group, group.acquire()
+
+    def post(self, url: str, **kwargs) -> _Http2Request:
+        return _Http2Request(self, "POST", url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> _Http2Request:
+        return _Http2Request(self, "GET", url, **kwargs)
+
+    async def close(self):
+        self.closed = True
+        for group in self.origins.values():
+            for client in group.clients:
+                await client.aclose()
+        self.origins.clear()
+
+    def connection_stats(self) -> dict:
+        groups = list(self.origins.values())
+        stats = {
+            "connections": None,
+            "active_connections": None,
+            "streams": sum(sum(group.inflight) for group in groups),
+            "origins": len(groups),
+        }
+        connections = []
+        for client in (client for group in groups for client in group.clients):
+            pooled = _pool_connections(client)
+            if pooled is None:
+                return stats
+            connections.extend(pooled)
+        try:
+            stats["active_connections"] = sum(1 for c in connections if not c.is_idle())
+        except AttributeError:
+            return stats
+        stats["connections"] = len(connections)
+        return stats
+
+
+def _pool_connections(client):
+    """httpx 没有公开连接池状态，只能读取内部属性；依赖升级后结构变化时返回 None"""
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    connections = getattr(pool, "connections", None)
+    return None if connections is None else list(connections)
+
+
+def _connector_stats(connector) -> dict:
+    """aiohttp 连接器的空闲与使用中的连接数（同样是内部属性），读取失败时为 None"""
+    try:
+        idle = sum(len(conns) for conns in connector._conns.values())
+        active = len(connector._acquired)
+    except (AttributeError, TypeError):
+        return {"connections": None, "active_connections": None}
+    return {"connections": idle + active, "active_connections": active}
+
+
+async def _on_connection_create(session, context, params):
+    metrics.inc("upstream_connections_created")
+
+
+async def _on_connection_reuse(session, context, params):
+    metrics.inc("upstream_connections_reused")
+
+
+def _trace_config():
+    """通过公开的 trace 钩子统计新建与复用的连接数，不依赖连接器内部结构"""
+    import aiohttp
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_end.append(_on_connection_create)
+    trace_config.on_connection_reuseconn.append(_on_connection_reuse)
+    return trace_config
+
+
+def _backend() -> str:
+    backend = config.UPSTREAM_BACKEND
+    if backend == "httpx_h2":
+        try:
+            import h2  # noqa: F401
+            import httpx  # noqa: F401
+        except ImportError:
+            logger.warning("未安装 httpx[http2]，上游连接使用 aiohttp (HTTP/1.1)")
+            return "aiohttp"
+    return backend if backend == "httpx_h2" else "aiohttp"
+
+
+def get_session():
+    """获取共享的上游会话，需在事件循环中调用
+
+    upstream_backend 为 httpx_h2 时返回 Http2Session，否则返回 aiohttp.ClientSession。
+    """
+    global _session, _session_backend
+    if _session is None or _session.closed:
+        _session_backend = _backend()
+        if _session_backend == "httpx_h2":
+            _session = Http2Session(config.UPSTREAM_H2_CONNECTIONS)
+        else:
+            # aiohttp 导入约 200ms（含创建默认 SSL 上下文），推迟到首次使用时再导入
+            import aiohttp
+
+            _session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0, keepalive_timeout=60, ttl_dns_cache=300),
+                trace_configs=[_trace_config()],
+            )
+    return _session
+
+
+def connection_stats() -> dict:
+    """当前到上游的连接数（含空闲的）与正在使用的连接数
+
+    连接数无法读取时（依赖升级后内部结构变化）为 None，不影响统计接口的其他字段。
+    """
+    session = _session
+    if session is None or session.closed:
+        stats = {"backend": config.UPSTREAM_BACKEND, "connections": 0, "active_connections": 0}
+    else:
+        if isinstance(session, Http2Session):
+            stats = session.connection_stats()
+        else:
+            stats = _connector_stats(session.connector)
+            stats["created"] = metrics.get("upstream_connections_created")
+            stats["reused"] = metrics.get("upstream_connections_reused")
+        if stats["connections"] is not None:
+            metrics.set_max("upstream_connections_max", stats["connections"])
+        stats = {"backend": _session_backend, **stats}
+    return stats
+
+
+async def close():
+    """关闭共享会话及其连接"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
@@ -1,27 +1,54 @@
 import re
-import random
+import asyncio
 import config
-import aiohttp
+import upstream
 import logging
-from db import conn, cursor
+import db
+import invalid_keys
+import providers
+from key_pool import pool
 
 
-async def validate_key_async(api_key: str):
-    """异步验证API密钥的有效性并获取余额"""
+# 密钥检查结果
+KEY_VALID = "valid"
+KEY_INVALID = "invalid"  # 上游明确拒绝，密钥已失效
+KEY_ERROR = "error"  # 网络错误、超时、5xx 等暂时性故障，无法判断密钥是否有效
+
+
+async def check_key_async(api_key: str, base_url: str = None):
+    """异步检查API密钥，区分明确失效和暂时性故障
+
+    base_url 默认为key所属上游的地址
+
+    Returns:
+        (KEY_VALID, 余额) / (KEY_INVALID, 错误信息) / (KEY_ERROR, 错误信息)
+    """
     headers = {"Authorization": f"Bearer {api_key}"}
+    base_url = base_url or providers.base_url_of(api_key)
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://api.siliconflow.cn/v1/user/info", headers=headers, timeout=10
-            ) as r:
-                if r.status == 200:
-                    data = await r.json()
-                    return True, data.get("data", {}).get("totalBalance", 0)
-                else:
-                    data = await r.json()
-                    return False, data.get("message", "验证失败")
+        # 与转发请求共用上游连接池，批量导入和检查时不再为每个key新建连接
+        async with upstream.get_session().get(
+            f"{base_url}/v1/user/info", headers=headers, timeout=10
+        ) as r:
+            if r.status == 200:
+                data = await r.json()
+                return KEY_VALID, data.get("data", {}).get("totalBalance", 0)
+            try:
+                data = await r.json()
+                message = data.get("message", "验证失败")
+            except Exception:
+                message = f"验证失败: HTTP {r.status}"
+            if r.status == 429 or r.status >= 500:
+                return KEY_ERROR, message
+            return KEY_INVALID, message
     except Exception as e:
-        return False, f"请求失败: {str(e)}"
+        return KEY_ERROR, f"请求失败: {str(e)}"
+
+
+async def validate_key_async(api_key: str, base_url: str = None):
+    """异步验证API密钥的有效性并获取余额"""
+    status, value = await check_key_async(api_key, base_url)
+    return status == KEY_VALID, value
 
 
 def validate_key_format(key: str) -> bool:
@@ -38,110 +65,105 @@ def clean_key(key: str) -> str:
     return key.strip()
 
 
-def select_api_key(keys_with_balance, use_zero_balance=False):
-    """根据配置策略选择一个API密钥
-    
+def select_api_key(use_zero_balance=False, tag=None, model=None):
+    """根据配置策略从内存密钥池中选择一个API密钥
+
+    配置了多个上游时按 providers.route 的顺序依次在各上游的key子池中选择
+
     Args:
-        keys_with_balance: API密钥及余额的列表
-        use_zero_balance: 是否优先使用余额为0的密钥
-    
+        use_zero_balance: 是否使用余额为0的密钥
+        tag: 只从指定标签的key子池中选择，None 表示所有key
+        model: 请求的模型，用于选择提供该模型的上游
+
     Returns:
-        选择的API密钥
+        选择的API密钥，没有可用密钥时返回 None
     """
-    # keys_with_balance: list of (key, balance)
-    if not keys_with_balance:
-        return None
-
-    # 只选择启用的key
-    cursor.execute(
-        "SELECT key, balance FROM api_keys WHERE key IN ({}) AND enabled = 1".format(
-            ",".join("?" for _ in range(len(keys_with_balance)))
-        ),
-        [k[0] for k in keys_with_balance],
-    )
-    enabled_keys = cursor.fetchall()
-
-    if not enabled_keys:
-        return None
-    
-    # 如果指定使用余额为0的key，则筛选出余额为0的key
-    if use_zero_balance:
-        zero_balance_keys = [k for k in enabled_keys if float(k[1]) <= 0]
-        if zero_balance_keys:
-            # 使用余额为0的key时，固定使用随机策略
-            return random.choice(zero_balance_keys)[0]
-        # 如果没有余额为0的key，则返回None，表示无法处理此请求
-        return None
-    
-    # 如果不使用余额为0的key，则筛选出余额大于0的key
-    positive_balance_keys = [k for k in enabled_keys if float(k[1]) > 0]
-    if not positive_balance_keys:
-        return None
-    
-    # 使用正常的选择策略
-    enabled_keys = positive_balance_keys
-
-    # 基于余额的策略
-    if config.CALL_STRATEGY == "high":
-        return max(enabled_keys, key=lambda x: x[1])[0]
-    elif config.CALL_STRATEGY == "low":
-        return min(enabled_keys, key=lambda x: x[1])[0]
-
-    # 基于使用次数的策略
-    elif config.CALL_STRATEGY == "least_used":
-        cursor.execute(
-            "SELECT key, usage_count FROM api_keys WHERE key IN ({}) AND enabled = 1".format(
-                ",".join("?" for _ in range(len(enabled_keys)))
-            ),
-            [k[0] for k in enabled_keys],
-        )
-        usage_data = cursor.fetchall()
-        return min(usage_data, key=lambda x: x[1])[0]
-    elif config.CALL_STRATEGY == "most_used":
-        cursor.execute(
-            "SELECT key, usage_count FROM api_keys WHERE key IN ({}) AND enabled = 1".format(
-                ",".join("?" for _ in range(len(enabled_keys)))
-            ),
-            [k[0] for k in enabled_keys],
-        )
-        usage_data = cursor.fetchall()
-        return max(usage_data, key=lambda x: x[1])[0]
-
-    # 基于添加时间的策略
-    elif config.CALL_STRATEGY == "oldest":
-        cursor.execute(
-            "SELECT key, add_time FROM api_keys WHERE key IN ({}) AND enabled = 1".format(
-                ",".join("?" for _ in range(len(enabled_keys)))
-            ),
-            [k[0] for k in enabled_keys],
-        )
-        time_data = cursor.fetchall()
-        return min(time_data, key=lambda x: x[1])[0]
-    elif config.CALL_STRATEGY == "newest":
-        cursor.execute(
-            "SELECT key, add_time FROM api_keys WHERE key IN ({}) AND enabled = 1".format(
-                ",".join("?" for _ in range(len(enabled_keys)))
-            ),
-            [k[0] for k in enabled_keys],
-        )
-        time_data = cursor.fetchall()
-        return max(time_data, key=lambda x: x[1])[0]
-
-    # 默认随机策略
-    else:
-        return random.choice(enabled_keys)[0]
+    for upstream in providers.route(model, use_zero_balance, tag):
+        selected = pool.select(config.CALL_STRATEGY, use_zero_balance, tag, upstream)
+        if selected:
+            return selected
+    return None
 
 
 async def check_and_remove_key(key: str):
-    """检查密钥的有效性并更新余额，但不删除余额为0的有效key"""
-    valid, balance = await validate_key_async(key)
+    """检查密钥的有效性并更新余额，但不删除余额为0的有效key
+
+    暂时性故障只会隔离key，只有上游明确拒绝的key才会被删除
+    """
+    status, value = await check_key_async(key)
     logger = logging.getLogger(__name__)
-    if valid:
-        logger.info(f"Key validation successful: {key[:8]}*** - Balance: {balance}")
+    if status == KEY_VALID:
+        logger.info(f"Key validation successful: {key[:8]}*** - Balance: {value}")
         # 更新余额
-        cursor.execute("UPDATE api_keys SET balance = ? WHERE key = ?", (balance, key))
-        conn.commit()
-    else:
+        db.update_key_balance(key, value)
+    elif status == KEY_INVALID:
         logger.warning(f"Invalid key detected: {key[:8]}*** - Removing from pool")
-        cursor.execute("DELETE FROM api_keys WHERE key = ?", (key,))
-        conn.commit()
+        upstream = pool.upstream_of(key)
+        db.delete_api_key(key)
+        invalid_keys.add([(key, upstream, value)])
+    else:
+        logger.warning(f"Key check failed: {key[:8]}*** - {value}, quarantined")
+        pool.quarantine(key)
+
+
+async def probe_quarantined_keys():
+    """试探隔离期已满的key：有效则进入半开状态，失效则删除，仍然故障则继续隔离"""
+    keys = pool.due_for_probe()
+    if not keys:
+        return
+    semaphore = asyncio.Semaphore(20)
+    logger = logging.getLogger(__name__)
+
+    async def probe(key):
+        async with semaphore:
+            status, value = await check_key_async(key)
+        if status == KEY_VALID:
+            db.update_key_balance(key, value)
+            pool.half_open(key)
+            logger.info(f"Key probe successful: {key[:8]}*** - half-open")
+        elif status == KEY_INVALID:
+            logger.warning(f"Invalid key detected: {key[:8]}*** - Removing from pool")
+            upstream = pool.upstream_of(key)
+            db.delete_api_key(key)
+            invalid_keys.add([(key, upstream, value)])
+        else:
+            pool.quarantine(key)
+
+    await asyncio.gather(*(probe(key) for key in keys))
+
+
+async def probe_loop(stop_event: asyncio.Event, interval: float = 5):
+    """后台定期试探被熔断隔离的key"""
+    while not stop_event.is_set():
+        try:
+            await probe_quarantined_keys()
+        except Exception as e:
+            logging.getLogger(__name__).error(f"试探隔离的key失败: {str(e)}")
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def reconcile_loop(stop_event: asyncio.Event):
+    """后台定期用数据库校正内存密钥池，修正汇总计数的漂移，并清理过期的失效key缓存"""
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(
+                stop_event.wait(), timeout=config.POOL_RECONCILE_INTERVAL
+            )
+        except asyncio.TimeoutError:
+            pass
+        try:
+            fixed = db.reconcile_pool()
+            if fixed:
+                logging.getLogger(__name__).warning(
+                    f"内存密钥池与数据库不一致，已校正 {fixed} 个key"
+                )
+        except Exception as e:
+            logging.getLogger(__name__).error(f"校正密钥池失败: {str(e)}")
+        # 顺带清理过期的失效key缓存，导入时不再逐次清理
+        try:
+            invalid_keys.purge()
+        except Exception as e:
+            logging.getLogger(__name__).error(f"清理失效key缓存失败: {str(e)}")